@@ -2,9 +2,15 @@
 
 # TODO Determine how to handle sites in the root of the web directory (main concern is permissions)
 
+import json
+import logging
+import os
+
 import salt.utils
 
 
+log = logging.getLogger(__name__)
+
 __virtualname__ = 'wordpress'
 
 
@@ -19,8 +25,117 @@ def __virtual__():
     return False, 'The wordpress execution module cannot be loaded: PHP is not installed'
 
 
+def _cli_cache_path():
+    return os.path.join(__opts__['cachedir'], 'wordpress', 'cli.json')
+
+
+def _file_signature(path):
+    # Replacing or updating the PHAR changes at least one of these
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def _load_cli_record():
+    try:
+        with open(_cli_cache_path()) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save_cli_record(record):
+    cache_path = _cli_cache_path()
+
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, 'w') as cache_file:
+            json.dump(record, cache_file)
+    except (IOError, OSError) as e:
+        log.debug('Unable to save the WP-CLI discovery record: %s', e)
+
+
+def _probe_cli(path):
+    # ``--allow-root`` is safe here: neither command loads WordPress
+    record = {'info': {}, 'php_version': None, 'version': None, 'subcommands': {}}
+
+    info = __salt__['cmd.run_all']('{0} --info --format=json --allow-root'.format(path), python_shell=False)
+    try:
+        record['info'] = json.loads(info['stdout'])
+        record['php_version'] = record['info'].get('php_version')
+        record['version'] = record['info'].get('wp_cli_version')
+    except ValueError:
+        log.debug('Unable to parse the output of \'wp --info\': %s', info['stderr'])
+
+    dump = __salt__['cmd.run_all']('{0} cli cmd-dump --allow-root'.format(path), python_shell=False)
+    try:
+        record['subcommands'] = dict(
+            (command['name'], sorted(sub['name'] for sub in command.get('subcommands', [])))
+            for command in json.loads(dump['stdout']).get('subcommands', [])
+        )
+    except (ValueError, KeyError):
+        log.debug('Unable to parse the output of \'wp cli cmd-dump\': %s', dump['stderr'])
+
+    return record
+
+
+def cli_info(refresh=False):
+    """
+    Return the cached WP-CLI discovery record
+
+    The record holds the binary path, the ``wp --info`` output, the PHP and WP-CLI versions,
+    and the available subcommands.  It is kept in ``__context__`` and in the minion cache,
+    and is only rebuilt when the binary's mtime or size changes, or when it disappears.
+    :param refresh: Rebuild the record even if the binary is unchanged
+    :return: The discovery record, or None if WP-CLI is not installed
+    """
+    record = None if refresh else __context__.get('wordpress.cli') or _load_cli_record()
+
+    if record and _file_signature(record['path']) == record['signature']:
+        __context__['wordpress.cli'] = record
+        return record
+
+    path = salt.utils.which('wp')
+    if not path:
+        __context__.pop('wordpress.cli', None)
+        return None
+
+    record = _probe_cli(path)
+    record['path'] = path
+    record['signature'] = _file_signature(path)
+
+    __context__['wordpress.cli'] = record
+    _save_cli_record(record)
+
+    return record
+
+
+def cli_supports(command):
+    """
+    Check whether the installed WP-CLI provides a command, without running WP-CLI
+
+    :param command: A top-level command such as 'plugin', or a subcommand such as 'plugin auto-updates'
+    :return:
+    """
+    record = cli_info()
+    if not record:
+        return False
+
+    parts = command.split(None, 1)
+    if parts[0] not in record['subcommands']:
+        return False
+
+    return len(parts) == 1 or parts[1] in record['subcommands'][parts[0]]
+
+
 def check_cli_installed():
-    return salt.utils.which('wp')
+    # Called by the ``__virtual__`` of every WordPress module, so this must stay cheap;
+    # it only stats the binary found on a previous call
+    record = cli_info()
+    return record['path'] if record else None
 
 
 def install_wp_cli(source, checksum, user, group):
@@ -29,6 +144,3 @@ def install_wp_cli(source, checksum, user, group):
     ret = __states__['file.managed'](name='/usr/local/bin/wp', source=source, source_hash=checksum, user=user,
                                      group=group, mode=740)
     return ret
-
-
-
@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+
+# Minion-local cache of downloaded WordPress packages, shared by every site on the minion.
+#
+# Files are stored content-addressed (named by their SHA-256 and the archive suffix) under
+# ``<wordpress:cache_dir>/<kind>/``, next to an ``index.json`` mapping cache keys
+# (such as 'core/6.4.2/en_US') to the file hash, size and last use.
+# The hash is checked again on every read, so a corrupted file is dropped and re-fetched.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urljoin, urlsplit
+from urllib.request import urlopen
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+_VERSION_CHECK_URL = 'https://api.wordpress.org/core/version-check/1.7/?locale={0}'
+
+_ARTIFACT_INFO_URLS = {
+    'plugin': 'https://api.wordpress.org/plugins/info/1.0/{0}.json',
+    'theme': 'https://api.wordpress.org/themes/info/1.1/?action=theme_information&request[slug]={0}',
+}
+
+_ARTIFACT_URL = 'https://downloads.wordpress.org/{0}/{1}.{2}.zip'
+
+_CACHE_KINDS = ('core', 'plugin', 'theme')
+
+# WP-CLI only installs local archives whose name ends in '.zip'
+_SUFFIXES = {
+    'core': '.tar.gz',
+    'plugin': '.zip',
+    'theme': '.zip',
+}
+
+_CHUNK_SIZE = 1024 * 1024
+
+_MAX_SIZE_OPTIONS = {
+    'core': ('wordpress:core_cache_max_size', 512 * 1024 * 1024),
+    'plugin': ('wordpress:artifact_cache_max_size', 1024 * 1024 * 1024),
+    'theme': ('wordpress:artifact_cache_max_size', 1024 * 1024 * 1024),
+}
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# The index, stats and latest-version files are read, changed and rewritten as a whole;
+# ``prefetch`` and the fleet functions update them from several threads
+_INDEX_LOCK = threading.RLock()
+
+
+def __virtual__():
+    """
+    The cache is pure Python, so it is always available
+    :return:
+    """
+    return __virtualname__
+
+
+def _cache_dir(kind):
+    cache_dir = __salt__['config.get']('wordpress:cache_dir',
+                                       os.path.join(__opts__['cachedir'], 'wordpress', 'cache'))
+    kind_dir = os.path.join(cache_dir, kind)
+
+    if not os.path.isdir(kind_dir):
+        os.makedirs(kind_dir)
+
+    return kind_dir
+
+
+def _load_index(kind):
+    try:
+        with open(os.path.join(_cache_dir(kind), 'index.json')) as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_index(kind, index):
+    # Written to a temporary file first so that a concurrent reader never sees a partial index
+    kind_dir = _cache_dir(kind)
+    fd, tmp_path = tempfile.mkstemp(dir=kind_dir, suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as index_file:
+        json.dump(index, index_file, indent=2, sort_keys=True)
+
+    os.rename(tmp_path, os.path.join(kind_dir, 'index.json'))
+
+
+def _file_hash(file_path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+
+    with open(file_path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _count(kind, outcome):
+    # Keeps persistent hit/miss counters next to the index
+    stats_path = os.path.join(_cache_dir(kind), 'stats.json')
+
+    try:
+        with open(stats_path) as stats_file:
+            stats = json.load(stats_file)
+    except (IOError, OSError, ValueError):
+        stats = {'hits': 0, 'misses': 0}
+
+    stats[outcome] = stats.get(outcome, 0) + 1
+
+    with open(stats_path, 'w') as stats_file:
+        json.dump(stats, stats_file)
+
+
+def _evict(kind, index, max_size, keep=None):
+    # Drops the least recently used entries, other than ``keep``, until the cache fits in ``max_size`` bytes
+    total = sum(entry['size'] for entry in index.values())
+
+    for key in sorted(index, key=lambda k: index[k]['last_used']):
+        if total <= max_size:
+            break
+        if key == keep:
+            continue
+
+        entry = index.pop(key)
+        total -= entry['size']
+
+        # Identical content may be shared by several keys
+        if not any(other['sha256'] == entry['sha256'] for other in index.values()):
+            try:
+                os.remove(os.path.join(_cache_dir(kind), entry['sha256'] + _SUFFIXES[kind]))
+            except OSError:
+                pass
+
+        log.debug('Evicted \'%s\' from the WordPress %s cache', key, kind)
+
+
+def _cache_get(kind, key, count=True):
+    """
+    Return the path of the cached file for ``key``, or None
+
+    The file hash is verified before the path is returned.
+    Lookups made by ``prefetch`` pass ``count=False``, so that they do not skew the hit/miss counters.
+    """
+    with _INDEX_LOCK:
+        index = _load_index(kind)
+        entry = index.get(key)
+
+        if entry is None:
+            if count:
+                _count(kind, 'misses')
+            return None
+
+        file_path = os.path.join(_cache_dir(kind), entry['sha256'] + _SUFFIXES[kind])
+
+        if not os.path.isfile(file_path) or _file_hash(file_path) != entry['sha256']:
+            log.warning('Dropping corrupted entry \'%s\' from the WordPress %s cache', key, kind)
+            index.pop(key)
+            _save_index(kind, index)
+            if count:
+                _count(kind, 'misses')
+            return None
+
+        entry['last_used'] = time.time()
+        _save_index(kind, index)
+        if count:
+            _count(kind, 'hits')
+
+    return file_path
+
+
+def _cache_put(kind, key, source_path, max_size, copy=False):
+    # Moves (or copies) ``source_path`` into the cache and returns its new path
+    sha256 = _file_hash(source_path)
+    file_path = os.path.join(_cache_dir(kind), sha256 + _SUFFIXES[kind])
+
+    with _INDEX_LOCK:
+        if copy:
+            shutil.copyfile(source_path, file_path)
+        else:
+            shutil.move(source_path, file_path)
+        # Packages are extracted or installed as the site user, not as the minion user
+        os.chmod(file_path, 0o644)
+
+        index = _load_index(kind)
+        index[key] = {
+            'sha256': sha256,
+            'size': os.path.getsize(file_path),
+            'last_used': time.time(),
+        }
+        _evict(kind, index, max_size, keep=key)
+        _save_index(kind, index)
+
+    return file_path
+
+
+def _max_size(kind):
+    option, default = _MAX_SIZE_OPTIONS[kind]
+    return __salt__['config.get'](option, default)
+
+
+def _download(url, kind):
+    # Downloads ``url`` to a temporary file inside the cache directory and returns its path
+    fd, tmp_path = tempfile.mkstemp(dir=_cache_dir(kind), suffix='.part')
+
+    try:
+        response = urlopen(url, timeout=60)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            shutil.copyfileobj(response, tmp_file, _CHUNK_SIZE)
+    except Exception as e:
+        os.remove(tmp_path)
+        raise CommandExecutionError('Unable to download {0}: {1}'.format(url, e))
+
+    return tmp_path
+
+
+def _request(connections, url, headers=None, max_redirects=5):
+    """
+    Send a GET request for ``url`` and return the response, following redirects
+
+    ``connections`` maps (thread, scheme, host) to an open connection, so that every worker thread
+    keeps one connection alive per host; the response must be read to the end before the next request.
+    """
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        key = (threading.current_thread().ident, parts.scheme, parts.netloc)
+
+        connection = connections.get(key)
+        if connection is None:
+            connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+            connection = connections[key] = connection_class(parts.netloc, timeout=60)
+
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        try:
+            connection.request('GET', path, headers=headers or {})
+            response = connection.getresponse()
+        except (HTTPException, socket.error):
+            # The server may have closed the idle connection; try once more on a new one
+            connection.close()
+            connection.request('GET', path, headers=headers or {})
+            response = connection.getresponse()
+
+        if response.status not in _REDIRECT_STATUSES:
+            return response
+
+        response.read()
+        url = urljoin(url, response.getheader('Location'))
+
+    raise CommandExecutionError('Too many redirects for {0}'.format(url))
+
+
+def _download_resumable(connections, url, kind):
+    """
+    Download ``url`` into the cache directory and return the path of the file
+
+    The partial file is named after the URL and kept when a download fails,
+    so that the next attempt only requests the missing bytes.
+    """
+    part_path = os.path.join(_cache_dir(kind), hashlib.sha1(url.encode('utf-8')).hexdigest() + '.part')
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset else None
+
+    try:
+        response = _request(connections, url, headers)
+
+        # The previous attempt got every byte but stopped before the file was cached
+        if response.status == 416 and offset:
+            response.read()
+            return part_path
+
+        if response.status not in (200, 206):
+            response.read()
+            raise CommandExecutionError('HTTP {0} {1}'.format(response.status, response.reason))
+
+        # Servers that ignore the range send the whole file again
+        with open(part_path, 'ab' if response.status == 206 else 'wb') as part_file:
+            shutil.copyfileobj(response, part_file, _CHUNK_SIZE)
+    except Exception as e:
+        raise CommandExecutionError('Unable to download {0}: {1}'.format(url, e))
+
+    return part_path
+
+
+def _fetch_text(url):
+    try:
+        return urlopen(url, timeout=30).read().decode('utf-8').strip()
+    except Exception as e:
+        raise CommandExecutionError('Unable to download {0}: {1}'.format(url, e))
+
+
+def _core_url(version, locale):
+    if locale == 'en_US':
+        return 'https://wordpress.org/wordpress-{0}.tar.gz'.format(version)
+    return 'https://downloads.wordpress.org/release/{0}/wordpress-{1}.tar.gz'.format(locale, version)
+
+
+def _newest_cached(kind, prefix):
+    # Returns the newest version cached under ``prefix``, such as 'plugin/akismet/'
+    versions = [key[len(prefix):] for key in _load_index(kind) if key.startswith(prefix)]
+
+    if not versions:
+        return None
+
+    return max(versions, key=lambda v: [int(part) if part.isdigit() else 0 for part in v.split('.')])
+
+
+def _remembered_latest(kind, name):
+    # The latest version looked up less than 'wordpress:latest_max_age' seconds ago (default one hour), or None
+    max_age = __salt__['config.get']('wordpress:latest_max_age', 3600)
+
+    try:
+        with open(os.path.join(_cache_dir(kind), 'latest.json')) as latest_file:
+            entry = json.load(latest_file).get(name)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if entry and time.time() - entry['checked'] < max_age:
+        return entry['version']
+    return None
+
+
+def _remember_latest(kind, name, version):
+    latest_path = os.path.join(_cache_dir(kind), 'latest.json')
+
+    with _INDEX_LOCK:
+        try:
+            with open(latest_path) as latest_file:
+                latest = json.load(latest_file)
+        except (IOError, OSError, ValueError):
+            latest = {}
+
+        latest[name] = {'version': version, 'checked': time.time()}
+
+        fd, tmp_path = tempfile.mkstemp(dir=_cache_dir(kind), suffix='.tmp')
+        with os.fdopen(fd, 'w') as latest_file:
+            json.dump(latest, latest_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, latest_path)
+
+    return version
+
+
+def _latest_core_version(locale):
+    # Asks wordpress.org for the latest release, unless it was looked up recently (for instance by ``prefetch``);
+    # offline, the newest cached release is used instead
+    remembered = _remembered_latest('core', locale)
+    if remembered:
+        return remembered
+
+    try:
+        offers = json.loads(_fetch_text(_VERSION_CHECK_URL.format(locale)))['offers']
+        return _remember_latest('core', locale, offers[0]['current'])
+    except (CommandExecutionError, ValueError, KeyError, IndexError) as e:
+        log.debug('Unable to look up the latest WordPress version: %s', e)
+
+    suffix = '/{0}'.format(locale)
+    cached = [key.split('/')[1] for key in _load_index('core') if key.endswith(suffix)]
+
+    if not cached:
+        raise CommandExecutionError('Unable to determine the latest WordPress version for locale {0}'
+                                    .format(locale))
+
+    return max(cached, key=lambda v: [int(part) if part.isdigit() else 0 for part in v.split('.')])
+
+
+def _latest_artifact_version(kind, slug):
+    # Asks wordpress.org for the latest release, unless it was looked up recently (for instance by ``prefetch``);
+    # offline, the newest cached release is used instead
+    remembered = _remembered_latest(kind, slug)
+    if remembered:
+        return remembered
+
+    try:
+        return _remember_latest(kind, slug, json.loads(_fetch_text(_ARTIFACT_INFO_URLS[kind].format(slug)))['version'])
+    except (CommandExecutionError, ValueError, KeyError, TypeError) as e:
+        log.debug('Unable to look up the latest version of %s \'%s\': %s', kind, slug, e)
+
+    version = _newest_cached(kind, '{0}/{1}/'.format(kind, slug))
+
+    if version is None:
+        raise CommandExecutionError('Unable to determine the latest version of {0} \'{1}\''.format(kind, slug))
+
+    return version
+
+
+def core_package(version=None, locale='en_US'):
+    """
+    Return the path of the WordPress core tarball for ``version`` and ``locale``, downloading it if needed
+
+    Downloaded packages are checked against the SHA-1 published by wordpress.org when one is available.
+    The cache is limited to 'wordpress:core_cache_max_size' bytes (default 512 MiB),
+    evicting the least recently used packages first.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.core_package 6.4.2 de_DE
+
+    :param version: The WordPress version; the latest release if not given
+    :param locale: The WordPress locale
+    :return: The path of the cached tarball
+    """
+    locale = locale or 'en_US'
+    version = version or _latest_core_version(locale)
+    key = 'core/{0}/{1}'.format(version, locale)
+
+    cached = _cache_get('core', key)
+    if cached:
+        return cached
+
+    url = _core_url(version, locale)
+    tmp_path = _download(url, 'core')
+
+    try:
+        expected = _fetch_text(url + '.sha1').split()[0]
+    except CommandExecutionError:
+        expected = None
+
+    if expected and _file_hash(tmp_path, 'sha1') != expected:
+        os.remove(tmp_path)
+        raise CommandExecutionError('Checksum mismatch for {0}'.format(url))
+
+    return _cache_put('core', key, tmp_path, _max_size('core'))
+
+
+def _check_kind(kind):
+    if kind not in _CACHE_KINDS[1:]:
+        raise SaltInvocationError('The artifact kind must be \'plugin\' or \'theme\', not \'{0}\''.format(kind))
+
+
+def artifact_package(kind, slug, version=None):
+    """
+    Return the path of the zip archive of a plugin or theme, downloading it from wordpress.org if needed
+
+    The cache is limited to 'wordpress:artifact_cache_max_size' bytes per kind (default 1 GiB),
+    evicting the least recently used archives first.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.artifact_package plugin akismet 5.3
+
+    :param kind: 'plugin' or 'theme'
+    :param slug: The wordpress.org slug of the plugin or theme
+    :param version: The version; the latest release if not given
+    :return: The path of the cached zip archive
+    """
+    _check_kind(kind)
+
+    version = version or _latest_artifact_version(kind, slug)
+    key = '{0}/{1}/{2}'.format(kind, slug, version)
+
+    cached = _cache_get(kind, key)
+    if cached:
+        return cached
+
+    tmp_path = _download(_ARTIFACT_URL.format(kind, slug, version), kind)
+
+    return _cache_put(kind, key, tmp_path, _max_size(kind))
+
+
+def cache_add(kind, slug, version, source):
+    """
+    Add a local package to the cache, for instance to provision sites without network access
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.cache_add plugin akismet 5.3 /srv/packages/akismet.5.3.zip
+
+    :param kind: 'core', 'plugin' or 'theme'
+    :param slug: The plugin or theme slug, or the locale for 'core'
+    :param version: The version of the package
+    :param source: The path of the archive to add; it is copied, not moved
+    :return: The path of the cached archive
+    """
+    if kind == 'core':
+        key = 'core/{0}/{1}'.format(version, slug)
+    else:
+        _check_kind(kind)
+        key = '{0}/{1}/{2}'.format(kind, slug, version)
+
+    if not os.path.isfile(source):
+        raise SaltInvocationError('No such file: {0}'.format(source))
+
+    return _cache_put(kind, key, source, _max_size(kind), copy=True)
+
+
+def cache_stats():
+    """
+    Report the size, entry count and hit/miss counters of the package caches
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.cache_stats
+
+    :return: A dict with one entry per cache kind ('core', 'plugin' and 'theme')
+    """
+    ret = {}
+
+    for kind in _CACHE_KINDS:
+        index = _load_index(kind)
+
+        try:
+            with open(os.path.join(_cache_dir(kind), 'stats.json')) as stats_file:
+                stats = json.load(stats_file)
+        except (IOError, OSError, ValueError):
+            stats = {}
+
+        ret[kind] = {
+            'entries': len(index),
+            'size': sum(entry['size'] for entry in index.values()),
+            'hits': stats.get('hits', 0),
+            'misses': stats.get('misses', 0),
+        }
+
+    return ret
+
+
+def _named_versions(items):
+    # Pillar lists may be ['akismet', ...], {'akismet': '5.3', ...} or {'akismet': {'version': '5.3', ...}, ...}
+    if not items:
+        return []
+    if isinstance(items, dict):
+        return [(name, spec.get('version') if isinstance(spec, dict) else spec) for name, spec in items.items()]
+    return [(name, None) for name in items]
+
+
+def _site_packages(site):
+    # The (kind, name, version) packages referenced by one site definition; 'name' is the locale for core
+    packages = {('core', site.get('locale') or 'en_US', site.get('version'))}
+
+    packages.update(('plugin', name, version) for name, version in _named_versions(site.get('plugins')))
+    packages.update(('theme', name, version) for name, version in _named_versions(site.get('themes')))
+    if site.get('theme'):
+        packages.add(('theme', site['theme'], None))
+
+    # URLs and local archives are installed from where they are
+    return set(package for package in packages
+               if package[0] == 'core' or not ('/' in package[1] or package[1].endswith('.zip')))
+
+
+def _resolve_package(kind, name, version):
+    # Returns the cache key and download URL of a package, looking up the latest version if none is given
+    if kind == 'core':
+        version = version or _latest_core_version(name)
+        return 'core/{0}/{1}'.format(version, name), _core_url(version, name)
+
+    version = version or _latest_artifact_version(kind, name)
+    return '{0}/{1}/{2}'.format(kind, name, version), _ARTIFACT_URL.format(kind, name, version)
+
+
+def _prefetch_package(connections, kind, key, url):
+    # Returns whether the package was 'cached' already or 'downloaded'
+    if _cache_get(kind, key, count=False):
+        return 'cached'
+
+    part_path = _download_resumable(connections, url, kind)
+
+    if kind == 'core':
+        try:
+            response = _request(connections, url + '.sha1')
+            body = response.read().decode('utf-8').split()
+            expected = body[0] if response.status == 200 and body else None
+        except (HTTPException, socket.error, CommandExecutionError):
+            expected = None
+
+        if expected and _file_hash(part_path, 'sha1') != expected:
+            os.remove(part_path)
+            raise CommandExecutionError('Checksum mismatch for {0}'.format(url))
+
+    _cache_put(kind, key, part_path, _max_size(kind))
+
+    return 'downloaded'
+
+
+def prefetch(sites=None, concurrency=None):
+    """
+    Download every core version, plugin and theme referenced by the site definitions into the package caches,
+    so that the downloads and installs made later by the states are local operations
+
+    Site definitions are read from the pillar key 'wordpress:sites', a dict keyed by site path::
+
+        wordpress:
+          sites:
+            /var/www/example:
+              version: 6.4.2
+              locale: de_DE
+              plugins:
+                akismet: 5.3
+                classic-editor: {}
+              themes: [twentytwentythree]
+              theme: twentytwentyfour
+
+    Packages without a version resolve to the latest release, which is remembered for
+    'wordpress:latest_max_age' seconds, so that the states do not look it up again.
+    Downloads run in up to 'wordpress:prefetch_concurrency' threads (default 4); each thread keeps one
+    connection alive per host, and interrupted downloads resume where they stopped on the next run.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.prefetch
+        salt '*' wordpress.prefetch concurrency=8
+
+    :param sites: Site definitions to use instead of the pillar, in the same format
+    :param concurrency: How many packages to download at once
+    :return: A dict with the cache keys 'downloaded' and already 'cached', and the 'failed' packages with errors
+    """
+    if sites is None:
+        sites = __salt__['pillar.get']('wordpress:sites', {})
+    if not isinstance(sites, dict):
+        raise SaltInvocationError('The site definitions must be a dict keyed by site path')
+
+    packages = set()
+    for site in sites.values():
+        packages.update(_site_packages(site or {}))
+
+    concurrency = int(concurrency or __salt__['config.get']('wordpress:prefetch_concurrency', 4))
+    connections = {}
+
+    ret = {'downloaded': [], 'cached': [], 'failed': {}}
+
+    def _resolve(package):
+        try:
+            return package, _resolve_package(*package), None
+        except Exception as e:
+            return package, None, str(e)
+
+    def _fetch(download):
+        kind, key, url = download
+        try:
+            return key, _prefetch_package(connections, kind, key, url), None
+        except Exception as e:
+            return key, None, str(e)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            # Versions are resolved first, so that a package listed both with and without a version
+            # is downloaded once, by one thread, rather than twice into the same partial file
+            downloads = {}
+            for (kind, name, version), resolved, error in executor.map(_resolve, sorted(packages, key=str)):
+                if error is None:
+                    downloads[resolved[0]] = (kind, resolved[0], resolved[1])
+                else:
+                    ret['failed']['{0}/{1}/{2}'.format(kind, name, version or 'latest')] = error
+
+            for key, result, error in executor.map(_fetch, [downloads[key] for key in sorted(downloads)]):
+                if error is None:
+                    ret[result].append(key)
+                else:
+                    ret['failed'][key] = error
+    finally:
+        for connection in connections.values():
+            connection.close()
+
+    ret['downloaded'].sort()
+    ret['cached'].sort()
+
+    return ret
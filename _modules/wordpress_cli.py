@@ -4,13 +4,38 @@
 # TODO Is the 'path' argument necessary for WP-CLI if we are setting the CWD?
 # TODO Add support for other WP-CLI arguments/flags
 
+import asyncio
+import collections
+import functools
+import hashlib
+import json
+import logging
 import os
+import resource
+import shlex
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from salt.exceptions import CommandExecutionError, SaltInvocationError
 
 
+log = logging.getLogger(__name__)
+
 __virtualname__ = 'wordpress'
 
+# The fleet functions run commands from several threads
+_STATS_LOCK = threading.Lock()
+_OUTPUT_LOCK = threading.Lock()
+
+# Batches running now, and started so far, in this process; see ``_run_commands``
+_BATCHES = {'active': 0, 'started': 0}
+_BATCHES_LOCK = threading.Lock()
+
+# Longest line accepted from a streamed command; WP-CLI prints far shorter ones
+_STREAM_LINE_LIMIT = 1024 * 1024
+
 
 def __virtual__():
     """
@@ -27,34 +52,806 @@ def __virtual__():
     return False, 'The wordpress execution module cannot be loaded: PHP is not installed'
 
 
-def _run_command(cmd, cwd, runas):
+def _run_command(cmd, cwd, runas, timeout=None, stream=False):
     """
     A shorthand for executing a command.
     Ideally, this will be inlined by the runtime to avoid overhead.
     :param cmd:
     :param cwd:
     :param runas:
+    :param timeout: Seconds before the command is killed; defaults to 'wordpress:command_timeout'
+    :param stream: Read the output line by line as it is produced and report progress (see ``_stream_output``)
+    :return:
+    """
+    # A single command is a batch of one; see ``_run_commands``
+    cmd_result = _run_commands([(cmd, cwd, runas)], timeout=timeout, stream=stream)[0]
+
+    if isinstance(cmd_result, Exception):
+        raise cmd_result
+
+    return cmd_result
+
+
+def _run_commands(commands, concurrency=None, timeout=None, stream=False):
+    """
+    Run several independent commands at once with the asyncio engine
+
+    :param commands: A list of (cmd, cwd, runas) tuples
+    :param concurrency: The maximum number of commands running at once
+                        (default: the 'wordpress:command_concurrency' option, or 8)
+    :param timeout: Seconds before a command is killed (default: the 'wordpress:command_timeout' option, or none)
+    :param stream: Read the output line by line as it is produced and report progress (see ``_stream_output``)
+    :return: The ``cmd.run_all``-style result of every command, in order;
+             a command that failed to run or timed out has its exception instead
+    """
+    if concurrency is None:
+        concurrency = __salt__['config.get']('wordpress:command_concurrency', 8)
+    if timeout is None:
+        timeout = __salt__['config.get']('wordpress:command_timeout', None)
+
+    with _BATCHES_LOCK:
+        overlapped = _BATCHES['active'] > 0
+        _BATCHES['active'] += 1
+        _BATCHES['started'] += 1
+        started_before = _BATCHES['started']
+
+    children_before = os.times()
+    peak_before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    try:
+        results, records = _run_sync(_gather_commands(commands, max(1, int(concurrency)), timeout, stream))
+    finally:
+        with _BATCHES_LOCK:
+            _BATCHES['active'] -= 1
+            overlapped = overlapped or _BATCHES['started'] != started_before
+
+    children_after = os.times()
+    peak_after = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    # The kernel only reports children's CPU time and peak RSS for the whole process, reaped children
+    # included, and the event loop reaps them itself.  They are shared out by wall time within a batch,
+    # but a batch that ran alongside another one (such as the fleet functions' threads) would also count
+    # that batch's children, so it reports None instead.
+    # Commands sent to a persistent worker report none, as the worker is never waited for.
+    cpu_time = (children_after[2] - children_before[2]) + (children_after[3] - children_before[3])
+    total_wall_time = sum(record['wall_time'] for record in records)
+
+    for record in records:
+        if overlapped:
+            record['cpu_time'] = None
+        else:
+            record['cpu_time'] = cpu_time * record['wall_time'] / total_wall_time if total_wall_time else 0.0
+        # The kernel only tracks the largest child so far; None means this batch was not a new peak,
+        # or that the peak cannot be attributed to one of its commands
+        record['peak_rss_kb'] = peak_after if peak_after > peak_before and len(records) == 1 \
+            and not overlapped else None
+        _record_command(record)
+
+    return results
+
+
+def _run_sync(coroutine):
+    # Every call gets its own event loop, which works from the fleet's threads as well.
+    # If this thread already runs a loop (the minion's own), the engine runs in a helper thread.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return _run_loop(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_run_loop, coroutine).result()
+
+
+def _run_loop(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        # Cancelled tasks kill their subprocesses (see ``_spawn``), e.g. after a KeyboardInterrupt
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        if hasattr(loop, 'shutdown_default_executor'):
+            loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+async def _gather_commands(commands, concurrency, timeout, stream):
+    semaphore = asyncio.Semaphore(concurrency)
+    # A persistent worker handles one request at a time, so its commands are serialized per site
+    worker_locks = {}
+    records = []
+
+    async def _execute(cmd, cwd, runas):
+        async with semaphore:
+            started = time.time()
+            cmd_result = None
+            try:
+                # The worker only answers once a command is done, so streamed commands bypass it
+                if _use_worker() and not stream:
+                    lock = worker_locks.setdefault((cwd, runas), asyncio.Lock())
+                    async with lock:
+                        cmd_result = await _worker_run(cmd, cwd, runas)
+
+                if cmd_result is None:
+                    cmd_result = await _spawn(cmd, cwd, runas, timeout, stream)
+                cmd_result['duration'] = round(time.time() - started, 3)
+                return cmd_result
+            finally:
+                records.append({
+                    'subcommand': _subcommand(cmd),
+                    'site': cwd,
+                    'started': started,
+                    'wall_time': time.time() - started,
+                    'retcode': cmd_result.get('retcode') if cmd_result else None,
+                    'output_bytes': (cmd_result.get('output_bytes', len(cmd_result.get('stdout') or '')
+                                                     + len(cmd_result.get('stderr') or ''))
+                                     if cmd_result else 0),
+                })
+
+    results = await asyncio.gather(*[_execute(cmd, cwd, runas) for cmd, cwd, runas in commands],
+                                   return_exceptions=True)
+
+    return results, records
+
+
+def _use_worker():
+    return __salt__['config.get']('wordpress:backend', 'cli') == 'worker' and 'wordpress.worker_run' in __salt__
+
+
+async def _worker_run(cmd, cwd, runas):
+    # The worker protocol is blocking, so it runs in the loop's default thread pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, functools.partial(__salt__['wordpress.worker_run'],
+                                                                  cmd=cmd, cwd=cwd, runas=runas))
+    except CommandExecutionError as e:
+        log.debug('Falling back to a WP-CLI process: %s', e)
+        return None
+
+
+async def _spawn(cmd, cwd, runas, timeout, stream=False):
+    """
+    Run one command in a subprocess, killing it on timeout or cancellation
+
+    :return: A dict with the same 'pid', 'retcode', 'stdout' and 'stderr' keys as ``cmd.run_all``
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(*shlex.split(cmd), cwd=cwd,
+                                                    stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE,
+                                                    limit=_STREAM_LINE_LIMIT,
+                                                    **__utils__['wordpress_process.demote'](runas))
+    except (KeyError, OSError, ValueError) as e:
+        raise CommandExecutionError('Unable to run \'{0}\': {1}'.format(_subcommand(cmd), e))
+
+    try:
+        if stream:
+            return await asyncio.wait_for(_stream_output(proc, cmd, cwd), timeout)
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        await _kill(proc)
+        raise CommandExecutionError('\'{0}\' timed out after {1} seconds in \'{2}\''
+                                    .format(_subcommand(cmd), timeout, cwd))
+    except ValueError:
+        # Raised by ``readline`` for a line longer than ``_STREAM_LINE_LIMIT``
+        await _kill(proc)
+        raise CommandExecutionError('\'{0}\' wrote a line longer than {1} bytes in \'{2}\''
+                                    .format(_subcommand(cmd), _STREAM_LINE_LIMIT, cwd))
+    except asyncio.CancelledError:
+        await _kill(proc)
+        raise
+
+    # Same output handling as ``cmd.run_all``
+    return {
+        'pid': proc.pid,
+        'retcode': proc.returncode,
+        'stdout': stdout.decode('utf-8', 'replace').rstrip(),
+        'stderr': stderr.decode('utf-8', 'replace').rstrip(),
+    }
+
+
+async def _stream_output(proc, cmd, cwd):
+    """
+    Read the output of a running command line by line, keeping only the last lines of each stream
+
+    At most 'wordpress:stream_max_lines' (default 1000) lines per stream are kept, so memory does not grow
+    with chatty commands; the size and a hash of the full output are computed as it goes.
+    While the command runs, a 'wordpress/progress' event with the elapsed time and the latest line is sent
+    every 'wordpress:progress_interval' seconds (default 2), and a last one when it exits;
+    set 'wordpress:progress_events' to False to disable them.
+    """
+    max_lines = int(__salt__['config.get']('wordpress:stream_max_lines', 1000))
+    progress = {
+        'site': cwd,
+        'subcommand': _subcommand(cmd),
+        'started': time.time(),
+        'lines': 0,
+        'last_line': None,
+    }
+
+    ticker = None
+    if __salt__['config.get']('wordpress:progress_events', True):
+        interval = float(__salt__['config.get']('wordpress:progress_interval', 2))
+        ticker = asyncio.ensure_future(_report_progress(progress, interval))
+
+    try:
+        stdout, stderr = await asyncio.gather(_read_lines(proc.stdout, max_lines, progress),
+                                              _read_lines(proc.stderr, max_lines, progress))
+        await proc.wait()
+    finally:
+        if ticker is not None:
+            ticker.cancel()
+
+    if ticker is not None:
+        progress['retcode'] = proc.returncode
+        _send_progress(progress)
+
+    return {
+        'pid': proc.pid,
+        'retcode': proc.returncode,
+        'stdout': '\n'.join(stdout['lines']).rstrip(),
+        'stderr': '\n'.join(stderr['lines']).rstrip(),
+        'output_sha256': hashlib.sha256(stdout['hash'].digest() + stderr['hash'].digest()).hexdigest(),
+        'output_bytes': stdout['bytes'] + stderr['bytes'],
+        'truncated': stdout['dropped'] or stderr['dropped'],
+    }
+
+
+async def _read_lines(reader, max_lines, progress):
+    ret = {
+        'lines': collections.deque(maxlen=max_lines),
+        'hash': hashlib.sha256(),
+        'bytes': 0,
+        'dropped': False,
+    }
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            return ret
+
+        ret['hash'].update(line)
+        ret['bytes'] += len(line)
+        ret['dropped'] = ret['dropped'] or len(ret['lines']) == max_lines
+
+        text = line.decode('utf-8', 'replace').rstrip('\r\n')
+        ret['lines'].append(text)
+        progress['lines'] += 1
+        if text:
+            progress['last_line'] = text
+
+
+async def _report_progress(progress, interval):
+    # Sends at most one event per interval, however fast the command writes
+    while True:
+        await asyncio.sleep(interval)
+        _send_progress(progress)
+
+
+def _send_progress(progress):
+    data = dict(progress, elapsed=round(time.time() - progress['started'], 3))
+    try:
+        __salt__['event.send']('wordpress/progress', data)
+    except Exception as e:
+        log.debug('Unable to send a WordPress progress event: %s', e)
+
+
+async def _kill(proc):
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+def _subcommand(cmd):
+    # 'wp plugin install "x" --path="y"' -> 'plugin install'
+    args = [arg for arg in shlex.split(cmd) if not arg.startswith('-')]
+
+    if args and args[0] == 'wp':
+        return ' '.join(args[1:3])
+    return args[0] if args else ''
+
+
+def _stats_path():
+    return os.path.join(__opts__['cachedir'], 'wordpress', 'commands.jsonl')
+
+
+def _record_command(record):
+    # Keeps the record for this run, appends it to the local stats log and optionally fires an event
+    __context__.setdefault('wordpress.commands', []).append(record)
+
+    stats_path = _stats_path()
+    max_bytes = __salt__['config.get']('wordpress:stats_max_bytes', 5 * 1024 * 1024)
+
+    try:
+        with _STATS_LOCK:
+            if not os.path.isdir(os.path.dirname(stats_path)):
+                os.makedirs(os.path.dirname(stats_path))
+            if os.path.isfile(stats_path) and os.path.getsize(stats_path) > max_bytes:
+                os.rename(stats_path, stats_path + '.1')
+            with open(stats_path, 'a') as stats_file:
+                stats_file.write(json.dumps(record) + '\n')
+    except (IOError, OSError) as e:
+        log.debug('Unable to write the WordPress command stats: %s', e)
+
+    if __salt__['config.get']('wordpress:stats_events', False):
+        __salt__['event.send']('wordpress/command', record)
+
+
+def _summarize(records):
+    summary = {
+        'commands': len(records),
+        'failed': 0,
+        'wall_time': 0.0,
+        'cpu_time': 0.0,
+        'max_wall_time': 0.0,
+        'peak_rss_kb': None,
+        'output_bytes': 0,
+    }
+
+    for record in records:
+        summary['failed'] += record['retcode'] != 0
+        summary['wall_time'] += record['wall_time']
+        # None for commands that ran alongside other batches; see ``_run_commands``
+        summary['cpu_time'] += record['cpu_time'] or 0.0
+        summary['max_wall_time'] = max(summary['max_wall_time'], record['wall_time'])
+        summary['output_bytes'] += record['output_bytes']
+        if record['peak_rss_kb'] is not None:
+            summary['peak_rss_kb'] = max(summary['peak_rss_kb'] or 0, record['peak_rss_kb'])
+
+    if records and all(record['cpu_time'] is None for record in records):
+        summary['cpu_time'] = None
+
+    return summary
+
+
+def command_count():
+    """
+    Return the number of WP-CLI commands run so far in this run; used as a mark for ``command_summary``
     :return:
     """
-    # TODO Determine if this will actually be optimized away at runtime
-    # Doubtful, due to Python's ability to alter code definitions;
-    # may be possible with a decorator of some sort
-    # FIXME Inline this code, replacing with the appropriate cmd call
-    # While Python code optimizations and decorators are interesting,
-    # many of our methods only need the return code; no point in dumping everything!
-    return __salt__['cmd.run_all'](cmd=cmd, cwd=cwd, runas=runas, python_shell=False)
+    return len(__context__.get('wordpress.commands', []))
+
+
+def command_summary(start=0):
+    """
+    Summarize the WP-CLI commands run in this run, from the ``start`` mark onwards
+
+    :param start: A value previously returned by ``command_count``
+    :return: Command and failure counts, total and maximum wall time, CPU time, peak RSS and output size;
+             the CPU time and peak RSS leave out commands run concurrently from several threads
+    """
+    return _summarize(__context__.get('wordpress.commands', [])[start:])
+
+
+def stats(site_path=None, since=None):
+    """
+    Aggregate the WP-CLI command timings recorded on this minion, per site and per subcommand
+
+    Records are kept in a local log that is rotated once it exceeds 'wordpress:stats_max_bytes'
+    (default 5 MiB); the current and the previous log are read.
+    Set 'wordpress:stats_events' to also send every record to the master as a
+    'wordpress/command' event.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.stats
+        salt '*' wordpress.stats site_path=/var/www/example since=1700000000
+
+    :param site_path: Only include commands run against this site
+    :param since: Only include commands started after this UNIX timestamp
+    :return: A dict with 'total', 'sites' and 'subcommands' summaries
+    """
+    stats_path = _stats_path()
+    records = []
+
+    for path in (stats_path + '.1', stats_path):
+        try:
+            with open(path) as stats_file:
+                for line in stats_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if site_path and record['site'] != site_path:
+                        continue
+                    if since and record['started'] < float(since):
+                        continue
+                    records.append(record)
+        except (IOError, OSError):
+            continue
+
+    by_site = {}
+    by_subcommand = {}
+    for record in records:
+        by_site.setdefault(record['site'], []).append(record)
+        by_subcommand.setdefault(record['subcommand'], []).append(record)
+
+    return {
+        'total': _summarize(records),
+        'sites': dict((key, _summarize(value)) for key, value in by_site.items()),
+        'subcommands': dict((key, _summarize(value)) for key, value in by_subcommand.items()),
+    }
+
+
+def _output_path():
+    return os.path.join(__opts__['cachedir'], 'wordpress', 'output.jsonl')
+
+
+def _tail(text, lines):
+    # The last ``lines`` lines of ``text``, without splitting the whole output
+    if lines <= 0:
+        return ''
+    return '\n'.join(text.rsplit('\n', lines)[-lines:])
+
+
+def _command_result(subcommand, site_path, cmd_result):
+    """
+    Build the 'Result' of a mutating function from a ``cmd.run_all``-style result
+
+    With the default 'wordpress:result_mode' of 'compact', only the return code, the duration, the last
+    'wordpress:result_lines' (default 10) lines of stdout and stderr, and a hash of the full output are returned.
+    The full output is appended to a local log, which ``last_output`` reads back.
+    Set 'wordpress:result_mode' to 'full' to return the whole output instead.
+    """
+    if __salt__['config.get']('wordpress:result_mode', 'compact') == 'full':
+        return cmd_result
+
+    stdout = cmd_result.get('stdout') or ''
+    stderr = cmd_result.get('stderr') or ''
+    lines = int(__salt__['config.get']('wordpress:result_lines', 10))
+    # A streamed command already hashed its full output, of which only the last lines were kept
+    digest = cmd_result.get('output_sha256') \
+        or hashlib.sha256('{0}\0{1}'.format(stdout, stderr).encode('utf-8')).hexdigest()
+
+    _log_output({
+        'sha256': digest,
+        'site': site_path,
+        'subcommand': subcommand,
+        'finished': time.time(),
+        'retcode': cmd_result.get('retcode'),
+        'stdout': stdout,
+        'stderr': stderr,
+    })
+
+    stdout_tail = _tail(stdout, lines)
+    stderr_tail = _tail(stderr, lines)
+
+    return {
+        'retcode': cmd_result.get('retcode'),
+        'duration': cmd_result.get('duration'),
+        'stdout': stdout_tail,
+        'stderr': stderr_tail,
+        'output_sha256': digest,
+        'output_bytes': cmd_result.get('output_bytes', len(stdout) + len(stderr)),
+        'truncated': cmd_result.get('truncated', False) or stdout_tail != stdout or stderr_tail != stderr,
+    }
+
+
+def _log_output(entry):
+    # Same rotation scheme as the stats log; only the current and the previous log are kept
+    output_path = _output_path()
+    max_bytes = __salt__['config.get']('wordpress:output_max_bytes', 20 * 1024 * 1024)
+
+    try:
+        with _OUTPUT_LOCK:
+            if not os.path.isdir(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+            if os.path.isfile(output_path) and os.path.getsize(output_path) > max_bytes:
+                os.rename(output_path, output_path + '.1')
+            with open(output_path, 'a') as output_file:
+                output_file.write(json.dumps(entry) + '\n')
+    except (IOError, OSError) as e:
+        log.debug('Unable to write the WordPress command output log: %s', e)
+
+
+def last_output(site_path=None, subcommand=None, sha256=None):
+    """
+    Return the full output of the most recent mutating WP-CLI command, as kept by the compact result mode
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.last_output site_path=/var/www/example subcommand='plugin install'
+        salt '*' wordpress.last_output sha256=<output_sha256 from a job return>
+
+    :param site_path: Only consider commands run against this site
+    :param subcommand: Only consider this WP-CLI subcommand, e.g. 'core download'
+    :param sha256: Return the output with this hash, as reported in the 'output_sha256' of a result
+    :return: A dict with 'site', 'subcommand', 'finished', 'retcode', 'stdout' and 'stderr', or None
+    """
+    output_path = _output_path()
+    # The logs are read oldest first, so the last match wins
+    latest = None
+
+    for path in (output_path + '.1', output_path):
+        try:
+            with open(path) as output_file:
+                for line in output_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if site_path and entry['site'] != site_path:
+                        continue
+                    if subcommand and entry['subcommand'] != subcommand:
+                        continue
+                    if sha256 and entry['sha256'] != sha256:
+                        continue
+                    latest = entry
+        except (IOError, OSError):
+            continue
+
+    return latest
+
+
+def _quote_names(names):
+    # Builds the space-separated argument list for the batched commands
+    return ' '.join('"{0}"'.format(name) for name in names)
+
+
+def _list_command(item_type, site_path, user):
+    # Lists every plugin or theme of a site in a single WP-CLI call
+    return 'wp {0} list --format=json --path="{1}"'.format(item_type, site_path), site_path, user
+
+
+def _parse_items(item_type, site_path, cmd_result):
+    # Keys the WP-CLI list output by name
+    if isinstance(cmd_result, Exception):
+        raise cmd_result
+
+    if cmd_result['retcode'] != 0:
+        raise CommandExecutionError('Unable to list {0}s for site at path \'{1}\': {2}'
+                                    .format(item_type, site_path, cmd_result['stderr']))
+
+    try:
+        items = json.loads(cmd_result['stdout'])
+    except ValueError:
+        raise CommandExecutionError('Unable to parse the {0} list for site at path \'{1}\''
+                                    .format(item_type, site_path))
+
+    return dict((item['name'], item) for item in items)
+
+
+def _invalidate_inventory(site_path):
+    # Called after every mutating command; the next read will query WP-CLI again
+    __context__.get('wordpress.inventory', {}).pop(site_path, None)
+    __context__.get('wordpress.network_inventory', {}).pop(site_path, None)
+    __context__.get('wordpress.current_states', {}).pop(site_path, None)
+    _drop_snapshot(site_path)
+
+
+# What a site's fingerprint is made of; plugin and theme installs, removals and updates
+# all replace directories, which changes the mtime of the parent directory
+_FINGERPRINT_PATHS = (
+    'wp-config.php',
+    os.path.join('wp-content', 'plugins'),
+    os.path.join('wp-content', 'themes'),
+    os.path.join('wp-includes', 'version.php'),
+)
+
+
+def _snapshot_path(site_path):
+    name = hashlib.sha1(os.path.abspath(site_path).encode('utf-8')).hexdigest()
+    return os.path.join(__opts__['cachedir'], 'wordpress', 'fingerprints', name + '.json')
+
+
+def _use_fingerprints():
+    return (__salt__['config.get']('wordpress:fingerprint', True)
+            and not __salt__['config.get']('wordpress:force_refresh', False))
+
+
+def _fingerprint(site_path):
+    # Returns the fingerprint, and whether it covers the plugin and theme statuses
+    parts = []
+    for relative_path in _FINGERPRINT_PATHS:
+        try:
+            stat = os.stat(os.path.join(site_path, relative_path))
+            parts.append([relative_path, stat.st_mtime_ns, stat.st_size, stat.st_ino])
+        except OSError:
+            parts.append([relative_path, None])
+
+    # Activations only change the database, so statuses are covered only when they can be read from it
+    covers_statuses = False
+    if _use_db_backend('wordpress.db_active_plugins') and 'wordpress.db_active_theme' in __salt__:
+        try:
+            parts.append(['active_plugins', __salt__['wordpress.db_active_plugins'](site_path=site_path)])
+            parts.append(['active_theme', __salt__['wordpress.db_active_theme'](site_path=site_path)])
+            covers_statuses = True
+        except Exception as e:
+            log.debug('Unable to read the active plugins and theme of site at path \'%s\': %s', site_path, e)
+            parts.append(['active_plugins', None])
+
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest(), covers_statuses
+
+
+def site_fingerprint(site_path):
+    """
+    Compute the fingerprint of a site, used to skip the WP-CLI probes of sites that have not changed
+
+    The fingerprint covers the mtimes of wp-config.php, wp-content/plugins, wp-content/themes and
+    wp-includes/version.php.  Activations do not touch the file system, so the active plugins and theme
+    are only included when they can be read directly from the database (see 'wordpress:check_backend');
+    without them, the snapshot still answers whether the site is installed, but plugin and theme
+    statuses are always probed with WP-CLI.
+    :param site_path: The path of the site
+    :return: A hex digest
+    """
+    return _fingerprint(site_path)[0]
+
+
+def _load_snapshot(site_path):
+    """
+    Return the current fingerprint of a site, and its snapshot if it was saved with the same fingerprint
+
+    A snapshot holds what the last run learned from WP-CLI about an unchanged site:
+    its 'inventory' (only if the fingerprint covers the statuses) and whether it is 'installed'.
+    Snapshots are trusted for up to 'wordpress:fingerprint_max_age' seconds (default 1 day).
+    """
+    if not _use_fingerprints():
+        return None, None
+
+    fingerprint, covers_statuses = _fingerprint(site_path)
+    max_age = __salt__['config.get']('wordpress:fingerprint_max_age', 24 * 60 * 60)
+
+    try:
+        with open(_snapshot_path(site_path)) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (IOError, OSError, ValueError):
+        return fingerprint, None
+
+    if snapshot.get('fingerprint') != fingerprint or time.time() - snapshot.get('saved', 0) > max_age:
+        return fingerprint, None
+
+    if not covers_statuses:
+        snapshot.pop('inventory', None)
+
+    return fingerprint, snapshot
+
 
+def _save_snapshot(site_path, fingerprint, **data):
+    # ``fingerprint`` must be computed before querying WP-CLI, so that a change made in the meantime
+    # makes the snapshot stale rather than hiding the change
+    if fingerprint is None or not _use_fingerprints():
+        return
 
-def _parse_status(command_stdout):
-    # Splits command results into a dict
-    # Rather overbuilt given that we only care about the 'Status' line
-    # Based off of https://stackoverflow.com/a/16175368
+    snapshot_path = _snapshot_path(site_path)
+
+    try:
+        with open(snapshot_path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (IOError, OSError, ValueError):
+        snapshot = {}
+
+    if snapshot.get('fingerprint') != fingerprint:
+        snapshot = {'site': site_path, 'fingerprint': fingerprint, 'saved': time.time()}
+    snapshot.update(data)
+
+    try:
+        if not os.path.isdir(os.path.dirname(snapshot_path)):
+            os.makedirs(os.path.dirname(snapshot_path))
+        # Written to a temporary file first, so that readers never see a partial snapshot
+        temp_path = '{0}.{1}.{2}'.format(snapshot_path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.rename(temp_path, snapshot_path)
+    except (IOError, OSError) as e:
+        log.debug('Unable to save the snapshot of site at path \'%s\': %s', site_path, e)
+
+
+def _drop_snapshot(site_path):
+    try:
+        os.remove(_snapshot_path(site_path))
+    except OSError:
+        pass
+
+
+def clear_fingerprints(site_path=None):
+    """
+    Forget the saved fingerprints, so that the next run queries WP-CLI for every site
+
+    To bypass them for a single run instead, set 'wordpress:force_refresh' (for instance in pillar).
+    :param site_path: Only forget the fingerprint of this site
+    :return: The number of fingerprints removed
+    """
+    if site_path is not None:
+        removed = os.path.isfile(_snapshot_path(site_path))
+        _drop_snapshot(site_path)
+        return int(removed)
+
+    snapshot_dir = os.path.dirname(_snapshot_path('/'))
+    removed = 0
+    for name in os.listdir(snapshot_dir) if os.path.isdir(snapshot_dir) else []:
+        try:
+            os.remove(os.path.join(snapshot_dir, name))
+            removed += 1
+        except OSError:
+            pass
+
+    return removed
+
+
+def get_inventory(site_path, user, refresh=False):
+    """
+    Return the plugins and themes of a site, as reported by ``wp plugin list`` and ``wp theme list``
+
+    The result is kept in ``__context__`` for the rest of the run, so that the check functions
+    only need two WP-CLI calls per site instead of one per plugin or theme; both run at once.
+    It is discarded whenever a function in this module changes the site.
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :param refresh: Query WP-CLI again even if a snapshot is available
+    :return: A dict with the keys 'plugins' and 'themes', each mapping names to the WP-CLI fields
+    """
+    # Sites whose fingerprint has not changed since the last run are answered from the saved snapshot
+    inventory = get_inventories([site_path], user, refresh=refresh)[site_path]
+
+    if isinstance(inventory, Exception):
+        raise inventory
+
+    return inventory
+
+
+def get_inventories(site_paths, user, refresh=False, concurrency=None):
+    """
+    Return the inventory of several sites, listing their plugins and themes concurrently
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.get_inventories '["/var/www/one", "/var/www/two"]' www-data
+
+    :param site_paths: A list of site paths
+    :param user: The user to run WP-CLI as
+    :param refresh: Query WP-CLI again even if a snapshot is available
+    :param concurrency: The maximum number of WP-CLI processes at once
+                        (default: the 'wordpress:command_concurrency' option, or 8)
+    :return: A dict mapping each site path to its inventory (see ``get_inventory``),
+             or to the exception raised while listing it
+    """
+    inventory = __context__.setdefault('wordpress.inventory', {})
+
+    stale = []
+    fingerprints = {}
+    for site_path in site_paths:
+        if site_path in inventory and not refresh:
+            continue
+        if refresh:
+            fingerprints[site_path], snapshot = site_fingerprint(site_path) if _use_fingerprints() else None, None
+        else:
+            fingerprints[site_path], snapshot = _load_snapshot(site_path)
+        if snapshot and 'inventory' in snapshot:
+            inventory[site_path] = snapshot['inventory']
+        else:
+            stale.append(site_path)
+
+    commands = [_list_command(item_type, site_path, user) for site_path in stale for item_type in ('plugin', 'theme')]
+    results = iter(_run_commands(commands, concurrency=concurrency)) if commands else iter([])
 
     ret = {}
-    for row in command_stdout.splitlines():
-        if ': ' in row:
-            key, value = row.split(': ')
-            ret[key.strip()] = value.strip()
+    for site_path in stale:
+        plugins, themes = next(results), next(results)
+        try:
+            ret[site_path] = inventory[site_path] = {
+                'plugins': _parse_items('plugin', site_path, plugins),
+                'themes': _parse_items('theme', site_path, themes),
+            }
+        except Exception as e:
+            ret[site_path] = e
+        else:
+            _save_snapshot(site_path, fingerprints[site_path], inventory=ret[site_path])
+
+    for site_path in site_paths:
+        ret.setdefault(site_path, inventory.get(site_path))
 
     return ret
 
@@ -66,37 +863,93 @@ def check_wp_downloaded(site_path):
     return os.path.isfile(test_full_path)
 
 
-def download_wordpress(site_path, user):
+def _cached_core_package(version, locale):
+    # Returns the path of a cached core tarball, or None to let WP-CLI download it
+    if not __salt__['config.get']('wordpress:core_cache', True) or 'wordpress.core_package' not in __salt__:
+        return None
+
+    try:
+        return __salt__['wordpress.core_package'](version=version, locale=locale)
+    except CommandExecutionError as e:
+        log.debug('WordPress core cache unavailable, using WP-CLI: %s', e)
+        return None
+
+
+def _cached_artifact(kind, name, version):
+    # Returns the path of a cached plugin/theme zip, or None to let WP-CLI download it
+    if not __salt__['config.get']('wordpress:artifact_cache', True) or 'wordpress.artifact_package' not in __salt__:
+        return None
+
+    # Names that are already URLs or local archives are passed to WP-CLI untouched
+    if '/' in name or name.endswith('.zip'):
+        return None
+
+    try:
+        return __salt__['wordpress.artifact_package'](kind=kind, slug=name, version=version)
+    except CommandExecutionError as e:
+        log.debug('WordPress %s cache unavailable for \'%s\', using WP-CLI: %s', kind, name, e)
+        return None
+
+
+def _install_source(kind, name, version):
+    # Builds the WP-CLI install argument(s), preferring a cached zip over a download
+    package = _cached_artifact(kind, name, version)
+
+    if package:
+        return '"{0}"'.format(package)
+    if version:
+        return '"{0}" --version="{1}"'.format(name, version)
+    return '"{0}"'.format(name)
+
+
+def download_wordpress(site_path, user, version=None, locale=None):
     # TODO Extend this to allow use of alternate sources
 
     if check_wp_downloaded(site_path):
         raise CommandExecutionError('Wordpress is already downloaded at {0}'.format(site_path))
 
     ret = {}
-    command = 'wp core download --path="{0}"'.format(site_path)
+
+    # Extracting from the minion-local package cache avoids downloading the same tarball for every site
+    package = _cached_core_package(version, locale)
+
+    if package:
+        command = 'tar -xzf "{0}" --strip-components=1 -C "{1}"'.format(package, site_path)
+    else:
+        command = 'wp core download --path="{0}"'.format(site_path)
+        if version:
+            command += ' --version="{0}"'.format(version)
+        if locale:
+            command += ' --locale="{0}"'.format(locale)
 
     try:
-        cmd_result = _run_command(cmd=command, cwd=site_path, runas=user)
+        cmd_result = _run_command(cmd=command, cwd=site_path, runas=user, stream=True)
     except Exception as e:
         return e
 
     ret['Name'] = 'WordPress Download Package'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
 
     return ret
 
 
-def check_site_configured(site_path):
-    # TODO This does not check the actual configuration values
-    # Compare with the behavior of the apache.config state
-    # Balance duplicated effort with external dependencies in terms of WP-CLI
+def check_site_configured(site_path, config=None):
+    # Without ``config`` this only checks that wp-config.php exists.
+    # With it, the values are compared by parsing wp-config.php in Python (see ``config_diff``),
+    # which avoids one ``wp config get`` bootstrap per key.
 
     # TODO This does not validate ``site_path``
 
     test_full_path = os.path.join(site_path, 'wp-config.php')
-    return os.path.isfile(test_full_path)
+    if not os.path.isfile(test_full_path):
+        return False
+
+    if config is None or 'wordpress.config_diff' not in __salt__:
+        return True
+
+    return not __salt__['wordpress.config_diff'](site_path=site_path, config=config)
 
 
 # noinspection SpellCheckingInspection
@@ -120,34 +973,124 @@ def config_site(site_path, config, user):
     command = 'wp core config --dbname="{0}" --dbuser="{1}" --dbpass="{2}" --dbhost="{3}" --path="{4}"' \
         .format(config['dbname'], config['dbuser'], config['dbpass'], config['dbhost'], site_path)
 
+    # The optional keys are written too, so that ``config_diff`` finds nothing left to change afterwards
+    for key in ('dbprefix', 'dbcharset', 'dbcollate'):
+        if config.get(key) is not None:
+            command += ' --{0}="{1}"'.format(key, config[key])
+
     try:
         cmd_result = _run_command(command, site_path, user)
     except Exception as e:
         return e
 
     ret['Name'] = 'WordPress Site Configure'
-    ret['Path'] = config['path']
+    ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
 
     return ret
 
 
+def update_config(site_path, config, user):
+    """
+    Change existing wp-config.php values with ``wp config set``, one key at a time
+
+    The ``wp config`` commands edit the file without loading WordPress.
+    :param site_path: The path of the site
+    :param config: The keys to change, as accepted by ``config_site``
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = {}
+    results = {}
+
+    for key in config:
+        if __salt__['wordpress.config_target'](key) is None:
+            raise SaltInvocationError('Unknown config key: {0}'.format(key))
+
+    # The tables of an installed site carry its prefix; changing only wp-config.php would orphan them
+    if 'dbprefix' in config and check_site_installed(site_path, user) is True:
+        raise CommandExecutionError('Refusing to change the table prefix of installed site at path \'{0}\''
+                                    .format(site_path))
+
+    for key, value in config.items():
+        target = __salt__['wordpress.config_target'](key)
+
+        # FIXME This is liable to result in the passwords being written to plaintext logs
+        if target == '$table_prefix':
+            command = 'wp config set table_prefix "{0}" --type=variable --path="{1}"'.format(value, site_path)
+        else:
+            command = 'wp config set {0} "{1}" --type=constant --path="{2}"'.format(target, value, site_path)
+
+        try:
+            cmd_result = _run_command(command, site_path, user)
+        except Exception as e:
+            return e
+
+        results[key] = cmd_result['retcode']
+
+    ret['Name'] = 'WordPress Site Configure'
+    ret['Path'] = site_path
+
+    ret['Result'] = results
+
+    return ret
+
+
+def _use_db_backend(function):
+    # The database backend is opt-in, and only available when a MySQL driver is installed
+    return __salt__['config.get']('wordpress:check_backend', 'cli') == 'db' and function in __salt__
+
+
 def check_site_installed(site_path, user):
     # TODO Determine what validations to perform on our parameters
 
-    command = 'wp core is-installed --path="{0}"'.format(site_path)
-
     # TODO Determine how to handle exceptions in command processing
     # That is, we currently treat this as returning a boolean value,
     # but other values may be coerced and cause undesired behavior.
-    try:
-        cmd_result = _run_command(command, site_path, user)
-    except Exception as e:
-        return e
+    return check_sites_installed([site_path], user)[site_path]
 
-    # WP-CLI exits with status 0 if installed, otherwise status 1
-    return cmd_result['retcode'] == 0
+
+def check_sites_installed(site_paths, user, concurrency=None):
+    """
+    Check whether several sites are installed, running their ``wp core is-installed`` calls concurrently
+
+    :param site_paths: A list of site paths
+    :param user: The user to run WP-CLI as
+    :param concurrency: The maximum number of WP-CLI processes at once
+                        (default: the 'wordpress:command_concurrency' option, or 8)
+    :return: A dict mapping each site path to a boolean, or to the exception raised while checking it
+    """
+    ret = {}
+    pending = []
+    fingerprints = {}
+
+    for site_path in site_paths:
+        # Once installed, a site whose fingerprint has not changed is still installed
+        fingerprints[site_path], snapshot = _load_snapshot(site_path)
+        if snapshot and snapshot.get('installed'):
+            ret[site_path] = True
+            continue
+
+        if _use_db_backend('wordpress.db_site_installed'):
+            try:
+                ret[site_path] = __salt__['wordpress.db_site_installed'](site_path=site_path)
+                continue
+            except Exception as e:
+                log.debug('Database check failed for site at path \'%s\', using WP-CLI: %s', site_path, e)
+        pending.append(site_path)
+
+    commands = [('wp core is-installed --path="{0}"'.format(site_path), site_path, user) for site_path in pending]
+    results = _run_commands(commands, concurrency=concurrency) if commands else []
+
+    for site_path, cmd_result in zip(pending, results):
+        # WP-CLI exits with status 0 if installed, otherwise status 1
+        ret[site_path] = cmd_result if isinstance(cmd_result, Exception) else cmd_result['retcode'] == 0
+
+        if ret[site_path] is True:
+            _save_snapshot(site_path, fingerprints[site_path], installed=True)
+
+    return ret
 
 
 def install_site(site_url,
@@ -175,11 +1118,85 @@ def install_site(site_url,
         cmd_result = _run_command(command, site_path, user)
     except Exception as e:
         return e
+    finally:
+        _invalidate_inventory(site_path)
 
     ret['Name'] = 'Wordpress Site Install'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
+
+    return ret
+
+
+def get_core_updates(site_path, user):
+    """
+    Return the core updates available for a site, newest first, as reported by ``wp core check-update``
+
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return: A list of dicts with the keys 'version', 'update_type' and 'package_url'; empty if up to date
+    """
+    command = 'wp core check-update --format=json --path="{0}"'.format(site_path)
+
+    cmd_result = _run_command(command, site_path, user)
+
+    if cmd_result['retcode'] != 0:
+        raise CommandExecutionError('Unable to check for core updates for site at path \'{0}\': {1}'
+                                    .format(site_path, cmd_result['stderr']))
+
+    # WP-CLI prints a success message instead of JSON when there is nothing to update
+    try:
+        return json.loads(cmd_result['stdout'] or '[]')
+    except ValueError:
+        return []
+
+
+def update_core(site_path, user, version=None):
+    """
+    Update WordPress core, then the database schema
+
+    Sites linked to a shared core tree (see ``link_core``) are switched to the new version instead,
+    as updating them in place would write through the hard links into the shared tree.
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :param version: The version to update to; defaults to the latest
+    :return:
+    """
+    ret = {}
+    results = {}
+
+    shared = None
+    if 'wordpress.shared_core_version' in __salt__:
+        shared = __salt__['wordpress.shared_core_version'](site_path=site_path)
+
+    try:
+        if shared is not None:
+            if version is None:
+                updates = get_core_updates(site_path, user)
+                if not updates:
+                    raise CommandExecutionError('Site at path \'{0}\' is already up to date'.format(site_path))
+                version = updates[0]['version']
+            results['update'] = __salt__['wordpress.switch_core'](site_path=site_path, user=user, version=version)
+        else:
+            command = 'wp core update --path="{0}"'.format(site_path)
+            if version:
+                command += ' --version="{0}"'.format(version)
+            results['update'] = _command_result(_subcommand(command), site_path,
+                                                _run_command(command, site_path, user, stream=True))
+
+        command = 'wp core update-db --path="{0}"'.format(site_path)
+        results['update_db'] = _command_result(_subcommand(command), site_path,
+                                               _run_command(command, site_path, user))
+    except Exception as e:
+        return e
+    finally:
+        _invalidate_inventory(site_path)
+
+    ret['Name'] = 'WordPress Core Update'
+    ret['Path'] = site_path
+
+    ret['Result'] = results
 
     return ret
 
@@ -187,46 +1204,54 @@ def install_site(site_url,
 def check_plugin_installed(plugin_name, site_path, user):
     # TODO Validate the input parameters
 
-    command = 'wp plugin is-installed "{0}" --path="{1}"' \
-        .format(plugin_name, site_path)
+    # The file system answers this without starting PHP; WP-CLI is only needed
+    # when ``wp-content`` is not where we expect it
+    if 'wordpress.plugin_index' in __salt__:
+        index = __salt__['wordpress.plugin_index'](site_path)
+        if index is not None:
+            return plugin_name in index
 
     # TODO Determine how to handle exceptions in command processing
     # That is, we currently treat this as returning a boolean value,
     # but other values may be coerced and cause undesired behavior.
     try:
-        cmd_result = _run_command(command, site_path, user)
+        inventory = get_inventory(site_path, user)
     except Exception as e:
         return e
 
-    # WP-CLI exits with status 0 if installed, otherwise status 1
-    return cmd_result['retcode'] == 0
+    return plugin_name in inventory['plugins']
 
 
-def install_plugin(plugin_name, site_path, user):
+def install_plugin(plugin_name, site_path, user, version=None, force=False):
     # Note that WP-CLI appears to just perform file system manipulation,
     # so a symlink should be used instead for a development environment.
     # That said, plugins may need to be deactivated and reactivated to
     # work correctly when changed.  For now, this is up to the plugin
     # developer to handle correctly in their environment.
     # TODO Validate the input parameters
+    # With ``force``, an installed plugin is overwritten, which is how a different version is installed
 
-    if check_plugin_installed(plugin_name, site_path, user):
+    if not force and check_plugin_installed(plugin_name, site_path, user):
         raise CommandExecutionError('Plugin \'{0}\' is already installed for site at path \'{1}\''
                                     .format(plugin_name, site_path))
 
     ret = {}
-    command = 'wp plugin install "{0}" --path="{1}"' \
-        .format(plugin_name, site_path)
+    command = 'wp plugin install {0} --path="{1}"' \
+        .format(_install_source('plugin', plugin_name, version), site_path)
+    if force:
+        command += ' --force'
 
     try:
-        cmd_result = _run_command(command, site_path, user)
+        cmd_result = _run_command(command, site_path, user, stream=True)
     except Exception as e:
         return e
+    finally:
+        _invalidate_inventory(site_path)
 
     ret['Name'] = 'WordPress Plugin Install'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
 
     return ret
 
@@ -234,20 +1259,23 @@ def install_plugin(plugin_name, site_path, user):
 def check_plugin_enabled(plugin_name, site_path, user):
     # TODO Validate the input parameters
 
-    command = 'wp plugin status "{0}" --path="{1}"' \
-        .format(plugin_name, site_path)
+    if _use_db_backend('wordpress.db_active_plugins'):
+        try:
+            return plugin_name in __salt__['wordpress.db_active_plugins'](site_path=site_path)
+        except Exception as e:
+            log.debug('Database check failed for site at path \'%s\', using WP-CLI: %s', site_path, e)
 
     # TODO Determine how to handle exceptions in command processing
     # That is, we currently treat this as returning a boolean value,
     # but other values may be coerced and cause undesired behavior.
     try:
-        cmd_result = _run_command(command, site_path, user)
+        inventory = get_inventory(site_path, user)
     except Exception as e:
         return e
 
-    parsed = _parse_status(cmd_result['stdout'])
+    plugin = inventory['plugins'].get(plugin_name, {})
 
-    return 'Status' in parsed and parsed['Status'] == 'Active'
+    return plugin.get('status') in ('active', 'active-network')
 
 
 def enable_plugin(plugin_name, site_path, user):
@@ -265,11 +1293,13 @@ def enable_plugin(plugin_name, site_path, user):
         cmd_result = _run_command(command, site_path, user)
     except Exception as e:
         return e
+    finally:
+        _invalidate_inventory(site_path)
 
     ret['Name'] = 'WordPress Plugin Enable'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
 
     return ret
 
@@ -277,7 +1307,7 @@ def enable_plugin(plugin_name, site_path, user):
 def disable_plugin(plugin_name, site_path, user):
     # TODO Validate the input parameters
 
-    if check_plugin_enabled(plugin_name, site_path, user):
+    if not check_plugin_enabled(plugin_name, site_path, user):
         raise CommandExecutionError('Plugin \'{0}\' is already disabled for site at path \'{1}\''
                                     .format(plugin_name, site_path))
 
@@ -289,11 +1319,159 @@ def disable_plugin(plugin_name, site_path, user):
         cmd_result = _run_command(command, site_path, user)
     except Exception as e:
         return e
+    finally:
+        _invalidate_inventory(site_path)
 
     ret['Name'] = 'WordPress Plugin Disable'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
+
+    return ret
+
+
+def get_plugin_updates(site_path, user):
+    """
+    Return the plugins of a site that have an update available, with a single ``wp plugin list`` call
+
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return: A dict mapping plugin names to their current 'version' and available 'update_version'
+    """
+    command = 'wp plugin list --update=available --fields=name,version,update_version --format=json --path="{0}"' \
+        .format(site_path)
+
+    plugins = _parse_items('plugin', site_path, _run_command(command, site_path, user))
+
+    return dict((name, {'version': plugin.get('version'), 'update_version': plugin.get('update_version')})
+                for name, plugin in plugins.items())
+
+
+def update_plugins(site_path, user, plugin_names=None):
+    """
+    Update several plugins with a single ``wp plugin update`` call
+
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :param plugin_names: The plugins to update; defaults to every plugin with an update available
+    :return:
+    """
+    if plugin_names is None:
+        plugin_names = sorted(get_plugin_updates(site_path, user))
+
+    if not plugin_names:
+        raise CommandExecutionError('No plugin updates are available for site at path \'{0}\''.format(site_path))
+
+    ret = {}
+
+    try:
+        cmd_result = _run_plugin_batch('update', plugin_names, site_path, user)
+    except Exception as e:
+        return e
+
+    ret['Name'] = 'WordPress Plugin Update'
+    ret['Path'] = site_path
+
+    ret['Result'] = _command_result('plugin update', site_path, cmd_result)
+
+    return ret
+
+
+def _run_plugin_batch(action, plugin_names, site_path, user):
+    # Runs a single WP-CLI plugin command against several plugins at once
+    # TODO Validate the input parameters
+
+    if not plugin_names:
+        raise SaltInvocationError('At least one plugin name must be given')
+
+    if action == 'install':
+        names = ' '.join(_install_source('plugin', name, None) for name in plugin_names)
+    else:
+        names = _quote_names(plugin_names)
+
+    command = 'wp plugin {0} {1} --path="{2}"' \
+        .format(action, names, site_path)
+
+    try:
+        return _run_command(command, site_path, user, stream=action in ('install', 'update'))
+    finally:
+        _invalidate_inventory(site_path)
+
+
+def install_plugins(plugin_names, site_path, user):
+    """
+    Install several plugins with a single ``wp plugin install`` call
+
+    Unlike ``install_plugin``, plugins that are already installed are not an error;
+    WP-CLI skips them and reports a warning.
+    :param plugin_names: A list of plugin names
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = {}
+
+    try:
+        cmd_result = _run_plugin_batch('install', plugin_names, site_path, user)
+    except SaltInvocationError:
+        raise
+    except Exception as e:
+        return e
+
+    ret['Name'] = 'WordPress Plugin Install'
+    ret['Path'] = site_path
+
+    ret['Result'] = _command_result('plugin install', site_path, cmd_result)
+
+    return ret
+
+
+def enable_plugins(plugin_names, site_path, user):
+    """
+    Activate several plugins with a single ``wp plugin activate`` call
+    :param plugin_names: A list of plugin names
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = {}
+
+    try:
+        cmd_result = _run_plugin_batch('activate', plugin_names, site_path, user)
+    except SaltInvocationError:
+        raise
+    except Exception as e:
+        return e
+
+    ret['Name'] = 'WordPress Plugin Enable'
+    ret['Path'] = site_path
+
+    ret['Result'] = _command_result('plugin activate', site_path, cmd_result)
+
+    return ret
+
+
+def disable_plugins(plugin_names, site_path, user):
+    """
+    Deactivate several plugins with a single ``wp plugin deactivate`` call
+    :param plugin_names: A list of plugin names
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = {}
+
+    try:
+        cmd_result = _run_plugin_batch('deactivate', plugin_names, site_path, user)
+    except SaltInvocationError:
+        raise
+    except Exception as e:
+        return e
+
+    ret['Name'] = 'WordPress Plugin Disable'
+    ret['Path'] = site_path
+
+    ret['Result'] = _command_result('plugin deactivate', site_path, cmd_result)
 
     return ret
 
@@ -301,46 +1479,54 @@ def disable_plugin(plugin_name, site_path, user):
 def check_theme_installed(theme_name, site_path, user):
     # TODO Validate the input parameters
 
-    command = 'wp theme is-installed "{0}" --path="{1}"' \
-        .format(theme_name, site_path)
+    # The file system answers this without starting PHP; WP-CLI is only needed
+    # when ``wp-content`` is not where we expect it
+    if 'wordpress.theme_index' in __salt__:
+        index = __salt__['wordpress.theme_index'](site_path)
+        if index is not None:
+            return theme_name in index
 
     # TODO Determine how to handle exceptions in command processing
     # That is, we currently treat this as returning a boolean value,
     # but other values may be coerced and cause undesired behavior.
     try:
-        cmd_result = _run_command(command, site_path, user)
+        inventory = get_inventory(site_path, user)
     except Exception as e:
         return e
 
-    # WP-CLI exits with status 0 if installed, otherwise status 1
-    return cmd_result['retcode'] == 0
+    return theme_name in inventory['themes']
 
 
-def install_theme(theme_name, site_path, user):
+def install_theme(theme_name, site_path, user, version=None, force=False):
     # Note that WP-CLI appears to just perform file system manipulation,
     # so a symlink should be used instead for a development environment.
     # That said, themes may need to be deactivated and reactivated to
     # work correctly when changed.  For now, this is up to the theme
     # developer to handle correctly in their environment.
     # TODO Validate the input parameters
+    # With ``force``, an installed theme is overwritten, which is how a different version is installed
 
-    if check_theme_installed(theme_name, site_path, user):
+    if not force and check_theme_installed(theme_name, site_path, user):
         raise CommandExecutionError('Theme \'{0}\' is already installed for site at path \'{1}\''
                                     .format(theme_name, site_path))
 
     ret = {}
-    command = 'wp theme install "{0}" --path="{1}"' \
-        .format(theme_name, site_path)
+    command = 'wp theme install {0} --path="{1}"' \
+        .format(_install_source('theme', theme_name, version), site_path)
+    if force:
+        command += ' --force'
 
     try:
-        cmd_result = _run_command(command, site_path, user)
+        cmd_result = _run_command(command, site_path, user, stream=True)
     except Exception as e:
         return e
+    finally:
+        _invalidate_inventory(site_path)
 
     ret['Name'] = 'WordPress Theme Install'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
 
     return ret
 
@@ -348,20 +1534,17 @@ def install_theme(theme_name, site_path, user):
 def check_theme_enabled(theme_name, site_path, user):
     # TODO Validate the input parameters
 
-    command = 'wp theme status "{0}" --path="{1}"' \
-        .format(theme_name, site_path)
-
     # TODO Determine how to handle exceptions in command processing
     # That is, we currently treat this as returning a boolean value,
     # but other values may be coerced and cause undesired behavior.
     try:
-        cmd_result = _run_command(command, site_path, user)
+        inventory = get_inventory(site_path, user)
     except Exception as e:
         return e
 
-    parsed = _parse_status(cmd_result['stdout'])
+    theme = inventory['themes'].get(theme_name, {})
 
-    return 'Status' in parsed and parsed['Status'] == 'Active'
+    return theme.get('status') == 'active'
 
 
 def enable_theme(theme_name, site_path, user):
@@ -379,10 +1562,288 @@ def enable_theme(theme_name, site_path, user):
         cmd_result = _run_command(command, site_path, user)
     except Exception as e:
         return e
+    finally:
+        _invalidate_inventory(site_path)
+
+    ret['Name'] = 'WordPress Theme Enable'
+    ret['Path'] = site_path
+
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
+
+    return ret
+
+
+def get_blogs(site_path, user, refresh=False):
+    """
+    Return the blogs of a multisite network, as reported by a single ``wp site list`` call
+
+    The list is kept in ``__context__`` for the rest of the run.
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :param refresh: Query WP-CLI again even if a list is available
+    :return: A list of dicts with the keys 'blog_id', 'url', 'archived', 'deleted' and 'spam'
+    """
+    blogs = __context__.setdefault('wordpress.blogs', {})
+
+    if refresh or site_path not in blogs:
+        command = 'wp site list --fields=blog_id,url,archived,deleted,spam --format=json --path="{0}"' \
+            .format(site_path)
+
+        cmd_result = _run_command(command, site_path, user)
+
+        if cmd_result['retcode'] != 0:
+            raise CommandExecutionError('Unable to list the blogs of network at path \'{0}\': {1}'
+                                        .format(site_path, cmd_result['stderr']))
+
+        try:
+            blogs[site_path] = json.loads(cmd_result['stdout'])
+        except ValueError:
+            raise CommandExecutionError('Unable to parse the blog list of network at path \'{0}\''
+                                        .format(site_path))
+
+    return blogs[site_path]
+
+
+def _blog_urls(site_path, user, blogs):
+    # Resolves blog URLs or IDs to URLs; by default, every blog that is not archived, deleted or spam
+    available = get_blogs(site_path, user)
+
+    if blogs is None:
+        return [blog['url'] for blog in available
+                if not any(str(blog.get(flag, 0)) == '1' for flag in ('archived', 'deleted', 'spam'))]
+
+    urls_by_id = dict((str(blog['blog_id']), blog['url']) for blog in available)
+    known_urls = set(urls_by_id.values())
+
+    urls = []
+    for blog in blogs:
+        url = urls_by_id.get(str(blog), blog)
+        if url not in known_urls:
+            raise SaltInvocationError('Unknown blog \'{0}\' in network at path \'{1}\''.format(blog, site_path))
+        urls.append(url)
+
+    return urls
+
+
+def _blog_list_command(item_type, url, site_path, user):
+    return ('wp {0} list --fields=name,status --format=json --url="{1}" --path="{2}"'.format(item_type, url, site_path),
+            site_path, user)
+
+
+def get_network_inventory(site_path, user, blogs=None, refresh=False, concurrency=None):
+    """
+    Return the plugin and theme statuses of every blog of a multisite network
+
+    Network activation is read from one ``wp plugin list``; each blog's own statuses are then
+    listed with ``--url``, with up to ``concurrency`` WP-CLI processes at once.
+    The result is kept in ``__context__`` until a function in this module changes the network.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.get_network_inventory /var/www/network www-data concurrency=16
+
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param refresh: Query WP-CLI again even if a snapshot is available
+    :param concurrency: The maximum number of WP-CLI processes at once
+                        (default: the 'wordpress:command_concurrency' option, or 8)
+    :return: A dict with 'network', mapping plugin names to their network-wide status,
+             and 'blogs', mapping each blog URL to its 'plugins' and 'themes' statuses
+    """
+    urls = _blog_urls(site_path, user, blogs)
+    inventory = __context__.setdefault('wordpress.network_inventory', {}).setdefault(site_path, {})
+
+    if refresh or 'network' not in inventory:
+        inventory['network'] = dict((name, plugin['status']) for name, plugin
+                                    in get_inventory(site_path, user, refresh=refresh)['plugins'].items())
+
+    cached = inventory.setdefault('blogs', {})
+    stale = [url for url in urls if refresh or url not in cached]
+    commands = [_blog_list_command(item_type, url, site_path, user) for url in stale for item_type in ('plugin', 'theme')]
+    results = iter(_run_commands(commands, concurrency=concurrency)) if commands else iter([])
+
+    for url in stale:
+        plugins, themes = next(results), next(results)
+        cached[url] = {
+            'plugins': dict((name, item['status']) for name, item in _parse_items('plugin', url, plugins).items()),
+            'themes': dict((name, item['status']) for name, item in _parse_items('theme', url, themes).items()),
+        }
+
+    return {
+        'network': inventory['network'],
+        'blogs': dict((url, cached[url]) for url in urls),
+    }
+
+
+def _run_blog_action(item_type, action, item_name, site_path, user, urls, concurrency):
+    # Runs the same command once per blog, in parallel, and aggregates the results
+    commands = [('wp {0} {1} "{2}" --url="{3}" --path="{4}"'.format(item_type, action, item_name, url, site_path),
+                 site_path, user) for url in urls]
+
+    try:
+        results = _run_commands(commands, concurrency=concurrency)
+    finally:
+        _invalidate_inventory(site_path)
+
+    ret = {'blogs': {}, 'succeeded': 0, 'failed': []}
+
+    for url, cmd_result in zip(urls, results):
+        if isinstance(cmd_result, Exception):
+            ret['blogs'][url] = {'retcode': None, 'stderr': str(cmd_result)}
+        else:
+            ret['blogs'][url] = _command_result('{0} {1}'.format(item_type, action), site_path, cmd_result)
+
+        if ret['blogs'][url]['retcode'] == 0:
+            ret['succeeded'] += 1
+        else:
+            ret['failed'].append(url)
+
+    return ret
+
+
+def check_plugin_network_enabled(plugin_name, site_path, user):
+    # TODO Validate the input parameters
+
+    try:
+        inventory = get_inventory(site_path, user)
+    except Exception as e:
+        return e
+
+    plugin = inventory['plugins'].get(plugin_name, {})
+
+    return plugin.get('status') == 'active-network'
+
+
+def enable_plugin_network(plugin_name, site_path, user):
+    """
+    Network-activate a plugin on a multisite network
+    :param plugin_name: The plugin name
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    if check_plugin_network_enabled(plugin_name, site_path, user):
+        raise CommandExecutionError('Plugin \'{0}\' is already network-enabled for network at path \'{1}\''
+                                    .format(plugin_name, site_path))
+
+    ret = {}
+    command = 'wp plugin activate "{0}" --network --path="{1}"' \
+        .format(plugin_name, site_path)
+
+    try:
+        cmd_result = _run_command(command, site_path, user)
+    except Exception as e:
+        return e
+    finally:
+        _invalidate_inventory(site_path)
+
+    ret['Name'] = 'WordPress Plugin Network Enable'
+    ret['Path'] = site_path
+
+    ret['Result'] = _command_result(_subcommand(command), site_path, cmd_result)
+
+    return ret
+
+
+def enable_plugin_blogs(plugin_name, site_path, user, blogs=None, concurrency=None):
+    """
+    Activate a plugin on several blogs of a multisite network, one ``--url`` call per blog run in parallel
+
+    Blogs where the plugin is already active are skipped.
+    :param plugin_name: The plugin name
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param concurrency: The maximum number of WP-CLI processes at once
+    :return: The per-blog results, with success/failure counts
+    """
+    inventory = get_network_inventory(site_path, user, blogs=blogs, concurrency=concurrency)
+
+    urls = [url for url, blog in sorted(inventory['blogs'].items())
+            if blog['plugins'].get(plugin_name) not in ('active', 'active-network')]
+
+    ret = {}
+
+    try:
+        results = _run_blog_action('plugin', 'activate', plugin_name, site_path, user, urls, concurrency)
+    except Exception as e:
+        return e
+
+    ret['Name'] = 'WordPress Plugin Enable'
+    ret['Path'] = site_path
+
+    ret['Result'] = results
+
+    return ret
+
+
+def disable_plugin_blogs(plugin_name, site_path, user, blogs=None, concurrency=None):
+    """
+    Deactivate a plugin on several blogs of a multisite network, one ``--url`` call per blog run in parallel
+
+    Blogs where the plugin is not active are skipped; a network-activated plugin is left alone.
+    :param plugin_name: The plugin name
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param concurrency: The maximum number of WP-CLI processes at once
+    :return: The per-blog results, with success/failure counts
+    """
+    inventory = get_network_inventory(site_path, user, blogs=blogs, concurrency=concurrency)
+
+    urls = [url for url, blog in sorted(inventory['blogs'].items()) if blog['plugins'].get(plugin_name) == 'active']
+
+    ret = {}
+
+    try:
+        results = _run_blog_action('plugin', 'deactivate', plugin_name, site_path, user, urls, concurrency)
+    except Exception as e:
+        return e
+
+    ret['Name'] = 'WordPress Plugin Disable'
+    ret['Path'] = site_path
+
+    ret['Result'] = results
+
+    return ret
+
+
+def enable_theme_blogs(theme_name, site_path, user, blogs=None, concurrency=None):
+    """
+    Activate a theme on several blogs of a multisite network, one ``--url`` call per blog run in parallel
+
+    The theme is network-enabled first, as WordPress refuses to activate a theme that is not allowed
+    on the network.  Blogs already using the theme are skipped.
+    :param theme_name: The theme name
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param concurrency: The maximum number of WP-CLI processes at once
+    :return: The per-blog results, with success/failure counts
+    """
+    inventory = get_network_inventory(site_path, user, blogs=blogs, concurrency=concurrency)
+
+    urls = [url for url, blog in sorted(inventory['blogs'].items()) if blog['themes'].get(theme_name) != 'active']
+
+    ret = {}
+
+    try:
+        if urls:
+            command = 'wp theme enable "{0}" --network --path="{1}"'.format(theme_name, site_path)
+            cmd_result = _run_command(command, site_path, user)
+            if cmd_result['retcode'] != 0:
+                raise CommandExecutionError('Unable to network-enable theme \'{0}\': {1}'
+                                            .format(theme_name, cmd_result['stderr']))
+        results = _run_blog_action('theme', 'activate', theme_name, site_path, user, urls, concurrency)
+    except Exception as e:
+        return e
 
     ret['Name'] = 'WordPress Theme Enable'
     ret['Path'] = site_path
 
-    ret['Result'] = cmd_result
+    ret['Result'] = results
 
     return ret
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# Reads ``wp-config.php`` in pure Python, so that configuration values can be compared
+# without starting PHP (``wp config get`` would bootstrap WP-CLI once per key).
+# Only literal ``define()`` calls and the ``$table_prefix`` assignment are understood;
+# constants whose value is computed at runtime (``getenv()``, concatenation, ...) are skipped.
+
+import os
+import re
+
+
+__virtualname__ = 'wordpress'
+
+# The keys accepted by ``config_site``, mapped to what they set in wp-config.php
+_CONFIG_KEYS = {
+    'dbname': 'DB_NAME',
+    'dbuser': 'DB_USER',
+    'dbpass': 'DB_PASSWORD',
+    'dbhost': 'DB_HOST',
+    'dbcharset': 'DB_CHARSET',
+    'dbcollate': 'DB_COLLATE',
+    'dbprefix': '$table_prefix',
+}
+
+# Never shown in diffs, which end up in job returns and logs
+_SECRET_KEYS = ('dbpass',)
+
+_STRING = r'\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*"'
+
+_DEFINE_PATTERN = re.compile(
+    r'\bdefine\s*\(\s*(' + _STRING + r')\s*,\s*(' + _STRING + r'|[^,)]+?)\s*(?:,\s*[^)]*)?\)\s*;',
+    re.IGNORECASE)
+
+_PREFIX_PATTERN = re.compile(r'\$table_prefix\s*=\s*(' + _STRING + r')\s*;')
+
+_TOKEN_PATTERN = re.compile(_STRING + r'|//[^\n]*|#[^\n]*|/\*.*?\*/', re.DOTALL)
+
+
+def __virtual__():
+    """
+    The parser is pure Python, so it is always available
+    :return:
+    """
+    return __virtualname__
+
+
+def _strip_comments(source):
+    # Comments are dropped, but comment markers inside strings (such as URLs) are kept
+    return _TOKEN_PATTERN.sub(lambda match: match.group(0) if match.group(0)[0] in '\'"' else ' ', source)
+
+
+def _php_value(token):
+    token = token.strip()
+
+    if token[:1] in ('\'', '"') and token[-1:] == token[:1]:
+        body = token[1:-1]
+        if token[0] == '\'':
+            return body.replace('\\\'', '\'').replace('\\\\', '\\')
+        return re.sub(r'\\(.)', r'\1', body)
+
+    lowered = token.lower()
+    if lowered in ('true', 'false'):
+        return lowered == 'true'
+    if lowered == 'null':
+        return None
+
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+
+def _parse(source):
+    source = _strip_comments(source)
+
+    constants = {}
+    for name, value in _DEFINE_PATTERN.findall(source):
+        constants[_php_value(name)] = _php_value(value)
+
+    prefix = _PREFIX_PATTERN.search(source)
+
+    return {
+        'constants': constants,
+        'table_prefix': _php_value(prefix.group(1)) if prefix else None,
+    }
+
+
+def read_config(site_path):
+    """
+    Parse the ``define()`` constants and ``$table_prefix`` of a site's ``wp-config.php``
+
+    The result is cached in ``__context__`` until the file's mtime or size changes.
+    :param site_path: The path of the site
+    :return: A dict with the keys 'constants' and 'table_prefix', or None if there is no wp-config.php
+    """
+    config_path = os.path.join(site_path, 'wp-config.php')
+
+    try:
+        stat = os.stat(config_path)
+    except OSError:
+        return None
+
+    cache = __context__.setdefault('wordpress.config', {})
+    signature = (stat.st_mtime, stat.st_size)
+
+    if config_path not in cache or cache[config_path][0] != signature:
+        with open(config_path) as config_file:
+            cache[config_path] = (signature, _parse(config_file.read()))
+
+    return cache[config_path][1]
+
+
+def config_diff(site_path, config):
+    """
+    Compare the desired ``config`` with the values in a site's ``wp-config.php``
+
+    :param site_path: The path of the site
+    :param config: The dict passed to ``config_site``; 'dbname', 'dbuser', 'dbpass', 'dbhost',
+                   'dbcharset', 'dbcollate' and 'dbprefix' are compared, other keys are ignored
+    :return: A dict of the differing keys, each with 'old' and 'new' values (passwords are masked),
+             or None if there is no wp-config.php
+    """
+    current = read_config(site_path)
+    if current is None:
+        return None
+
+    diff = {}
+    for key, target in _CONFIG_KEYS.items():
+        if key not in config:
+            continue
+
+        if target == '$table_prefix':
+            old = current['table_prefix']
+        else:
+            old = current['constants'].get(target)
+
+        if old != config[key]:
+            if key in _SECRET_KEYS:
+                diff[key] = {'old': '********', 'new': '********'}
+            else:
+                diff[key] = {'old': old, 'new': config[key]}
+
+    return diff
+
+
+def config_target(key):
+    """
+    Return the wp-config.php constant (or '$table_prefix') set by a ``config_site`` key
+    :param key:
+    :return:
+    """
+    return _CONFIG_KEYS.get(key)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Optional backend that answers install/activation checks straight from the site's database,
+# instead of bootstrapping WordPress through WP-CLI just to read one row of the options table.
+#
+# Enabled with the minion config or pillar option ``wordpress:check_backend: db``.
+# Credentials are read from wp-config.php (see ``read_config``), and connections are pooled
+# per database server and account, so sites sharing a server also share connections.
+# Any failure makes the callers fall back to WP-CLI.
+
+import logging
+import re
+import threading
+
+from salt.exceptions import CommandExecutionError
+
+# Same driver lookup as Salt's own mysql module
+try:
+    import MySQLdb
+    HAS_MYSQLDB = True
+except ImportError:
+    try:
+        import pymysql
+        pymysql.install_as_MySQLdb()
+        import MySQLdb
+        HAS_MYSQLDB = True
+    except ImportError:
+        HAS_MYSQLDB = False
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+# The fleet functions run checks from several threads
+_POOL_LOCK = threading.Lock()
+
+# WordPress itself only allows these characters in the table prefix
+_PREFIX_PATTERN = re.compile(r'^[A-Za-z0-9_]+$')
+
+
+def __virtual__():
+    """
+    Only load the module if a MySQL driver (MySQLdb or PyMySQL) is installed
+    :return:
+    """
+    if HAS_MYSQLDB:
+        return __virtualname__
+    return False, 'The wordpress database module cannot be loaded: MySQLdb or PyMySQL is not installed'
+
+
+def _connection_params(db_host):
+    # DB_HOST may be 'host', 'host:port', 'host:/path/to/socket' or '[ipv6]:port'
+    params = {}
+    match = re.match(r'^(\[[^\]]+\]|[^:]*)(?::(.*))?$', db_host or 'localhost')
+    host, extra = match.group(1).strip('[]') or 'localhost', match.group(2)
+
+    params['host'] = host
+    if extra:
+        if extra.isdigit():
+            params['port'] = int(extra)
+        else:
+            params['unix_socket'] = extra
+
+    return params
+
+
+def _site_credentials(site_path):
+    config = __salt__['wordpress.read_config'](site_path=site_path)
+    if config is None:
+        raise CommandExecutionError('No wp-config.php for site at path \'{0}\''.format(site_path))
+
+    constants = config['constants']
+    if constants.get('MULTISITE'):
+        # Network activation lives in the sitemeta table; leave that to WP-CLI
+        raise CommandExecutionError('Multisite installs are not supported by the database backend')
+
+    missing = [name for name in ('DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST') if constants.get(name) is None]
+    prefix = config['table_prefix']
+    if missing or not prefix or not _PREFIX_PATTERN.match(prefix):
+        raise CommandExecutionError('Unable to read the database settings of site at path \'{0}\''
+                                    .format(site_path))
+
+    params = _connection_params(constants['DB_HOST'])
+    params['user'] = constants['DB_USER']
+    params['passwd'] = constants['DB_PASSWORD']
+
+    return params, constants['DB_NAME'], prefix
+
+
+def _pool_key(params):
+    return tuple(sorted(params.items()))
+
+
+def _acquire(params):
+    with _POOL_LOCK:
+        pool = __context__.setdefault('wordpress.db_pool', {}).setdefault(_pool_key(params), [])
+        connection = pool.pop() if pool else None
+
+    if connection is not None:
+        try:
+            connection.ping()
+            return connection
+        except MySQLdb.Error:
+            log.debug('Dropping a stale WordPress database connection')
+
+    kwargs = dict(params)
+    kwargs['connect_timeout'] = __salt__['config.get']('wordpress:db_connect_timeout', 5)
+    kwargs['charset'] = 'utf8mb4'
+
+    return MySQLdb.connect(**kwargs)
+
+
+def _release(params, connection):
+    max_idle = __salt__['config.get']('wordpress:db_pool_size', 4)
+
+    with _POOL_LOCK:
+        pool = __context__.setdefault('wordpress.db_pool', {}).setdefault(_pool_key(params), [])
+        if len(pool) < max_idle:
+            pool.append(connection)
+            return
+
+    connection.close()
+
+
+def _get_option(site_path, option_name):
+    params, db_name, prefix = _site_credentials(site_path)
+    connection = _acquire(params)
+
+    # The database is named in the query, so one pooled connection can serve every site on the server
+    query = 'SELECT option_value FROM `{0}`.`{1}options` WHERE option_name = %s LIMIT 1' \
+        .format(db_name.replace('`', '``'), prefix)
+
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query, (option_name,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+    except MySQLdb.ProgrammingError:
+        # Missing tables and the like; the connection itself is still usable
+        _release(params, connection)
+        raise
+    except MySQLdb.Error as e:
+        connection.close()
+        raise CommandExecutionError('Unable to query the database of site at path \'{0}\': {1}'
+                                    .format(site_path, e))
+
+    _release(params, connection)
+
+    if row is None:
+        return None
+
+    value = row[0]
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _php_unserialize(data):
+    """
+    Decode the PHP ``serialize()`` format used for array options such as 'active_plugins'
+
+    Only scalars and arrays are supported; arrays are returned as dicts.
+    String lengths are in bytes, so the data is decoded as UTF-8 bytes.
+    """
+    raw = data.encode('utf-8')
+
+    def _read(position):
+        kind = raw[position:position + 1]
+
+        if kind == b'N':
+            return None, position + 2
+        if kind in (b'b', b'i', b'd'):
+            end = raw.index(b';', position)
+            token = raw[position + 2:end].decode('ascii')
+            value = token == '1' if kind == b'b' else int(token) if kind == b'i' else float(token)
+            return value, end + 1
+        if kind == b's':
+            colon = raw.index(b':', position + 2)
+            length = int(raw[position + 2:colon])
+            start = colon + 2
+            return raw[start:start + length].decode('utf-8', 'replace'), start + length + 2
+        if kind == b'a':
+            colon = raw.index(b':', position + 2)
+            count = int(raw[position + 2:colon])
+            position = colon + 2
+            items = {}
+            for _ in range(count):
+                key, position = _read(position)
+                value, position = _read(position)
+                items[key] = value
+            return items, position + 1
+
+        raise ValueError('Unsupported serialized PHP value at offset {0}'.format(position))
+
+    return _read(0)[0]
+
+
+def db_site_installed(site_path):
+    """
+    Check whether a site is installed by reading its options table, like ``is_blog_installed()``
+
+    :param site_path: The path of the site
+    :return:
+    """
+    try:
+        return _get_option(site_path, 'siteurl') is not None
+    except MySQLdb.ProgrammingError:
+        # The options table does not exist yet
+        return False
+
+
+def db_active_plugins(site_path):
+    """
+    Return the slugs of the plugins active on a site, read from the 'active_plugins' option
+
+    :param site_path: The path of the site
+    :return: A list of plugin names, as used by WP-CLI
+    """
+    value = _get_option(site_path, 'active_plugins')
+    if not value:
+        return []
+
+    try:
+        plugins = _php_unserialize(value)
+    except (ValueError, IndexError) as e:
+        raise CommandExecutionError('Unable to decode the active plugins of site at path \'{0}\': {1}'
+                                    .format(site_path, e))
+
+    # 'akismet/akismet.php' -> 'akismet', 'hello.php' -> 'hello'
+    return sorted(plugin_file.split('/')[0] if '/' in plugin_file else plugin_file[:-4]
+                  for plugin_file in plugins.values())
+
+
+def db_active_theme(site_path):
+    """
+    Return the name of the theme active on a site, read from the 'stylesheet' option
+
+    :param site_path: The path of the site
+    :return: The theme name, as used by WP-CLI, or None if the option is not set
+    """
+    return _get_option(site_path, 'stylesheet') or None
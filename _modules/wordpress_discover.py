@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# Finds WordPress installs under a web root, including ones that were not provisioned by Salt.
+# The walk is iterative and holds only one directory iterator per level, so memory stays bounded
+# by the tree depth rather than its size.
+
+import logging
+import os
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+
+from salt.exceptions import SaltInvocationError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+# Subtrees that never contain a separate install, or are too large to be worth walking
+_DEFAULT_PRUNE = ('wp-admin', 'wp-content', 'wp-includes', 'node_modules', 'vendor',
+                  '.git', '.svn', '.hg', 'cgi-bin')
+
+_VERSION_PATTERN = re.compile(r'^\$wp_version\s*=\s*[\'"]([^\'"]+)[\'"]', re.MULTILINE)
+
+
+def __virtual__():
+    """
+    Discovery is pure Python, so it is always available
+    :return:
+    """
+    return __virtualname__
+
+
+def core_version(site_path):
+    """
+    Read the WordPress version of a site from ``wp-includes/version.php``, without calling WP-CLI
+
+    :param site_path: The path of the site
+    :return: The version string, or None if it cannot be read
+    """
+    try:
+        with open(os.path.join(site_path, 'wp-includes', 'version.php')) as version_file:
+            match = _VERSION_PATTERN.search(version_file.read())
+    except (IOError, OSError):
+        return None
+
+    return match.group(1) if match else None
+
+
+def _owner(path):
+    try:
+        uid = os.stat(path).st_uid
+    except OSError:
+        return None
+
+    try:
+        import pwd
+        return pwd.getpwuid(uid).pw_name
+    except (ImportError, KeyError):
+        return uid
+
+
+def _configured(site_path):
+    # Same lookup as wp-load.php: the install directory, or one level above it
+    # as long as that directory is not itself a WordPress install
+    if os.path.isfile(os.path.join(site_path, 'wp-config.php')):
+        return True
+
+    parent = os.path.dirname(site_path)
+    return (os.path.isfile(os.path.join(parent, 'wp-config.php'))
+            and not os.path.isfile(os.path.join(parent, 'wp-settings.php')))
+
+
+def _describe(site_path):
+    return {
+        'path': site_path,
+        'downloaded': True,
+        'configured': _configured(site_path),
+        'version': core_version(site_path),
+        'owner': _owner(site_path),
+    }
+
+
+def _walk(root, prune, max_depth):
+    """
+    Yield a description of every install under ``root`` as soon as it is found
+
+    Symbolic links are not followed, and unreadable directories are skipped.
+    """
+    stack = [(root, 0)]
+
+    while stack:
+        dir_path, depth = stack.pop()
+        sub_dirs = []
+        is_install = False
+
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.name == 'wp-load.php' and entry.is_file(follow_symlinks=False):
+                        is_install = True
+                    elif (entry.is_dir(follow_symlinks=False) and entry.name not in prune
+                          and (max_depth is None or depth < max_depth)):
+                        sub_dirs.append(entry.path)
+        except OSError as e:
+            log.debug('Skipping \'%s\' during WordPress discovery: %s', dir_path, e)
+            continue
+
+        if is_install:
+            yield _describe(dir_path)
+
+        # Sorted in reverse so that the stack pops them in name order
+        stack.extend((sub_dir, depth + 1) for sub_dir in sorted(sub_dirs, reverse=True))
+
+
+def discover(root,
+             prune=None,
+             max_depth=None,
+             parallel=1,
+             fire_events=False):
+    """
+    Find every WordPress install under ``root``
+
+    Each install is reported with its path, whether it is downloaded and configured,
+    the core version read from ``wp-includes/version.php``, and the owner of the directory.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.discover /var/www parallel=8 fire_events=True
+
+    :param root: The directory to search
+    :param prune: Directory names that are never descended into; defaults to
+                  wp-admin, wp-content, wp-includes, node_modules, vendor and VCS directories
+    :param max_depth: How many levels below ``root`` to search; unlimited by default
+    :param parallel: Walk up to this many top-level directories of ``root`` at once
+    :param fire_events: Send a 'wordpress/discover/site' event for each install as soon as it is found,
+                        so that results stream back before the walk finishes
+    :return: The list of installs found, sorted by path
+    """
+    if not os.path.isdir(root):
+        raise SaltInvocationError('Not a directory: {0}'.format(root))
+
+    prune = frozenset(_DEFAULT_PRUNE if prune is None else prune)
+    max_depth = None if max_depth is None else int(max_depth)
+
+    def _collect(walker):
+        found = []
+        for site in walker:
+            if fire_events:
+                __salt__['event.send']('wordpress/discover/site', site)
+            found.append(site)
+        return found
+
+    parallel = int(parallel)
+    if parallel <= 1 or max_depth == 0:
+        return _collect(_walk(root, prune, max_depth))
+
+    # The root itself is checked here, and each top-level directory is walked by its own task
+    ret = []
+    top_dirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name == 'wp-load.php' and entry.is_file(follow_symlinks=False):
+                ret.extend(_collect([_describe(root)]))
+            elif entry.is_dir(follow_symlinks=False) and entry.name not in prune:
+                top_dirs.append(entry.path)
+
+    sub_depth = None if max_depth is None else max_depth - 1
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        for found in executor.map(lambda top_dir: _collect(_walk(top_dir, prune, sub_depth)), top_dirs):
+            ret.extend(found)
+
+    return sorted(ret, key=lambda site: site['path'])
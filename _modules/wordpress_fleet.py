@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+# Runs the per-site functions of this module against many sites at once.
+# The work is almost entirely spent waiting on WP-CLI subprocesses, so a thread pool is enough.
+
+import glob
+import logging
+import math
+
+from concurrent.futures import ThreadPoolExecutor
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+
+def __virtual__():
+    """
+    Only load the module if WP-CLI is installed
+    :return:
+    """
+    if 'wordpress.check_cli_installed' in __salt__ and __salt__['wordpress.check_cli_installed']():
+        return __virtualname__
+    return False, 'The wordpress fleet module cannot be loaded: WP-CLI is not installed'
+
+
+def _expand_sites(site_paths):
+    """
+    Expand a list of paths and/or glob patterns into the paths that have WordPress downloaded
+
+    Paths matched by a pattern are quietly left out when they are not WordPress sites,
+    but paths given explicitly are returned as missing, so that they can be reported.
+    :return: The sites, and the explicit paths that are not sites
+    """
+    if isinstance(site_paths, str):
+        site_paths = [site_paths]
+
+    sites = []
+    missing = []
+    for pattern in site_paths:
+        if not glob.has_magic(pattern):
+            if pattern in sites or pattern in missing:
+                continue
+            if __salt__['wordpress.check_wp_downloaded'](site_path=pattern):
+                sites.append(pattern)
+            else:
+                missing.append(pattern)
+            continue
+
+        for site_path in sorted(glob.glob(pattern)):
+            if site_path not in sites and __salt__['wordpress.check_wp_downloaded'](site_path=site_path):
+                sites.append(site_path)
+
+    if not sites and not missing:
+        raise SaltInvocationError('No WordPress sites match {0}'.format(', '.join(site_paths)))
+
+    return sites, missing
+
+
+def _concurrency(concurrency):
+    if concurrency is None:
+        concurrency = __salt__['config.get']('wordpress:fleet_concurrency', 8)
+    return max(1, int(concurrency))
+
+
+def _fan_out(site_function, site_paths, concurrency):
+    """
+    Call ``site_function(site_path)`` for every site in a bounded thread pool
+
+    An exception raised for one site is recorded in that site's result and does not
+    affect the others.  Explicit paths without WordPress are reported as failed sites.
+    :return: A dict with the per-site results and success/failure counts
+    """
+    sites, missing = _expand_sites(site_paths)
+
+    def _run_site(site_path):
+        try:
+            return {'result': True, 'return': site_function(site_path)}
+        except Exception as e:
+            log.debug('Fleet operation failed for site at path \'%s\': %s', site_path, e)
+            return {'result': False, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=_concurrency(concurrency)) as executor:
+        results = dict(zip(sites, executor.map(_run_site, sites)))
+
+    for site_path in missing:
+        results[site_path] = {'result': False,
+                              'error': 'WordPress is not downloaded at {0}'.format(site_path)}
+
+    failed = sorted(site_path for site_path, result in results.items() if not result['result'])
+
+    return {
+        'sites': results,
+        'succeeded': len(results) - len(failed),
+        'failed': failed,
+    }
+
+
+def fleet_run(function, site_paths, concurrency=None, **kwargs):
+    """
+    Run one of the per-site ``wordpress`` functions against many sites in parallel
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.fleet_run check_plugin_enabled '/var/www/*' plugin_name=akismet user=www-data
+
+    :param function: The function name, with or without the 'wordpress.' prefix
+    :param site_paths: A list of site paths or glob patterns
+    :param concurrency: The maximum number of sites handled at once
+                        (default: the 'wordpress:fleet_concurrency' option, or 8)
+    :param kwargs: Passed to the function along with ``site_path``
+    :return: A dict with the per-site results and success/failure counts
+    """
+    if not function.startswith('wordpress.'):
+        function = 'wordpress.{0}'.format(function)
+
+    if function not in __salt__:
+        raise SaltInvocationError('Unknown function: {0}'.format(function))
+
+    # Drop the ``__pub_*`` arguments Salt adds for CLI calls
+    kwargs = dict((key, value) for key, value in kwargs.items() if not key.startswith('__'))
+
+    return _fan_out(lambda site_path: __salt__[function](site_path=site_path, **kwargs),
+                    site_paths, concurrency)
+
+
+def fleet_check_plugins(site_paths, user, concurrency=None):
+    """
+    Report the status of every plugin on many sites, using one ``wp plugin list`` per site
+
+    :param site_paths: A list of site paths or glob patterns
+    :param user: The user to run WP-CLI as
+    :param concurrency: The maximum number of sites handled at once
+    :return: A dict with the per-site plugin statuses and success/failure counts
+    """
+    def _check(site_path):
+        inventory = __salt__['wordpress.get_inventory'](site_path=site_path, user=user)
+        return dict((name, plugin['status']) for name, plugin in inventory['plugins'].items())
+
+    return _fan_out(_check, site_paths, concurrency)
+
+
+def fleet_enable_plugin(plugin_name, site_paths, user, concurrency=None):
+    """
+    Activate a plugin on many sites, skipping the sites where it is already active
+
+    :param plugin_name: The plugin to activate
+    :param site_paths: A list of site paths or glob patterns
+    :param user: The user to run WP-CLI as
+    :param concurrency: The maximum number of sites handled at once
+    :return: A dict with the per-site results and success/failure counts
+    """
+    def _enable(site_path):
+        # The check functions return, rather than raise, their exceptions
+        current_state = __salt__['wordpress.check_plugin_enabled'](plugin_name=plugin_name,
+                                                                   site_path=site_path,
+                                                                   user=user)
+        if isinstance(current_state, Exception):
+            raise current_state
+        if current_state:
+            return {'changed': False}
+
+        cmd_result = __salt__['wordpress.enable_plugin'](plugin_name=plugin_name, site_path=site_path, user=user)
+        if isinstance(cmd_result, Exception):
+            raise cmd_result
+        if cmd_result['Result']['retcode'] != 0:
+            raise CommandExecutionError(cmd_result['Result']['stderr'])
+
+        return {'changed': True}
+
+    return _fan_out(_enable, site_paths, concurrency)
+
+
+def _check_waves(waves):
+    # Rejects wave sizes that ``_wave_sizes`` cannot use, before anything is updated
+    if not isinstance(waves, (list, tuple)) or not waves:
+        raise CommandExecutionError('The update waves must be a non-empty list of site counts or percentages, '
+                                    'not {0!r}'.format(waves))
+
+    for spec in waves:
+        try:
+            size = float(str(spec)[:-1]) if str(spec).endswith('%') else int(spec)
+        except (TypeError, ValueError):
+            size = 0
+        if size <= 0:
+            raise CommandExecutionError('Invalid update wave size {0!r}: expected a positive number of sites '
+                                        'or a percentage such as \'25%\''.format(spec))
+
+
+def _wave_sizes(total, waves):
+    # Each entry is a number of sites or a percentage of ``total``; the last one repeats until all are covered
+    sizes = []
+    remaining = total
+
+    while remaining > 0:
+        spec = str(waves[min(len(sizes), len(waves) - 1)])
+        if spec.endswith('%'):
+            size = int(math.ceil(total * float(spec[:-1]) / 100))
+        else:
+            size = int(spec)
+        size = max(1, min(size, remaining))
+        sizes.append(size)
+        remaining -= size
+
+    return sizes
+
+
+def _failure_threshold(max_failures, total):
+    spec = str(max_failures)
+    if spec.endswith('%'):
+        return int(total * float(spec[:-1]) / 100)
+    return int(spec)
+
+
+def _raise_on_failure(result):
+    # The mutating functions return, rather than raise, their exceptions
+    if isinstance(result, Exception):
+        raise result
+    if result['Result']['retcode'] != 0:
+        raise CommandExecutionError(result['Result']['stderr'])
+
+
+def update_fleet(site_paths,
+                 user,
+                 plugins=True,
+                 core=False,
+                 waves=None,
+                 max_failures=None,
+                 concurrency=None,
+                 test=False):
+    """
+    Update plugins and/or core on many sites, in waves that stop once too many sites have failed
+
+    Every site is first queried once for its pending updates (``wp plugin list --update=available``,
+    ``wp core check-update``), in parallel.  The sites with something to update are then split into waves;
+    each site has all of its plugin updates applied with a single ``wp plugin update`` call.
+    After each wave, the rollout stops if more sites have failed than ``max_failures``;
+    the remaining sites are reported as skipped.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.update_fleet '/var/www/*' www-data waves='[1, "10%", "50%"]' max_failures=1 test=True
+
+    :param site_paths: A list of site paths or glob patterns
+    :param user: The user to run WP-CLI as
+    :param plugins: Update plugins
+    :param core: Update WordPress core (and the database schema)
+    :param waves: The size of each wave, as a number of sites or a percentage of the sites to update;
+                  the last size repeats (default: the 'wordpress:update_waves' option, or [1, '25%'])
+    :param max_failures: The number (or percentage) of failed sites tolerated before the rollout stops
+                         (default: the 'wordpress:update_max_failures' option, or 0)
+    :param concurrency: The maximum number of sites handled at once within a wave
+    :param test: Only report the pending updates and the waves
+    :return: A dict with the per-site results, success/failure counts, the waves and the skipped sites
+    """
+    if waves is None:
+        waves = __salt__['config.get']('wordpress:update_waves', [1, '25%'])
+    if max_failures is None:
+        max_failures = __salt__['config.get']('wordpress:update_max_failures', 0)
+    _check_waves(waves)
+
+    def _discover(site_path):
+        pending = {}
+        if plugins:
+            pending['plugins'] = __salt__['wordpress.get_plugin_updates'](site_path=site_path, user=user)
+        if core:
+            updates = __salt__['wordpress.get_core_updates'](site_path=site_path, user=user)
+            pending['core'] = updates[0]['version'] if updates else None
+        return pending
+
+    discovery = _fan_out(_discover, site_paths, concurrency)
+
+    # Discovery failures are reported, but do not count towards the rollout's failure threshold
+    pending = dict((site_path, result['return']) for site_path, result in discovery['sites'].items()
+                   if result['result'] and (result['return'].get('plugins') or result['return'].get('core')))
+    ordered = sorted(pending)
+
+    rollout = []
+    for size in _wave_sizes(len(ordered), waves):
+        rollout.append(ordered[sum(len(wave) for wave in rollout):][:size])
+
+    ret = {
+        'sites': discovery['sites'],
+        'succeeded': 0,
+        'failed': list(discovery['failed']),
+        'waves': rollout,
+        'skipped': [],
+        'stopped': False,
+    }
+
+    if test:
+        ret['succeeded'] = discovery['succeeded']
+        return ret
+
+    def _update(site_path):
+        updates = pending[site_path]
+        changes = {}
+
+        if updates.get('plugins'):
+            _raise_on_failure(__salt__['wordpress.update_plugins'](site_path=site_path, user=user,
+                                                                   plugin_names=sorted(updates['plugins'])))
+            changes['plugins'] = dict((name, {'old': plugin['version'], 'new': plugin['update_version']})
+                                      for name, plugin in updates['plugins'].items())
+
+        if updates.get('core'):
+            old_version = __salt__['wordpress.core_version'](site_path=site_path) \
+                if 'wordpress.core_version' in __salt__ else None
+            result = __salt__['wordpress.update_core'](site_path=site_path, user=user, version=updates['core'])
+            if isinstance(result, Exception):
+                raise result
+            for step, step_result in result['Result'].items():
+                # A site on a shared core tree is switched over, which reports files rather than a command result
+                if 'retcode' in step_result and step_result['retcode'] != 0:
+                    raise CommandExecutionError('Core {0} failed: {1}'.format(step, step_result['stderr']))
+            changes['core'] = {'old': old_version, 'new': updates['core']}
+
+        return changes
+
+    threshold = _failure_threshold(max_failures, len(ordered))
+    rollout_failures = 0
+
+    for index, wave in enumerate(rollout):
+        if ret['stopped']:
+            ret['skipped'].extend(wave)
+            continue
+
+        results = _fan_out(_update, wave, concurrency)
+        ret['sites'].update(results['sites'])
+        ret['failed'].extend(results['failed'])
+        rollout_failures += len(results['failed'])
+
+        if rollout_failures > threshold:
+            log.warning('Stopping the WordPress update rollout after wave %s: %s site(s) failed',
+                        index + 1, rollout_failures)
+            ret['stopped'] = True
+
+    ret['failed'] = sorted(ret['failed'])
+    ret['succeeded'] = len(ret['sites']) - len(ret['failed']) - len(ret['skipped'])
+
+    for site_path in ret['skipped']:
+        ret['sites'][site_path] = {'result': None, 'skipped': True, 'pending': pending[site_path]}
+
+    return ret
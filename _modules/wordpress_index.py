@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Answers "is this plugin/theme installed" from the file system instead of WP-CLI.
+# This mirrors what WordPress itself does in ``get_plugins()`` and ``wp_get_themes()``:
+# plugins are PHP files with a 'Plugin Name' header, either directly in ``wp-content/plugins``
+# or one level down in a directory; themes are directories with a 'Theme Name' header in ``style.css``.
+
+# TODO Sites that move ``wp-content`` with WP_CONTENT_DIR are not indexed; callers fall back to WP-CLI
+
+import os
+import re
+
+
+__virtualname__ = 'wordpress'
+
+# WordPress only reads the first 8 KiB of a file when looking for headers
+_HEADER_BYTES = 8192
+
+_PLUGIN_HEADERS = {
+    'name': 'Plugin Name',
+    'version': 'Version',
+    'text_domain': 'Text Domain',
+}
+
+_THEME_HEADERS = {
+    'name': 'Theme Name',
+    'version': 'Version',
+    'text_domain': 'Text Domain',
+}
+
+
+def __virtual__():
+    """
+    The index is pure Python, so it is always available
+    :return:
+    """
+    return __virtualname__
+
+
+def _read_headers(file_path, headers):
+    # Based off of ``get_file_data()`` in wp-includes/functions.php
+    try:
+        with open(file_path, 'rb') as header_file:
+            data = header_file.read(_HEADER_BYTES).decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return {}
+
+    ret = {}
+    for key, header in headers.items():
+        match = re.search(r'^[ \t/*#@]*' + re.escape(header) + r':(.*)$', data, re.MULTILINE | re.IGNORECASE)
+        if match:
+            # Strip a trailing comment terminator, as WordPress does
+            ret[key] = re.sub(r'\s*(?:\*/|\?>).*', '', match.group(1)).strip()
+
+    return ret
+
+
+def _plugin_entry(entry):
+    # Returns the slug and headers of a plugin directory entry, or None if it is not a plugin
+    if entry.is_file():
+        if not entry.name.endswith('.php'):
+            return None
+        headers = _read_headers(entry.path, _PLUGIN_HEADERS)
+        return (entry.name[:-4], headers) if headers.get('name') else None
+
+    if entry.is_dir() and not entry.name.startswith('.'):
+        for sub_entry in os.scandir(entry.path):
+            if sub_entry.is_file() and sub_entry.name.endswith('.php'):
+                headers = _read_headers(sub_entry.path, _PLUGIN_HEADERS)
+                if headers.get('name'):
+                    return entry.name, headers
+
+    return None
+
+
+def _theme_entry(entry):
+    # Returns the slug and headers of a theme directory entry, or None if it is not a theme
+    if not entry.is_dir() or entry.name.startswith('.'):
+        return None
+
+    headers = _read_headers(os.path.join(entry.path, 'style.css'), _THEME_HEADERS)
+    return (entry.name, headers) if headers.get('name') else None
+
+
+def _index(directory, parse_entry):
+    """
+    Scan ``directory`` and cache the result in ``__context__``
+
+    The whole scan is skipped while the directory mtime is unchanged, which covers
+    plugins and themes being added or removed.  On a rescan, entries whose own mtime
+    is unchanged reuse their previously parsed headers.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return None
+
+    cache = __context__.setdefault('wordpress.index', {})
+    cached = cache.get(directory)
+
+    if cached and cached['mtime'] == mtime:
+        return cached['items']
+
+    previous = cached['entries'] if cached else {}
+    entries = {}
+    items = {}
+
+    try:
+        directory_entries = list(os.scandir(directory))
+    except OSError:
+        # Unreadable: callers fall back to WP-CLI
+        return None
+
+    for entry in directory_entries:
+        # Like WP-CLI, skip entries that cannot be read, such as dangling symlinks
+        try:
+            entry_mtime = entry.stat().st_mtime
+            if entry.name in previous and previous[entry.name][0] == entry_mtime:
+                parsed = previous[entry.name][1]
+            else:
+                parsed = parse_entry(entry)
+        except OSError:
+            continue
+
+        entries[entry.name] = (entry_mtime, parsed)
+        if parsed:
+            items[parsed[0]] = parsed[1]
+
+    cache[directory] = {'mtime': mtime, 'entries': entries, 'items': items}
+
+    return items
+
+
+def plugin_index(site_path):
+    """
+    Return the plugins installed in ``wp-content/plugins`` without calling WP-CLI
+
+    :param site_path: The path of the site
+    :return: A dict mapping plugin names to their 'name', 'version' and 'text_domain' headers,
+             or None if the plugin directory does not exist or cannot be read
+    """
+    return _index(os.path.join(site_path, 'wp-content', 'plugins'), _plugin_entry)
+
+
+def theme_index(site_path):
+    """
+    Return the themes installed in ``wp-content/themes`` without calling WP-CLI
+
+    :param site_path: The path of the site
+    :return: A dict mapping theme names to their 'name', 'version' and 'text_domain' headers,
+             or None if the theme directory does not exist or cannot be read
+    """
+    return _index(os.path.join(site_path, 'wp-content', 'themes'), _theme_entry)
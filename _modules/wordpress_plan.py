@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+# Brings a site to a full specification (core version, wp-config.php values, installation, plugins
+# and active theme) in one pass, for the ``wordpress_site.managed`` state.
+#
+# The current state is gathered once, mostly from the file system and the cached inventory,
+# and compared with the specification to build a plan: the steps that are actually needed,
+# in dependency order, each with its share of the diff.  Applying the plan runs those steps
+# and stops at the first one that fails.
+
+import logging
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+_PLUGIN_STATUSES = ('installed', 'active', 'inactive')
+
+_REQUIRED_CONFIG = ('dbname', 'dbuser', 'dbpass', 'dbhost')
+
+_INSTALL_KEYS = ('site_url', 'site_title', 'admin_user', 'admin_password', 'admin_email')
+
+# Never shown in diffs, which end up in job returns and logs
+_SECRET_KEYS = ('dbpass', 'admin_password')
+
+# Steps that change which plugins and themes are on disk, or how their state is read
+_REPLAN_AFTER = ('wordpress.download_wordpress', 'wordpress.install_site')
+
+
+def __virtual__():
+    """
+    Only load the module if WP-CLI is installed
+    :return:
+    """
+    if 'wordpress.check_cli_installed' in __salt__ and __salt__['wordpress.check_cli_installed']():
+        return __virtualname__
+    return False, 'The wordpress plan module cannot be loaded: WP-CLI is not installed'
+
+
+def _named_specs(items, default):
+    # ['akismet', ...], {'akismet': '5.3', ...} or {'akismet': {'version': '5.3', 'status': 'active'}, ...}
+    if not items:
+        return {}
+    if not isinstance(items, dict):
+        return dict((name, {'version': None, 'status': default}) for name in items)
+
+    specs = {}
+    for name, spec in items.items():
+        if not isinstance(spec, dict):
+            spec = {'version': spec}
+        specs[name] = {'version': spec.get('version'), 'status': spec.get('status', default)}
+
+    return specs
+
+
+def _mask(key, value):
+    return '********' if key in _SECRET_KEYS else value
+
+
+def _local_state(site_path):
+    # Everything that can be read from the file system, without WP-CLI
+    ret = {
+        'downloaded': __salt__['wordpress.check_wp_downloaded'](site_path=site_path),
+        'version': None,
+        'configured': False,
+        'installed': False,
+        'plugins': {},
+        'themes': {},
+        'theme': None,
+    }
+
+    if ret['downloaded']:
+        ret['version'] = __salt__['wordpress.core_version'](site_path=site_path)
+        ret['configured'] = __salt__['wordpress.check_site_configured'](site_path=site_path)
+
+    return ret
+
+
+def _current_states(site_users, refresh=False, concurrency=None):
+    """
+    Gather the current state of several sites, mapped to the user to run WP-CLI as
+
+    The install checks, then the inventories, of all the sites of a user run concurrently.
+    :return: A dict mapping each site path to its state, or to the exception raised while gathering it
+    """
+    states = dict((site_path, _local_state(site_path)) for site_path in site_users)
+
+    by_user = {}
+    for site_path, user in site_users.items():
+        if states[site_path]['configured']:
+            by_user.setdefault(user, []).append(site_path)
+
+    for user, site_paths in sorted(by_user.items()):
+        installed = __salt__['wordpress.check_sites_installed'](site_paths=site_paths, user=user,
+                                                                concurrency=concurrency)
+        for site_path in site_paths:
+            if isinstance(installed[site_path], Exception):
+                states[site_path] = installed[site_path]
+            else:
+                states[site_path]['installed'] = installed[site_path]
+
+        listed = [site_path for site_path in site_paths if installed[site_path] is True]
+        inventories = __salt__['wordpress.get_inventories'](site_paths=listed, user=user, refresh=refresh,
+                                                            concurrency=concurrency) if listed else {}
+
+        for site_path, inventory in inventories.items():
+            if isinstance(inventory, Exception):
+                states[site_path] = inventory
+                continue
+            for item_type in ('plugins', 'themes'):
+                states[site_path][item_type] = dict((name, {'version': item.get('version'),
+                                                            'status': item.get('status')})
+                                                    for name, item in inventory[item_type].items())
+            states[site_path]['theme'] = next((name for name, theme in states[site_path]['themes'].items()
+                                               if theme['status'] == 'active'), None)
+
+    for site_path, state in states.items():
+        if isinstance(state, Exception) or not state['downloaded'] or state['installed']:
+            continue
+        # Nothing can be active before the site is installed
+        for item_type in ('plugins', 'themes'):
+            index = __salt__['wordpress.{0}_index'.format(item_type[:-1])](site_path) or {}
+            state[item_type] = dict((name, {'version': item.get('version'), 'status': 'inactive'})
+                                    for name, item in index.items())
+
+    return states
+
+
+def current_state(site_path, user, refresh=False):
+    """
+    Gather what ``plan_site`` compares against, with as few WP-CLI calls as possible
+
+    The core version, wp-config.php and the installed plugins and themes are read from the file system.
+    Only an installed site is asked for its plugin and theme statuses, through the cached inventory
+    (see ``get_inventory``), which is free for sites whose fingerprint has not changed.
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :param refresh: Query WP-CLI again even if a snapshot is available
+    :return: A dict with the keys 'downloaded', 'version', 'configured', 'installed',
+             'plugins' and 'themes' (names mapped to their 'version' and 'status') and 'theme'
+    """
+    state = _current_states({site_path: user}, refresh=refresh)[site_path]
+
+    if isinstance(state, Exception):
+        raise state
+
+    return state
+
+
+def _step(name, function, changes, **kwargs):
+    return {'step': name, 'function': function, 'kwargs': kwargs, 'changes': changes}
+
+
+def _core_steps(site_path, spec, current, user):
+    steps = []
+
+    if not current['downloaded']:
+        steps.append(_step('download', 'wordpress.download_wordpress',
+                           {'core': {'old': None, 'new': spec.get('version') or 'latest'}},
+                           site_path=site_path, user=user, version=spec.get('version'), locale=spec.get('locale')))
+
+    config = spec.get('config')
+    if config and not current['configured']:
+        missing = [key for key in _REQUIRED_CONFIG if key not in config]
+        if missing:
+            raise SaltInvocationError('The config of site at path \'{0}\' must specify {1}'
+                                      .format(site_path, ', '.join(missing)))
+        steps.append(_step('configure', 'wordpress.config_site',
+                           {'config': dict((key, {'old': None, 'new': _mask(key, value)})
+                                           for key, value in config.items()
+                                           if __salt__['wordpress.config_target'](key) and value is not None)},
+                           site_path=site_path, config=config, user=user))
+    elif config:
+        diff = __salt__['wordpress.config_diff'](site_path=site_path, config=config)
+        # ``update_config`` would refuse it, since the tables would no longer be found
+        if 'dbprefix' in diff and current['installed']:
+            raise CommandExecutionError('Refusing to change the table prefix of installed site at path \'{0}\''
+                                        .format(site_path))
+        if diff:
+            steps.append(_step('update_config', 'wordpress.update_config', {'config': diff},
+                               site_path=site_path, config=dict((key, config[key]) for key in diff), user=user))
+
+    install = spec.get('install')
+    if install and not current['installed']:
+        missing = [key for key in _INSTALL_KEYS if key not in install]
+        if missing:
+            raise SaltInvocationError('The install parameters of site at path \'{0}\' must specify {1}'
+                                      .format(site_path, ', '.join(missing)))
+        kwargs = dict((key, install[key]) for key in _INSTALL_KEYS)
+        steps.append(_step('install', 'wordpress.install_site',
+                           {'installed': {'old': False, 'new': True}},
+                           site_path=site_path, user=user, **kwargs))
+
+    # Updating core also migrates the database, so a fresh download is left to ``download``
+    if spec.get('version') and current['downloaded'] and current['version'] != spec['version']:
+        steps.append(_step('update_core', 'wordpress.update_core',
+                           {'core': {'old': current['version'], 'new': spec['version']}},
+                           site_path=site_path, user=user, version=spec['version']))
+
+    return steps
+
+
+def _reinstall_steps(kind, site_path, items, current, user):
+    # Installed items pinned to another version are installed again over the old files;
+    # those whose version cannot be read are left alone, or they would be reinstalled on every run
+    installed = current[kind + 's']
+    steps = []
+
+    for name in sorted(name for name, item in items.items()
+                       if item['version'] and installed.get(name, {}).get('version') not in (None, item['version'])):
+        kwargs = {kind + '_name': name, 'site_path': site_path, 'user': user,
+                  'version': items[name]['version'], 'force': True}
+        steps.append(_step('reinstall_{0}:{1}'.format(kind, name), 'wordpress.install_' + kind,
+                           {kind + '_versions': {name: {'old': installed[name]['version'],
+                                                        'new': items[name]['version']}}},
+                           **kwargs))
+
+    return steps
+
+
+def _plugin_steps(site_path, spec, current, user):
+    plugins = _named_specs(spec.get('plugins'), 'installed')
+    invalid = sorted(name for name, plugin in plugins.items() if plugin['status'] not in _PLUGIN_STATUSES)
+    if invalid:
+        raise SaltInvocationError('Unknown plugin status for {0}; expected one of {1}'
+                                  .format(', '.join(invalid), ', '.join(_PLUGIN_STATUSES)))
+
+    steps = []
+    missing = sorted(name for name in plugins if name not in current['plugins'])
+    steps.extend(_reinstall_steps('plugin', site_path, plugins, current, user))
+
+    # Pinned versions need one call each; the others are installed with a single call
+    for name in missing:
+        if plugins[name]['version']:
+            steps.append(_step('install_plugin:' + name, 'wordpress.install_plugin',
+                               {'plugins': {name: {'old': None, 'new': 'inactive'}}},
+                               plugin_name=name, site_path=site_path, user=user, version=plugins[name]['version']))
+    unpinned = [name for name in missing if not plugins[name]['version']]
+    if unpinned:
+        steps.append(_step('install_plugins', 'wordpress.install_plugins',
+                           {'plugins': dict((name, {'old': None, 'new': 'inactive'}) for name in unpinned)},
+                           plugin_names=unpinned, site_path=site_path, user=user))
+
+    def _status(name):
+        return current['plugins'][name]['status'] if name in current['plugins'] else 'inactive'
+
+    to_enable = sorted(name for name, plugin in plugins.items()
+                       if plugin['status'] == 'active' and _status(name) not in ('active', 'active-network'))
+    to_disable = sorted(name for name, plugin in plugins.items()
+                        if plugin['status'] == 'inactive' and _status(name) in ('active', 'active-network'))
+
+    if to_enable:
+        steps.append(_step('enable_plugins', 'wordpress.enable_plugins',
+                           {'plugins': dict((name, {'old': _status(name), 'new': 'active'}) for name in to_enable)},
+                           plugin_names=to_enable, site_path=site_path, user=user))
+    if to_disable:
+        steps.append(_step('disable_plugins', 'wordpress.disable_plugins',
+                           {'plugins': dict((name, {'old': _status(name), 'new': 'inactive'})
+                                            for name in to_disable)},
+                           plugin_names=to_disable, site_path=site_path, user=user))
+
+    return steps
+
+
+def _theme_steps(site_path, spec, current, user):
+    themes = _named_specs(spec.get('themes'), 'installed')
+    if spec.get('theme'):
+        themes.setdefault(spec['theme'], {'version': None, 'status': 'installed'})
+
+    steps = []
+    for name in sorted(name for name in themes if name not in current['themes']):
+        steps.append(_step('install_theme:' + name, 'wordpress.install_theme',
+                           {'themes': {name: {'old': None, 'new': 'inactive'}}},
+                           theme_name=name, site_path=site_path, user=user, version=themes[name]['version']))
+    steps.extend(_reinstall_steps('theme', site_path, themes, current, user))
+
+    if spec.get('theme') and current['theme'] != spec['theme']:
+        steps.append(_step('enable_theme', 'wordpress.enable_theme',
+                           {'theme': {'old': current['theme'], 'new': spec['theme']}},
+                           theme_name=spec['theme'], site_path=site_path, user=user))
+
+    return steps
+
+
+def _merge(changes, fragment):
+    # Later steps keep the 'old' value of earlier ones, so that each key shows one before/after pair
+    for key, value in fragment.items():
+        if isinstance(value, dict) and 'new' in value and 'old' in value:
+            if key in changes:
+                changes[key]['new'] = value['new']
+            else:
+                changes[key] = dict(value)
+        else:
+            _merge(changes.setdefault(key, {}), value)
+    return changes
+
+
+def _plan(site_path, spec, user, current=None, refresh=False):
+    if current is None:
+        current = current_state(site_path, user, refresh=refresh)
+
+    steps = _core_steps(site_path, spec, current, user)
+    steps.extend(_plugin_steps(site_path, spec, current, user))
+    steps.extend(_theme_steps(site_path, spec, current, user))
+
+    return steps
+
+
+def plan_site(site_path, spec, user='www-data', refresh=False):
+    """
+    Compute the steps needed to bring a site to ``spec``, without changing anything
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.plan_site /var/www/example '{"version": "6.4.2", "theme": "twentytwentyfour"}'
+
+    :param site_path: The path of the site
+    :param spec: The site specification, with the optional keys 'version', 'locale', 'config' (as for
+                 ``config_site``), 'install' (the parameters of ``install_site``), 'plugins' (a list of names,
+                 or names mapped to a version and/or a 'status' of 'installed', 'active' or 'inactive'),
+                 'themes' (likewise, without status) and 'theme' (the active theme).
+                 Plugins and themes installed at another version than the one given are installed again
+    :param user: The user to run WP-CLI as
+    :param refresh: Query WP-CLI again, ignoring both the snapshots and the states gathered by ``plan_fleet``
+    :return: A dict with the ordered 'steps' and the 'changes' they would make, as 'old'/'new' pairs
+    """
+    # ``plan_fleet`` gathers the state of every site at once; later plans in the same run reuse it
+    current = None if refresh else __context__.get('wordpress.current_states', {}).get(site_path)
+
+    return _summarize(_plan(site_path, spec, user, current=current, refresh=refresh))
+
+
+def _summarize(steps):
+    changes = {}
+    for step in steps:
+        _merge(changes, step['changes'])
+
+    return {'steps': [step['step'] for step in steps], 'changes': changes}
+
+
+def plan_fleet(sites=None, user='www-data', refresh=False, concurrency=None):
+    """
+    Dry-run the site specifications of many sites at once, returning the changes each would need
+
+    The current state of every site is gathered in one pass: the install checks, then the inventories
+    (``wp plugin list`` and ``wp theme list``), run concurrently across sites, and sites whose fingerprint
+    has not changed are answered from their snapshot without WP-CLI.  The gathered states are kept for
+    the rest of the run, so that the ``wordpress_site.managed`` states that follow in test mode reuse them.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.plan_fleet
+        salt '*' wordpress.plan_fleet concurrency=16
+
+    :param sites: Site specifications keyed by site path (see ``plan_site``); each may also set its 'user'.
+                  Defaults to the pillar key 'wordpress:sites', as used by ``prefetch``
+    :param user: The user to run WP-CLI as, for sites that do not set one
+    :param refresh: Query WP-CLI again even if a snapshot is available
+    :param concurrency: The maximum number of WP-CLI processes at once
+                        (default: the 'wordpress:command_concurrency' option, or 8)
+    :return: A dict with the per-site plans ('steps' and 'changes'), success/failure counts,
+             and the sites that would be 'changed'
+    """
+    if sites is None:
+        sites = __salt__['pillar.get']('wordpress:sites', {})
+    if not isinstance(sites, dict):
+        raise SaltInvocationError('The site definitions must be a dict keyed by site path')
+
+    site_users = dict((site_path, (spec or {}).get('user', user)) for site_path, spec in sites.items())
+    states = _current_states(site_users, refresh=refresh, concurrency=concurrency)
+    __context__.setdefault('wordpress.current_states', {}).update(
+        (site_path, state) for site_path, state in states.items() if not isinstance(state, Exception))
+
+    results = {}
+    for site_path, state in sorted(states.items()):
+        try:
+            if isinstance(state, Exception):
+                raise state
+            plan = _summarize(_plan(site_path, sites[site_path] or {}, site_users[site_path], current=state))
+            results[site_path] = {'result': True, 'steps': plan['steps'], 'changes': plan['changes']}
+        except Exception as e:
+            log.debug('Unable to plan site at path \'%s\': %s', site_path, e)
+            results[site_path] = {'result': False, 'error': str(e)}
+
+    failed = sorted(site_path for site_path, result in results.items() if not result['result'])
+
+    return {
+        'sites': results,
+        'succeeded': len(results) - len(failed),
+        'failed': failed,
+        'changed': sorted(site_path for site_path, result in results.items() if result.get('steps')),
+    }
+
+
+def _step_error(result):
+    # The mutating functions return, rather than raise, their exceptions
+    if isinstance(result, Exception):
+        return str(result)
+
+    outcome = result.get('Result') if isinstance(result, dict) else None
+    if not isinstance(outcome, dict):
+        return None
+
+    if 'retcode' in outcome:
+        if outcome['retcode']:
+            return outcome['stderr'] or 'exit status {0}'.format(outcome['retcode'])
+        return None
+
+    # Multi-command results: {'update': {...}, 'update_db': {...}} or {key: retcode}
+    for part, part_result in outcome.items():
+        if isinstance(part_result, dict) and part_result.get('retcode'):
+            return '{0}: {1}'.format(part, part_result['stderr'] or 'exit status {0}'.format(part_result['retcode']))
+        if isinstance(part_result, int) and part_result:
+            return '{0}: exit status {1}'.format(part, part_result)
+
+    return None
+
+
+def manage_site(site_path, spec, user='www-data'):
+    """
+    Bring a site to ``spec``, running only the needed steps, in dependency order
+
+    Steps run in this order: download, configure (or update the config), install, core update,
+    plugin installs, plugin activations and deactivations, theme installs, theme activation.
+    The steps left after the download and the install are planned again, since those bring the bundled
+    plugins and themes.  The first step that fails stops the run.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.manage_site /var/www/example '{"plugins": {"akismet": {"status": "active"}}}'
+
+    :param site_path: The path of the site
+    :param spec: The site specification (see ``plan_site``)
+    :param user: The user to run WP-CLI as
+    :return: A dict with the 'changes' made, the 'steps' run with their results,
+             and the 'failed' step with its 'error' (both None on success)
+    """
+    ret = {'changes': {}, 'steps': {}, 'failed': None, 'error': None}
+
+    steps = _plan(site_path, spec, user)
+    while steps:
+        step = steps.pop(0)
+        if step['step'] in ret['steps']:
+            continue
+
+        try:
+            result = __salt__[step['function']](**step['kwargs'])
+        except (CommandExecutionError, SaltInvocationError) as e:
+            result = e
+
+        error = _step_error(result)
+        ret['steps'][step['step']] = str(result) if isinstance(result, Exception) else result.get('Result')
+
+        if error:
+            log.warning('Step \'%s\' failed for site at path \'%s\': %s', step['step'], site_path, error)
+            ret['failed'] = step['step']
+            ret['error'] = error
+            break
+
+        _merge(ret['changes'], step['changes'])
+
+        # WordPress comes with bundled plugins and themes, so the remaining steps are planned
+        # again from what the download and the install actually left on disk
+        if step['function'] in _REPLAN_AFTER:
+            steps = _plan(site_path, spec, user, refresh=True)
+
+    return ret
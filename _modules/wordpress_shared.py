@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+# Shared, read-only WordPress core trees with per-site overlays.
+#
+# Each core version/locale is extracted once under 'wordpress:shared_core_dir' and made read-only.
+# Sites are populated with hard links into that tree, so identical core files share one inode
+# (and one copy in the page cache) across every site.  Symbolic links cannot be used here:
+# PHP resolves them in ``__FILE__``, so ABSPATH would point at the shared tree
+# and WordPress would look for ``wp-config.php`` there instead of in the site.
+#
+# Each site keeps its own ``wp-config.php`` and a private, writable copy of ``wp-content``.
+# The linked version is recorded in a marker file in the site root.
+
+# REFINE Hard links require the shared tree and the sites to be on the same file system
+
+import errno
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+_MARKER = '.wp-shared-core'
+
+# Site-specific paths that are never linked from the shared tree
+_OVERLAY = ('wp-config.php', 'wp-content', _MARKER)
+
+
+def __virtual__():
+    """
+    Shared core trees are managed in pure Python, so they are always available
+    :return:
+    """
+    return __virtualname__
+
+
+def _store_path(version, locale):
+    shared_dir = __salt__['config.get']('wordpress:shared_core_dir', '/var/lib/wordpress/core')
+    return os.path.join(shared_dir, '{0}-{1}'.format(version, locale))
+
+
+def _chown(path, user):
+    # Only possible, and only needed, when the minion runs as root
+    if user and os.geteuid() == 0:
+        import pwd
+        pw_record = pwd.getpwnam(user)
+        os.lchown(path, pw_record.pw_uid, pw_record.pw_gid)
+
+
+def _make_read_only(root):
+    for dir_path, dir_names, file_names in os.walk(root):
+        for file_name in file_names:
+            os.chmod(os.path.join(dir_path, file_name), 0o444)
+        os.chmod(dir_path, 0o555)
+
+
+def _extract(package, target):
+    # Extracts a core tarball into ``target``, dropping the leading 'wordpress/' directory
+    with tarfile.open(package) as archive:
+        members = []
+        for member in archive.getmembers():
+            parts = member.name.split('/', 1)
+            if len(parts) < 2 or not parts[1] or member.issym() or member.islnk():
+                continue
+            if parts[1].startswith('/') or '..' in parts[1].split('/'):
+                raise CommandExecutionError('Unsafe path in core package: {0}'.format(member.name))
+            member.name = parts[1]
+            members.append(member)
+
+        archive.extractall(target, members)
+
+
+def _core_files(store):
+    # Yields the paths, relative to the shared tree, of every core file that sites link to
+    for dir_path, dir_names, file_names in os.walk(store):
+        rel_dir = os.path.relpath(dir_path, store)
+        if rel_dir == '.':
+            dir_names[:] = [name for name in dir_names if name not in _OVERLAY]
+            rel_dir = ''
+
+        for file_name in file_names:
+            rel_path = os.path.join(rel_dir, file_name)
+            if rel_path not in _OVERLAY:
+                yield rel_path
+
+
+def _read_marker(site_path):
+    try:
+        with open(os.path.join(site_path, _MARKER)) as marker_file:
+            return json.load(marker_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_marker(site_path, version, locale, user):
+    marker_path = os.path.join(site_path, _MARKER)
+
+    with open(marker_path, 'w') as marker_file:
+        json.dump({'version': version, 'locale': locale}, marker_file)
+
+    _chown(marker_path, user)
+
+
+def _link_file(source, target):
+    # Replaces ``target`` with a hard link to ``source`` in a single rename, so readers never see it missing
+    tmp_target = '{0}.wp-link-tmp'.format(target)
+
+    try:
+        if os.path.lexists(tmp_target):
+            os.remove(tmp_target)
+        os.link(source, tmp_target)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            raise CommandExecutionError('The shared core at \'{0}\' and the site at \'{1}\' '
+                                        'must be on the same file system'.format(source, target))
+        raise
+
+    os.rename(tmp_target, target)
+
+
+def _link_tree(store, site_path, user):
+    linked = set()
+
+    for rel_path in _core_files(store):
+        target = os.path.join(site_path, rel_path)
+        target_dir = os.path.dirname(target)
+
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+            _chown(target_dir, user)
+
+        _link_file(os.path.join(store, rel_path), target)
+        linked.add(rel_path)
+
+    return linked
+
+
+def shared_core(version, locale='en_US'):
+    """
+    Return the path of the shared core tree for a version, creating it from the package cache if needed
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.shared_core 6.4.2
+
+    :param version: The WordPress version
+    :param locale: The WordPress locale
+    :return: The path of the read-only core tree
+    """
+    if not version:
+        raise SaltInvocationError('A version is required for a shared core')
+
+    store = _store_path(version, locale)
+    if os.path.isdir(store):
+        return store
+
+    package = __salt__['wordpress.core_package'](version=version, locale=locale)
+
+    # Extracted next to its final location, then renamed, so a half-extracted tree is never used
+    parent = os.path.dirname(store)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(dir=parent, prefix='.staging-')
+
+    try:
+        _extract(package, staging)
+        _make_read_only(staging)
+        os.rename(staging, store)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    return store
+
+
+def shared_core_version(site_path):
+    """
+    Return the shared core version and locale a site is linked to
+
+    :param site_path: The path of the site
+    :return: A dict with the keys 'version' and 'locale', or None if the site has its own copy of core
+    """
+    return _read_marker(site_path)
+
+
+def link_core(site_path, user, version, locale='en_US'):
+    """
+    Populate a new site with hard links to a shared core tree
+
+    The site gets its own writable copy of the default ``wp-content``; ``wp-config.php``
+    is left to ``config_site`` as usual.
+    :param site_path: The path of the site
+    :param user: The user that should own the site-specific files
+    :param version: The WordPress version
+    :param locale: The WordPress locale
+    :return:
+    """
+    if __salt__['wordpress.check_wp_downloaded'](site_path=site_path):
+        raise CommandExecutionError('Wordpress is already downloaded at {0}'.format(site_path))
+
+    store = shared_core(version, locale)
+
+    if not os.path.isdir(site_path):
+        os.makedirs(site_path)
+        _chown(site_path, user)
+
+    content_path = os.path.join(site_path, 'wp-content')
+    if not os.path.isdir(content_path):
+        shutil.copytree(os.path.join(store, 'wp-content'), content_path)
+        for dir_path, dir_names, file_names in os.walk(content_path):
+            os.chmod(dir_path, 0o755)
+            _chown(dir_path, user)
+            for file_name in file_names:
+                os.chmod(os.path.join(dir_path, file_name), 0o644)
+                _chown(os.path.join(dir_path, file_name), user)
+
+    linked = _link_tree(store, site_path, user)
+    _write_marker(site_path, version, locale, user)
+
+    ret = {}
+    ret['Name'] = 'WordPress Shared Core Link'
+    ret['Path'] = site_path
+    ret['Result'] = {'version': version, 'locale': locale, 'files': len(linked)}
+
+    return ret
+
+
+def switch_core(site_path, user, version, locale=None):
+    """
+    Switch a linked site to another shared core version
+
+    The new tree is prepared before the site is touched.  Every core file is then replaced
+    by an atomic rename, and the files that only existed in the old version are removed last.
+    ``wp-config.php`` and ``wp-content`` are not changed; run ``wp core update-db`` afterwards
+    if the new version needs a database upgrade.
+    :param site_path: The path of the site
+    :param user: The user that should own newly created directories
+    :param version: The WordPress version to switch to
+    :param locale: The WordPress locale; defaults to the locale currently linked
+    :return:
+    """
+    current = _read_marker(site_path)
+    if current is None:
+        raise CommandExecutionError('Site at path \'{0}\' is not linked to a shared core'.format(site_path))
+
+    locale = locale or current['locale']
+    if current['version'] == version and current['locale'] == locale:
+        raise CommandExecutionError('Site at path \'{0}\' is already linked to {1}-{2}'
+                                    .format(site_path, version, locale))
+
+    new_store = shared_core(version, locale)
+    old_store = _store_path(current['version'], current['locale'])
+
+    linked = _link_tree(new_store, site_path, user)
+
+    removed = 0
+    if os.path.isdir(old_store):
+        for rel_path in _core_files(old_store):
+            target = os.path.join(site_path, rel_path)
+            if rel_path not in linked and os.path.lexists(target):
+                os.remove(target)
+                removed += 1
+
+    _write_marker(site_path, version, locale, user)
+
+    ret = {}
+    ret['Name'] = 'WordPress Shared Core Switch'
+    ret['Path'] = site_path
+    ret['Result'] = {
+        'old': '{0}-{1}'.format(current['version'], current['locale']),
+        'new': '{0}-{1}'.format(version, locale),
+        'files': len(linked),
+        'removed': removed,
+    }
+
+    return ret
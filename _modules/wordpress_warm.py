@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Warms a site's caches (OPcache, object and page caches) after a change, by requesting its pages
+# before the first visitors do.  URLs come from the site's XML sitemap or an explicit list,
+# and are requested by a small pool of threads, each keeping one connection alive per host.
+
+import logging
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urljoin, urlsplit
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+# The core sitemap (WordPress 5.5+), then the name used by most SEO plugins
+_SITEMAP_PATHS = ('/wp-sitemap.xml', '/sitemap_index.xml', '/sitemap.xml')
+
+_SITEMAP_NAMESPACE = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+# Page caches often key on the encoding, so the requests look like a browser's
+_HEADERS = {
+    'User-Agent': 'salt-wordpress-warm-cache',
+    'Accept': 'text/html,application/xhtml+xml,*/*',
+    'Accept-Encoding': 'gzip, deflate',
+}
+
+# Sitemaps are parsed, so they are requested without compression
+_SITEMAP_HEADERS = {
+    'User-Agent': 'salt-wordpress-warm-cache',
+    'Accept': 'application/xml,text/xml,*/*',
+}
+
+_PERCENTILES = (50, 90, 95, 99)
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+def __virtual__():
+    """
+    The warmer is pure Python, so it is always available
+    :return:
+    """
+    return __virtualname__
+
+
+def _get(connections, url, timeout, headers=None, max_redirects=5):
+    """
+    Send a GET request for ``url`` over a kept-alive connection and read the whole response
+
+    ``connections`` maps (thread, scheme, host) to an open connection, so each worker thread
+    keeps one connection per host.  Redirects to the same host (such as http to https, or an added
+    trailing slash) are followed, as ``wordpress_cache._request`` does; others are returned as they are.
+    :param headers: The request headers, instead of the browser-like ``_HEADERS``
+    :return: The status and body of the response, and the time taken in seconds
+    """
+    headers = _HEADERS if headers is None else headers
+    host = urlsplit(url).hostname
+
+    started = time.time()
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        key = (threading.current_thread().ident, parts.scheme, parts.netloc)
+
+        connection = connections.get(key)
+        if connection is None:
+            connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+            connection = connections[key] = connection_class(parts.netloc, timeout=timeout)
+
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (HTTPException, socket.error):
+            # The server may have closed the idle connection; try once more on a new one
+            connection.close()
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+
+        body = response.read()
+
+        location = response.getheader('Location')
+        if response.status not in _REDIRECT_STATUSES or not location \
+                or urlsplit(urljoin(url, location)).hostname != host:
+            return response.status, body, time.time() - started
+
+        url = urljoin(url, location)
+
+    raise HTTPException('Too many redirects for {0}'.format(url))
+
+
+def _sitemap_urls(connections, site_url, sitemap, max_urls, timeout):
+    """
+    Collect up to ``max_urls`` page URLs from the site's sitemap, following sitemap indexes
+
+    :param sitemap: The sitemap URL or path; by default the usual locations are tried in turn
+    """
+    candidates = [urljoin(site_url, sitemap)] if sitemap else [urljoin(site_url, path) for path in _SITEMAP_PATHS]
+
+    pending = []
+    for candidate in candidates:
+        try:
+            status, body, _ = _get(connections, candidate, timeout, _SITEMAP_HEADERS)
+        except (HTTPException, socket.error) as e:
+            log.debug('Unable to fetch the sitemap %s: %s', candidate, e)
+            continue
+        if status == 200:
+            pending.append((candidate, body))
+            break
+
+    if not pending:
+        raise CommandExecutionError('No sitemap found for {0}'.format(site_url))
+
+    urls = []
+    seen = set()
+    while pending and len(urls) < max_urls:
+        sitemap_url, body = pending.pop(0)
+        seen.add(sitemap_url)
+
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError as e:
+            log.debug('Unable to parse the sitemap %s: %s', sitemap_url, e)
+            continue
+
+        locations = [element.text.strip() for element in root.iter(_SITEMAP_NAMESPACE + 'loc') if element.text]
+
+        if root.tag != _SITEMAP_NAMESPACE + 'sitemapindex':
+            urls.extend(locations[:max_urls - len(urls)])
+            continue
+
+        for location in locations:
+            if location in seen:
+                continue
+            try:
+                status, nested_body, _ = _get(connections, location, timeout, _SITEMAP_HEADERS)
+            except (HTTPException, socket.error) as e:
+                log.debug('Unable to fetch the sitemap %s: %s', location, e)
+                continue
+            if status == 200:
+                pending.append((location, nested_body))
+
+    if not urls:
+        raise CommandExecutionError('The sitemap of {0} lists no URLs'.format(site_url))
+
+    return urls
+
+
+def _percentiles(latencies):
+    # Nearest-rank percentiles, in milliseconds
+    if not latencies:
+        return None
+
+    ordered = sorted(latencies)
+    ret = dict(('p{0}'.format(percentile),
+                round(ordered[max(0, -(-percentile * len(ordered) // 100) - 1)] * 1000, 1))
+               for percentile in _PERCENTILES)
+    ret['max'] = round(ordered[-1] * 1000, 1)
+
+    return ret
+
+
+def warm_cache(site_url,
+               urls=None,
+               sitemap=None,
+               max_urls=None,
+               passes=1,
+               concurrency=None,
+               timeout=None):
+    """
+    Request the pages of a site, so that its OPcache and page cache are warm before visitors arrive
+
+    Without ``urls``, the pages are read from the site's XML sitemap; sitemap indexes are followed.
+    Requests run in up to 'wordpress:warm_concurrency' threads (default 4), each keeping its connection alive.
+    With several ``passes``, the later ones show the latency of the warmed site.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' wordpress.warm_cache https://example.com max_urls=50 passes=2
+        salt '*' wordpress.warm_cache https://example.com urls='["/", "/shop/"]'
+
+    :param site_url: The base URL of the site
+    :param urls: The URLs or paths to request, instead of those in the sitemap
+    :param sitemap: The URL or path of the sitemap; '/wp-sitemap.xml', '/sitemap_index.xml'
+                    and '/sitemap.xml' are tried by default
+    :param max_urls: The maximum number of sitemap URLs to request
+                     (default: the 'wordpress:warm_max_urls' option, or 200)
+    :param passes: How many times to request every URL
+    :param concurrency: How many requests to make at once
+    :param timeout: The timeout of each request, in seconds (default: the 'wordpress:warm_timeout' option, or 30)
+    :return: A dict with, per URL, the 'status' and 'latency' (in ms) of each pass, and per pass,
+             the latency percentiles ('p50', 'p90', 'p95', 'p99', 'max') and the number of 'errors'
+    """
+    if not urlsplit(site_url).netloc:
+        raise SaltInvocationError('The site URL must be absolute, not \'{0}\''.format(site_url))
+
+    max_urls = int(max_urls or __salt__['config.get']('wordpress:warm_max_urls', 200))
+    concurrency = int(concurrency or __salt__['config.get']('wordpress:warm_concurrency', 4))
+    timeout = float(timeout or __salt__['config.get']('wordpress:warm_timeout', 30))
+
+    connections = {}
+
+    def _warm(url):
+        try:
+            status, _, elapsed = _get(connections, url, timeout)
+        except (HTTPException, socket.error) as e:
+            return url, {'error': str(e)}
+        return url, {'status': status, 'latency': elapsed}
+
+    try:
+        if urls is None:
+            urls = _sitemap_urls(connections, site_url, sitemap, max_urls, timeout)
+        urls = list(dict.fromkeys(urljoin(site_url, url) for url in urls))
+
+        ret = {
+            'urls': dict((url, {'status': [], 'latency': []}) for url in urls),
+            'passes': [],
+        }
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for _ in range(max(1, int(passes))):
+                latencies = []
+                errors = 0
+                for url, result in executor.map(_warm, urls):
+                    # Server errors are counted, but their latency is still reported
+                    if 'error' in result or result['status'] >= 500:
+                        errors += 1
+                    ret['urls'][url]['status'].append(result.get('status', result.get('error')))
+                    if 'latency' in result:
+                        latencies.append(result['latency'])
+                        ret['urls'][url]['latency'].append(round(result['latency'] * 1000, 1))
+                    else:
+                        ret['urls'][url]['latency'].append(None)
+                ret['passes'].append({'requests': len(urls), 'errors': errors, 'latency': _percentiles(latencies)})
+    finally:
+        for connection in connections.values():
+            connection.close()
+
+    return ret
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+# Optional execution backend that keeps one long-lived WP-CLI process per site,
+# so that WordPress is only bootstrapped once per state run instead of once per command.
+#
+# Enabled with the minion config or pillar option ``wordpress:backend: worker``.
+# The worker speaks a line-based JSON protocol over its stdin/stdout:
+#   worker -> {"ready": true}                                  once WordPress is loaded
+#   client -> {"command": "plugin list --format=json"}
+#   worker -> {"retcode": 0, "stdout": "...", "stderr": "..."}
+# Any program that follows the protocol can stand in for the PHP worker
+# by setting ``wordpress:worker_command``, which is useful for testing.
+
+import hashlib
+import json
+import logging
+import os
+import select
+import shlex
+import subprocess
+import tempfile
+import time
+
+from shlex import quote
+
+from salt.exceptions import CommandExecutionError
+
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'wordpress'
+
+# Only subcommands that need a bootstrapped WordPress are sent to the worker;
+# everything else (``core download``, ``core config``, ...) keeps running in its own process
+_WORKER_SUBCOMMANDS = ('plugin', 'theme')
+
+_WORKER_SCRIPT = r'''<?php
+// Loaded through ``wp eval-file``, so WordPress is already bootstrapped at this point
+$idle_timeout = (int) getenv('WP_WORKER_IDLE_TIMEOUT');
+if ($idle_timeout <= 0) {
+    $idle_timeout = 300;
+}
+
+$stdin = fopen('php://stdin', 'r');
+fwrite(STDOUT, json_encode(array('ready' => true)) . "\n");
+fflush(STDOUT);
+
+while (true) {
+    $read = array($stdin);
+    $write = null;
+    $except = null;
+    if (!stream_select($read, $write, $except, $idle_timeout)) {
+        break;
+    }
+
+    $line = fgets($stdin);
+    if ($line === false) {
+        break;
+    }
+
+    $request = json_decode($line, true);
+    if (!is_array($request) || !isset($request['command'])) {
+        $response = array('retcode' => 1, 'stdout' => '', 'stderr' => 'Invalid worker request');
+    } else {
+        $result = WP_CLI::runcommand($request['command'], array(
+            'return' => 'all',
+            'launch' => false,
+            'exit_error' => false,
+        ));
+        $response = array(
+            'retcode' => $result->return_code,
+            'stdout' => $result->stdout,
+            'stderr' => $result->stderr,
+        );
+    }
+
+    fwrite(STDOUT, json_encode($response) . "\n");
+    fflush(STDOUT);
+}
+'''
+
+
+def __virtual__():
+    """
+    Only load the module if WP-CLI is installed
+    :return:
+    """
+    if 'wordpress.check_cli_installed' in __salt__ and __salt__['wordpress.check_cli_installed']():
+        return __virtualname__
+    return False, 'The wordpress worker module cannot be loaded: WP-CLI is not installed'
+
+
+def _worker_script_path():
+    # The PHP worker is written to the minion cache on first use, named after its contents
+    # so that an upgraded module never runs the script left behind by an older one
+    digest = hashlib.sha1(_WORKER_SCRIPT.encode('utf-8')).hexdigest()[:12]
+    script_path = os.path.join(__opts__['cachedir'], 'wordpress', 'worker-{0}.php'.format(digest))
+
+    if not os.path.isfile(script_path):
+        script_dir = os.path.dirname(script_path)
+        if not os.path.isdir(script_dir):
+            os.makedirs(script_dir)
+        # Written to a temporary file first so that a concurrent run never loads a partial script
+        fd, tmp_path = tempfile.mkstemp(dir=script_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as script_file:
+            script_file.write(_WORKER_SCRIPT)
+        # The worker runs as the site user, not as the minion user
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, script_path)
+
+    return script_path
+
+
+def _worker_argv(site_path):
+    worker_command = __salt__['config.get']('wordpress:worker_command', None)
+
+    if worker_command:
+        if not isinstance(worker_command, list):
+            worker_command = shlex.split(worker_command)
+        return worker_command + ['--path={0}'.format(site_path)]
+
+    return ['wp', 'eval-file', _worker_script_path(), '--path={0}'.format(site_path)]
+
+
+def _read_line(worker, timeout):
+    # Reads one protocol line from the worker, without blocking past ``timeout``
+    deadline = time.time() + timeout
+    fd = worker['proc'].stdout.fileno()
+
+    while b'\n' not in worker['buffer']:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise CommandExecutionError('Timed out waiting for the WP-CLI worker')
+
+        ready, _, _ = select.select([fd], [], [], remaining)
+        if not ready:
+            continue
+
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            raise CommandExecutionError('The WP-CLI worker exited unexpectedly')
+        worker['buffer'] += chunk
+
+    line, worker['buffer'] = worker['buffer'].split(b'\n', 1)
+
+    try:
+        return json.loads(line.decode('utf-8'))
+    except ValueError:
+        raise CommandExecutionError('The WP-CLI worker sent an invalid response')
+
+
+def _start_worker(site_path, user):
+    idle_timeout = __salt__['config.get']('wordpress:worker_idle_timeout', 300)
+
+    try:
+        demote = __utils__['wordpress_process.demote'](user)
+        env = dict(demote.pop('env', os.environ))
+        env['WP_WORKER_IDLE_TIMEOUT'] = str(idle_timeout)
+
+        with open(os.devnull, 'wb') as devnull:
+            proc = subprocess.Popen(_worker_argv(site_path),
+                                    cwd=site_path,
+                                    env=env,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=devnull,
+                                    close_fds=True,
+                                    **demote)
+    except (OSError, KeyError) as e:
+        raise CommandExecutionError('Unable to start the WP-CLI worker: {0}'.format(e))
+
+    worker = {
+        'proc': proc,
+        'buffer': b'',
+        'last_used': time.time(),
+        'idle_timeout': idle_timeout,
+    }
+
+    try:
+        if not _read_line(worker, __salt__['config.get']('wordpress:worker_start_timeout', 30)).get('ready'):
+            raise CommandExecutionError('The WP-CLI worker did not report ready')
+    except CommandExecutionError:
+        _stop_worker(worker)
+        raise
+
+    return worker
+
+
+def _stop_worker(worker):
+    # Closing stdin asks the worker to exit; it is killed if it does not do so promptly
+    proc = worker['proc']
+
+    try:
+        proc.stdin.close()
+    except (IOError, OSError):
+        pass
+
+    deadline = time.time() + 5
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+    proc.stdout.close()
+
+
+def _reap_idle_workers():
+    # Stops the workers that have not been used within their idle timeout
+    workers = __context__.setdefault('wordpress.workers', {})
+    now = time.time()
+
+    for key in list(workers):
+        if now - workers[key]['last_used'] > workers[key]['idle_timeout']:
+            _stop_worker(workers.pop(key))
+
+
+def _send(worker, command):
+    try:
+        worker['proc'].stdin.write(json.dumps({'command': command}).encode('utf-8') + b'\n')
+        worker['proc'].stdin.flush()
+    except (IOError, OSError) as e:
+        raise CommandExecutionError('Unable to send a command to the WP-CLI worker: {0}'.format(e))
+
+
+def _receive(worker, timeout):
+    response = _read_line(worker, timeout)
+    worker['last_used'] = time.time()
+
+    return {
+        'pid': worker['proc'].pid,
+        'retcode': response.get('retcode', 1),
+        'stdout': response.get('stdout', ''),
+        'stderr': response.get('stderr', ''),
+    }
+
+
+def _worker_command(cmd):
+    # Converts a ``wp ... --path="..."`` command line into the string the worker expects;
+    # the worker is already bound to its site, so the global ``--path`` flag is dropped
+    args = shlex.split(cmd)
+
+    if not args or args[0] != 'wp' or len(args) < 2 or args[1] not in _WORKER_SUBCOMMANDS:
+        return None
+
+    return ' '.join(quote(arg) for arg in args[1:] if not arg.startswith('--path='))
+
+
+def worker_run(cmd, cwd, runas):
+    """
+    Run a WP-CLI command through the persistent worker of the site at ``cwd``
+
+    The worker is started on first use and restarted once if it has crashed before the command was sent.
+    A ``CommandExecutionError`` is raised if the command cannot be handled by the worker,
+    in which case the caller is expected to run the command in its own process.
+    If the worker dies while running the command, a failed result is returned instead.
+    :param cmd: The WP-CLI command line, as built by the other functions of this module
+    :param cwd: The path of the site
+    :param runas: The user to run WP-CLI as
+    :return: A dict with the same 'retcode', 'stdout' and 'stderr' keys as ``cmd.run_all``
+    """
+    command = _worker_command(cmd)
+    if command is None:
+        raise CommandExecutionError('Command is not supported by the WP-CLI worker: {0}'.format(cmd))
+
+    unavailable = __context__.setdefault('wordpress.workers_unavailable', set())
+    if (cwd, runas) in unavailable:
+        raise CommandExecutionError('The WP-CLI worker is unavailable for site at path \'{0}\''.format(cwd))
+
+    _reap_idle_workers()
+
+    workers = __context__.setdefault('wordpress.workers', {})
+    timeout = __salt__['config.get']('wordpress:worker_command_timeout', 300)
+
+    # One retry covers a worker that has crashed or been killed since its last command.
+    # Once the command has been sent it is never retried, since it may have run already
+    for attempt in range(2):
+        worker = workers.get((cwd, runas))
+
+        if worker is None or worker['proc'].poll() is not None:
+            try:
+                worker = workers[(cwd, runas)] = _start_worker(cwd, runas)
+            except CommandExecutionError:
+                # Do not pay the start-up cost again for a site that cannot run a worker
+                unavailable.add((cwd, runas))
+                raise
+
+        try:
+            _send(worker, command)
+        except CommandExecutionError as e:
+            log.debug('WP-CLI worker for \'%s\' failed (attempt %s): %s', cwd, attempt + 1, e)
+            _stop_worker(workers.pop((cwd, runas)))
+            if attempt:
+                raise
+            continue
+
+        try:
+            return _receive(worker, timeout)
+        except CommandExecutionError as e:
+            # Reported as a failed command rather than raised, so that the caller does not run it again
+            log.debug('WP-CLI worker for \'%s\' failed: %s', cwd, e)
+            _stop_worker(workers.pop((cwd, runas)))
+            return {
+                'pid': worker['proc'].pid,
+                'retcode': 1,
+                'stdout': '',
+                'stderr': '{0}; the command may have partly run'.format(e),
+            }
+
+
+def worker_stop(site_path=None):
+    """
+    Stop the persistent WP-CLI workers started by this run
+
+    :param site_path: Only stop the workers of this site
+    :return: The number of workers stopped
+    """
+    workers = __context__.setdefault('wordpress.workers', {})
+    stopped = 0
+
+    for key in list(workers):
+        if site_path is None or key[0] == site_path:
+            _stop_worker(workers.pop(key))
+            stopped += 1
+
+    return stopped
@@ -73,7 +73,7 @@ def cli_installed(name,
         ret['comment'] = 'WP-CLI will be installed.'
         ret['pchanges'] = {
             'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'new': {'source': source, 'user': user, 'group': group},
         }
 
         # Return ``None`` when running with ``test=true``.
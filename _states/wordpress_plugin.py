@@ -14,6 +14,8 @@ def __virtual__():
 def _prep_return_array(name):
     # This technique is not used in the SaltStack built-in modules, presumably due to performance
     # However, for early dev, this allows us to reduce repetition
+    # The command mark lets ``_finish`` summarize the WP-CLI calls made by this state
+    __context__['wordpress.state_mark'] = __salt__['wordpress.command_count']()
     return {
         'name': name,
         'changes': {},
@@ -23,9 +25,16 @@ def _prep_return_array(name):
     }
 
 
+def _finish(ret):
+    # Adds the timing summary of the WP-CLI commands run by this state
+    ret['wp_cli'] = __salt__['wordpress.command_summary'](__context__.get('wordpress.state_mark', 0))
+    return ret
+
+
 def plugin_installed(name,
                      site_path,
-                     user='www-data'):
+                     user='www-data',
+                     version=None):
     ret = _prep_return_array(name)
 
     # Basic error checking, "raise salt.exceptions.SaltInvocationError" if invalid inputs
@@ -38,25 +47,26 @@ def plugin_installed(name,
     if current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
             'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'new': {'version': version or 'latest', 'status': 'inactive'},
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
     new_state = __salt__['wordpress.install_plugin'](plugin_name=name,
                                                      site_path=site_path,
-                                                     user=user)
+                                                     user=user,
+                                                     version=version)
 
     ret['comment'] = 'The state of "{0}" was changed!'.format(name)
 
@@ -67,7 +77,7 @@ def plugin_installed(name,
 
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
 
 
 def plugin_enabled(name,
@@ -85,20 +95,20 @@ def plugin_enabled(name,
     if current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
-            'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'old': _plugin_status(__salt__['wordpress.get_inventory'](site_path=site_path, user=user), name),
+            'new': 'active',
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
     new_state = __salt__['wordpress.enable_plugin'](plugin_name=name,
@@ -114,7 +124,7 @@ def plugin_enabled(name,
 
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
 
 
 def plugin_disabled(name,
@@ -132,20 +142,20 @@ def plugin_disabled(name,
     if not current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
-            'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'old': _plugin_status(__salt__['wordpress.get_inventory'](site_path=site_path, user=user), name),
+            'new': 'inactive',
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
     new_state = __salt__['wordpress.disable_plugin'](plugin_name=name,
@@ -161,4 +171,412 @@ def plugin_disabled(name,
 
     ret['result'] = True
 
+    return _finish(ret)
+
+
+def _plugin_status(inventory, plugin_name):
+    # Returns the WP-CLI status of a plugin, or 'not installed' if it is missing
+    return inventory['plugins'].get(plugin_name, {}).get('status', 'not installed')
+
+
+def _plugin_changes(old_inventory, new_inventory, plugins):
+    # Per-plugin before/after status for the plugins whose status differs
+    changes = {}
+    for plugin in plugins:
+        old = _plugin_status(old_inventory, plugin)
+        new = _plugin_status(new_inventory, plugin)
+        if old != new:
+            changes[plugin] = {'old': old, 'new': new}
+    return changes
+
+
+def _batch_result(ret, plugins, site_path, user, old_inventory, is_correct):
+    # Re-reads the inventory after the batched commands and fills in the return dict
+    new_inventory = __salt__['wordpress.get_inventory'](site_path=site_path, user=user)
+
+    ret['changes'] = _plugin_changes(old_inventory, new_inventory, plugins)
+
+    failed = [plugin for plugin in plugins if not is_correct(_plugin_status(new_inventory, plugin))]
+    if failed:
+        ret['result'] = False
+        ret['comment'] = 'The state of {0} could not be changed'.format(', '.join(failed))
+    else:
+        ret['result'] = True
+        ret['comment'] = 'The state of {0} plugin(s) was changed!'.format(len(ret['changes']))
+
+    return ret
+
+
+def _is_installed(status):
+    return status != 'not installed'
+
+
+def _is_enabled(status):
+    return status in ('active', 'active-network')
+
+
+def _is_disabled(status):
+    return not _is_enabled(status)
+
+
+def plugins_installed(name,
+                      plugins,
+                      site_path,
+                      user='www-data'):
+    """
+    Ensure that all of the given plugins are installed, using a single WP-CLI install call
+
+    :param name: The state ID
+    :param plugins: A list of plugin names
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = __salt__['wordpress.get_inventory'](site_path=site_path, user=user)
+
+    missing = [plugin for plugin in plugins if not _is_installed(_plugin_status(current_state, plugin))]
+
+    if not missing:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'The following plugins will be installed: {0}'.format(', '.join(missing))
+        ret['pchanges'] = dict((plugin, {'old': 'not installed', 'new': 'inactive'}) for plugin in missing)
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    __salt__['wordpress.install_plugins'](plugin_names=missing, site_path=site_path, user=user)
+
+    return _finish(_batch_result(ret, plugins, site_path, user, current_state, _is_installed))
+
+
+def plugins_enabled(name,
+                    plugins,
+                    site_path,
+                    user='www-data'):
+    """
+    Ensure that all of the given plugins are installed and active
+
+    Missing plugins are installed with one WP-CLI call, then every inactive plugin
+    is activated with a second one.
+    :param name: The state ID
+    :param plugins: A list of plugin names
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = __salt__['wordpress.get_inventory'](site_path=site_path, user=user)
+
+    missing = [plugin for plugin in plugins if not _is_installed(_plugin_status(current_state, plugin))]
+    inactive = [plugin for plugin in plugins if not _is_enabled(_plugin_status(current_state, plugin))]
+
+    if not inactive:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'The following plugins will be enabled: {0}'.format(', '.join(inactive))
+        ret['pchanges'] = dict((plugin, {'old': _plugin_status(current_state, plugin), 'new': 'active'})
+                               for plugin in inactive)
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    if missing:
+        __salt__['wordpress.install_plugins'](plugin_names=missing, site_path=site_path, user=user)
+    __salt__['wordpress.enable_plugins'](plugin_names=inactive, site_path=site_path, user=user)
+
+    return _finish(_batch_result(ret, plugins, site_path, user, current_state, _is_enabled))
+
+
+def plugins_disabled(name,
+                     plugins,
+                     site_path,
+                     user='www-data'):
+    """
+    Ensure that none of the given plugins are active, using a single WP-CLI deactivate call
+
+    Plugins that are not installed are considered disabled.
+    :param name: The state ID
+    :param plugins: A list of plugin names
+    :param site_path: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = __salt__['wordpress.get_inventory'](site_path=site_path, user=user)
+
+    active = [plugin for plugin in plugins if _is_enabled(_plugin_status(current_state, plugin))]
+
+    if not active:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'The following plugins will be disabled: {0}'.format(', '.join(active))
+        ret['pchanges'] = dict((plugin, {'old': _plugin_status(current_state, plugin), 'new': 'inactive'})
+                               for plugin in active)
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    __salt__['wordpress.disable_plugins'](plugin_names=active, site_path=site_path, user=user)
+
+    return _finish(_batch_result(ret, plugins, site_path, user, current_state, _is_disabled))
+
+
+def plugins_latest(name,
+                   site_path,
+                   plugins=None,
+                   user='www-data'):
+    """
+    Ensure that the given plugins, or every installed plugin, are at their latest version
+
+    Pending updates are found with a single ``wp plugin list --update=available`` call,
+    and applied with a single ``wp plugin update`` call.
+    :param name: The state ID
+    :param site_path: The path of the site
+    :param plugins: A list of plugin names; defaults to every installed plugin
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = __salt__['wordpress.get_plugin_updates'](site_path=site_path, user=user)
+
+    outdated = sorted(plugin for plugin in current_state if plugins is None or plugin in plugins)
+
+    if not outdated:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    updates = dict((plugin, {'old': current_state[plugin]['version'], 'new': current_state[plugin]['update_version']})
+                   for plugin in outdated)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'The following plugins will be updated: {0}'.format(', '.join(outdated))
+        ret['pchanges'] = updates
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    __salt__['wordpress.update_plugins'](site_path=site_path, user=user, plugin_names=outdated)
+
+    remaining = __salt__['wordpress.get_plugin_updates'](site_path=site_path, user=user)
+    failed = [plugin for plugin in outdated if plugin in remaining]
+
+    ret['changes'] = dict((plugin, change) for plugin, change in updates.items() if plugin not in failed)
+
+    if failed:
+        ret['comment'] = 'The following plugins could not be updated: {0}'.format(', '.join(failed))
+    else:
+        ret['comment'] = 'The state of {0} plugin(s) was changed!'.format(len(ret['changes']))
+        ret['result'] = True
+
+    return _finish(ret)
+
+
+def plugin_network_enabled(name,
+                           site_path,
+                           user='www-data'):
+    """
+    Ensure that a plugin is network-activated on a multisite network
+
+    :param name: The plugin name
+    :param site_path: The path of the network's WordPress install
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = __salt__['wordpress.check_plugin_network_enabled'](plugin_name=name,
+                                                                       site_path=site_path,
+                                                                       user=user)
+
+    if current_state:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'Plugin "{0}" will be network-enabled.'.format(name)
+        ret['pchanges'] = {
+            'old': current_state,
+            'new': True,
+        }
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    new_state = __salt__['wordpress.enable_plugin_network'](plugin_name=name,
+                                                            site_path=site_path,
+                                                            user=user)
+
+    ret['comment'] = 'The state of "{0}" was changed!'.format(name)
+
+    ret['changes'] = {
+        'old': current_state,
+        'new': new_state,
+    }
+
+    ret['result'] = True
+
+    return _finish(ret)
+
+
+def _blog_statuses(site_path, user, blogs, plugin_name):
+    # Per-blog status of a plugin; a network-activated plugin is active on every blog
+    inventory = __salt__['wordpress.get_network_inventory'](site_path=site_path, user=user, blogs=blogs)
+    network_status = inventory['network'].get(plugin_name, 'not installed')
+
+    return dict((url, network_status if network_status in ('active-network', 'not installed')
+                 else blog['plugins'].get(plugin_name, 'inactive'))
+                for url, blog in inventory['blogs'].items())
+
+
+def _blogs_result(ret, site_path, user, blogs, name, old_statuses, is_correct):
+    # Re-reads the statuses after the per-blog commands and fills in the aggregated return dict
+    new_statuses = _blog_statuses(site_path, user, blogs, name)
+
+    ret['changes'] = dict((url, {'old': old_statuses[url], 'new': status}) for url, status in new_statuses.items()
+                          if status != old_statuses.get(url))
+
+    failed = sorted(url for url, status in new_statuses.items() if not is_correct(status))
+    if failed:
+        ret['result'] = False
+        ret['comment'] = 'The state of "{0}" could not be changed on {1} blog(s): {2}' \
+            .format(name, len(failed), ', '.join(failed))
+    else:
+        ret['result'] = True
+        ret['comment'] = 'The state of "{0}" was changed on {1} blog(s)!'.format(name, len(ret['changes']))
+
     return ret
+
+
+def plugin_blogs_enabled(name,
+                         site_path,
+                         blogs=None,
+                         user='www-data'):
+    """
+    Ensure that a plugin is active on every (or the given) blogs of a multisite network
+
+    The blogs are checked with one ``wp site list`` and one status listing per blog, run in parallel,
+    and the plugin is activated with one ``--url`` call per inactive blog, also in parallel.
+    :param name: The plugin name
+    :param site_path: The path of the network's WordPress install
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = _blog_statuses(site_path, user, blogs, name)
+
+    inactive = sorted(url for url, status in current_state.items() if not _is_enabled(status))
+
+    if not inactive:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    if 'not installed' in current_state.values():
+        ret['comment'] = 'Plugin "{0}" is not installed on network at "{1}"'.format(name, site_path)
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'Plugin "{0}" will be enabled on {1} blog(s).'.format(name, len(inactive))
+        ret['pchanges'] = dict((url, {'old': current_state[url], 'new': 'active'}) for url in inactive)
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    __salt__['wordpress.enable_plugin_blogs'](plugin_name=name, site_path=site_path, user=user, blogs=inactive)
+
+    return _finish(_blogs_result(ret, site_path, user, blogs, name, current_state, _is_enabled))
+
+
+def plugin_blogs_disabled(name,
+                          site_path,
+                          blogs=None,
+                          user='www-data'):
+    """
+    Ensure that a plugin is not active on every (or the given) blogs of a multisite network
+
+    A network-activated plugin cannot be disabled per blog; use ``plugin_disabled`` on the network instead.
+    :param name: The plugin name
+    :param site_path: The path of the network's WordPress install
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = _blog_statuses(site_path, user, blogs, name)
+
+    active = sorted(url for url, status in current_state.items() if _is_enabled(status))
+
+    if not active:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    if 'active-network' in current_state.values():
+        ret['comment'] = 'Plugin "{0}" is network-enabled on network at "{1}"'.format(name, site_path)
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'Plugin "{0}" will be disabled on {1} blog(s).'.format(name, len(active))
+        ret['pchanges'] = dict((url, {'old': current_state[url], 'new': 'inactive'}) for url in active)
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    __salt__['wordpress.disable_plugin_blogs'](plugin_name=name, site_path=site_path, user=user, blogs=active)
+
+    return _finish(_blogs_result(ret, site_path, user, blogs, name, current_state, _is_disabled))
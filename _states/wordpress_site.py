@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from salt.exceptions import CommandExecutionError
+
 
 def __virtual__():
     """
@@ -14,6 +16,8 @@ def __virtual__():
 def _prep_return_array(name):
     # This technique is not used in the SaltStack built-in modules, presumably due to performance
     # However, for early dev, this allows us to reduce repetition
+    # The command mark lets ``_finish`` summarize the WP-CLI calls made by this state
+    __context__['wordpress.state_mark'] = __salt__['wordpress.command_count']()
     return {
         'name': name,
         'changes': {},
@@ -23,8 +27,16 @@ def _prep_return_array(name):
     }
 
 
+def _finish(ret):
+    # Adds the timing summary of the WP-CLI commands run by this state
+    ret['wp_cli'] = __salt__['wordpress.command_summary'](__context__.get('wordpress.state_mark', 0))
+    return ret
+
+
 def site_downloaded(name,
-                    user='www-data'):
+                    user='www-data',
+                    version=None,
+                    locale=None):
     ret = _prep_return_array(name)
 
     # Basic error checking, "raise salt.exceptions.SaltInvocationError" if invalid inputs
@@ -35,23 +47,24 @@ def site_downloaded(name,
     if current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
             'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'new': {'version': version or 'latest', 'locale': locale or 'en_US'},
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
-    new_state = __salt__['wordpress.download_wordpress'](site_path=name, user=user)
+    new_state = __salt__['wordpress.download_wordpress'](site_path=name, user=user,
+                                                         version=version, locale=locale)
 
     ret['comment'] = 'The state of "{0}" was changed!'.format(name)
 
@@ -62,7 +75,7 @@ def site_downloaded(name,
 
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
 
 
 def site_configured(name,
@@ -74,38 +87,65 @@ def site_configured(name,
 
     # Get the current state, then check for changes
     current_state = __salt__['wordpress.check_site_configured'](site_path=name)
+    diff = __salt__['wordpress.config_diff'](site_path=name, config=config) if current_state else None
 
-    if current_state:
+    if current_state and not diff:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
-        ret['pchanges'] = {
+        ret['pchanges'] = diff or {
             'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'new': dict((key, '********' if key == 'dbpass' else value) for key, value in config.items()),
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
-    new_state = __salt__['wordpress.config_site'](site_path=name, config=config, user=user)
+    if current_state:
+        try:
+            new_state = __salt__['wordpress.update_config'](site_path=name,
+                                                            config=dict((key, config[key]) for key in diff),
+                                                            user=user)
+        except CommandExecutionError as e:
+            new_state = e
+
+        # The function returns, rather than raises, the errors of the commands
+        if isinstance(new_state, Exception):
+            ret['comment'] = 'The config of "{0}" could not be changed: {1}'.format(name, new_state)
+            return _finish(ret)
+
+        failed = sorted(key for key, retcode in new_state['Result'].items() if retcode != 0)
+        ret['changes'] = dict((key, change) for key, change in diff.items() if key not in failed)
+
+        if failed:
+            ret['comment'] = 'The following config keys of "{0}" could not be changed: {1}' \
+                .format(name, ', '.join(failed))
+            return _finish(ret)
+    else:
+        new_state = __salt__['wordpress.config_site'](site_path=name, config=config, user=user)
+
+        if isinstance(new_state, Exception) or new_state['Result']['retcode'] != 0:
+            ret['comment'] = 'Site at "{0}" could not be configured: {1}'.format(
+                name, new_state if isinstance(new_state, Exception) else new_state['Result']['stderr'])
+            return _finish(ret)
+
+        ret['changes'] = {
+            'old': current_state,
+            'new': new_state,
+        }
 
     ret['comment'] = 'The state of "{0}" was changed!'.format(name)
 
-    ret['changes'] = {
-        'old': current_state,
-        'new': new_state,
-    }
-
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
 
 
 # FIXME This is inconsistent; site_configured takes a dict of options, this takes named parameters
@@ -126,20 +166,25 @@ def site_installed(name,
     if current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
             'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'new': {
+                'site_url': site_url,
+                'site_title': site_title,
+                'admin_user': admin_user,
+                'admin_email': admin_email,
+            },
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
     new_state = __salt__['wordpress.install_site'](site_url=site_url,
@@ -159,4 +204,271 @@ def site_installed(name,
 
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
+
+
+def core_linked(name,
+                version,
+                locale='en_US',
+                user='www-data'):
+    """
+    Ensure that a site uses the shared, read-only core tree of the given version
+
+    New sites are populated with hard links to the shared tree; sites already linked
+    to another version are switched over.  Sites with their own copy of core are left alone.
+    :param name: The path of the site
+    :param version: The WordPress version
+    :param locale: The WordPress locale
+    :param user: The user that should own the site-specific files
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    current_state = __salt__['wordpress.shared_core_version'](site_path=name)
+    desired_state = {'version': version, 'locale': locale}
+
+    if current_state == desired_state:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    if current_state is None and __salt__['wordpress.check_wp_downloaded'](site_path=name):
+        ret['comment'] = 'Site at "{0}" has its own copy of WordPress and cannot be linked'.format(name)
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
+        ret['pchanges'] = {
+            'old': current_state,
+            'new': desired_state,
+        }
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    if current_state is None:
+        new_state = __salt__['wordpress.link_core'](site_path=name, user=user, version=version, locale=locale)
+    else:
+        new_state = __salt__['wordpress.switch_core'](site_path=name, user=user, version=version, locale=locale)
+
+    ret['comment'] = 'The state of "{0}" was changed!'.format(name)
+
+    ret['changes'] = {
+        'old': current_state,
+        'new': new_state,
+    }
+
+    ret['result'] = True
+
+    return _finish(ret)
+
+
+def core_latest(name,
+                user='www-data'):
+    """
+    Ensure that WordPress core is at its latest version, and its database schema up to date
+
+    :param name: The path of the site
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    updates = __salt__['wordpress.get_core_updates'](site_path=name, user=user)
+
+    if not updates:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    current_state = __salt__['wordpress.core_version'](site_path=name)
+    desired_state = updates[0]['version']
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'WordPress at "{0}" will be updated to {1}.'.format(name, desired_state)
+        ret['pchanges'] = {
+            'old': current_state,
+            'new': desired_state,
+        }
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    new_state = __salt__['wordpress.update_core'](site_path=name, user=user, version=desired_state)
+
+    if isinstance(new_state, Exception):
+        ret['comment'] = 'WordPress at "{0}" could not be updated: {1}'.format(name, new_state)
+        return _finish(ret)
+
+    ret['changes'] = {
+        'old': current_state,
+        'new': __salt__['wordpress.core_version'](site_path=name),
+    }
+
+    if ret['changes']['new'] != desired_state:
+        ret['comment'] = 'WordPress at "{0}" could not be updated to {1}'.format(name, desired_state)
+        return _finish(ret)
+
+    ret['comment'] = 'The state of "{0}" was changed!'.format(name)
+
+    ret['result'] = True
+
+    return _finish(ret)
+
+
+def managed(name,
+            version=None,
+            locale=None,
+            config=None,
+            install=None,
+            plugins=None,
+            themes=None,
+            theme=None,
+            user='www-data'):
+    """
+    Ensure that a site matches a full specification, in place of separate download, config, install,
+    plugin and theme states
+
+    The current state is gathered once, and only the needed steps are run, in dependency order
+    (see ``wordpress.manage_site``).  The changes are reported as a single diff.
+    :param name: The path of the site
+    :param version: The WordPress version; if not given, a new site gets the latest and existing sites are kept
+    :param locale: The WordPress locale of a new site
+    :param config: The wp-config.php values, as for ``site_configured``
+    :param install: A dict with the 'site_url', 'site_title', 'admin_user', 'admin_password' and 'admin_email'
+                    of the installation, as for ``site_installed``
+    :param plugins: A list of plugin names, or a dict mapping plugin names to a version and/or a 'status'
+                    of 'installed' (the default), 'active' or 'inactive'
+    :param themes: A list of theme names, or a dict mapping theme names to a version;
+                   plugins and themes installed at another version are installed again at this one
+    :param theme: The theme to activate
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    spec = {
+        'version': version,
+        'locale': locale,
+        'config': config,
+        'install': install,
+        'plugins': plugins,
+        'themes': themes,
+        'theme': theme,
+    }
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        # The first dry run gathers every site defined in pillar at once, concurrently;
+        # the ``managed`` states that follow are then planned without WP-CLI
+        if 'wordpress.current_states' not in __context__ \
+                and isinstance(__salt__['pillar.get']('wordpress:sites', {}), dict):
+            __salt__['wordpress.plan_fleet'](user=user)
+
+        plan = __salt__['wordpress.plan_site'](site_path=name, spec=spec, user=user)
+
+        if not plan['steps']:
+            ret['result'] = True
+            ret['comment'] = 'System already in the correct state'
+            return _finish(ret)
+
+        ret['comment'] = 'The state of "{0}" will be changed: {1}'.format(name, ', '.join(plan['steps']))
+        ret['pchanges'] = plan['changes']
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Planning and applying share one look at the current state
+    applied = __salt__['wordpress.manage_site'](site_path=name, spec=spec, user=user)
+
+    ret['changes'] = applied['changes']
+
+    if applied['failed']:
+        ret['comment'] = 'Site at "{0}" could not be brought to the correct state; step "{1}" failed: {2}' \
+            .format(name, applied['failed'], applied['error'])
+        return _finish(ret)
+
+    if not applied['steps']:
+        ret['comment'] = 'System already in the correct state'
+    else:
+        ret['comment'] = 'The state of "{0}" was changed: {1}'.format(name, ', '.join(applied['steps']))
+
+    ret['result'] = True
+
+    return _finish(ret)
+
+
+def cache_warmed(name,
+                 site_url,
+                 urls=None,
+                 sitemap=None,
+                 max_urls=None,
+                 passes=1,
+                 concurrency=None,
+                 max_errors=0):
+    """
+    Request the pages of a site, so that its caches are warm before the first visitors arrive
+
+    Meant to follow the states that leave the caches cold (``site_installed``, ``plugin_enabled``,
+    ``theme_enabled``, ...) through an ``onchanges`` requisite; see ``wordpress.warm_cache``.
+    :param name: The path of the site
+    :param site_url: The base URL of the site
+    :param urls: The URLs or paths to request, instead of those in the sitemap
+    :param sitemap: The URL or path of the sitemap
+    :param max_urls: The maximum number of sitemap URLs to request
+    :param passes: How many times to request every URL
+    :param concurrency: How many requests to make at once
+    :param max_errors: How many failed requests (errors and 5xx responses) are tolerated
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Warming always makes requests; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'The caches of "{0}" will be warmed.'.format(name)
+        ret['pchanges'] = {
+            'site_url': site_url,
+            'urls': len(urls) if urls is not None else 'sitemap',
+            'passes': passes,
+        }
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    try:
+        warmed = __salt__['wordpress.warm_cache'](site_url=site_url, urls=urls, sitemap=sitemap,
+                                                  max_urls=max_urls, passes=passes, concurrency=concurrency)
+    except Exception as e:
+        ret['comment'] = 'The caches of "{0}" could not be warmed: {1}'.format(name, e)
+        return _finish(ret)
+
+    errors = sum(warm_pass['errors'] for warm_pass in warmed['passes'])
+
+    ret['changes'] = {
+        'requests': sum(warm_pass['requests'] for warm_pass in warmed['passes']),
+        'errors': errors,
+        'latency': [warm_pass['latency'] for warm_pass in warmed['passes']],
+    }
+
+    if errors > max_errors:
+        ret['comment'] = '{0} request(s) failed while warming the caches of "{1}"'.format(errors, name)
+        return _finish(ret)
+
+    ret['comment'] = 'The caches of "{0}" were warmed with {1} URL(s)'.format(name, len(warmed['urls']))
+    ret['result'] = True
+
+    return _finish(ret)
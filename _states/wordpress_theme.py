@@ -14,6 +14,8 @@ def __virtual__():
 def _prep_return_array(name):
     # This technique is not used in the SaltStack built-in modules, presumably due to performance
     # However, for early dev, this allows us to reduce repetition
+    # The command mark lets ``_finish`` summarize the WP-CLI calls made by this state
+    __context__['wordpress.state_mark'] = __salt__['wordpress.command_count']()
     return {
         'name': name,
         'changes': {},
@@ -23,9 +25,22 @@ def _prep_return_array(name):
     }
 
 
+def _finish(ret):
+    # Adds the timing summary of the WP-CLI commands run by this state
+    ret['wp_cli'] = __salt__['wordpress.command_summary'](__context__.get('wordpress.state_mark', 0))
+    return ret
+
+
+def _active_theme(site_path, user):
+    # The inventory is cached for the run, so this costs no WP-CLI call after the check
+    inventory = __salt__['wordpress.get_inventory'](site_path=site_path, user=user)
+    return next((theme for theme, item in inventory['themes'].items() if item.get('status') == 'active'), None)
+
+
 def theme_installed(name,
                     site_path,
-                    user='www-data'):
+                    user='www-data',
+                    version=None):
     ret = _prep_return_array(name)
 
     # Basic error checking, "raise salt.exceptions.SaltInvocationError" if invalid inputs
@@ -38,25 +53,26 @@ def theme_installed(name,
     if current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
             'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'new': {'version': version or 'latest', 'status': 'inactive'},
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
     new_state = __salt__['wordpress.install_theme'](theme_name=name,
                                                     site_path=site_path,
-                                                    user=user)
+                                                    user=user,
+                                                    version=version)
 
     ret['comment'] = 'The state of "{0}" was changed!'.format(name)
 
@@ -67,7 +83,7 @@ def theme_installed(name,
 
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
 
 
 def theme_enabled(name,
@@ -88,20 +104,20 @@ def theme_enabled(name,
     if current_state:
         ret['result'] = True
         ret['comment'] = 'System already in the correct state'
-        return ret
+        return _finish(ret)
 
     # The state needs to change; check for test mode
     if __opts__['test']:
         ret['comment'] = 'The state of "{0}" will be changed.'.format(name)
         ret['pchanges'] = {
-            'old': current_state,
-            'new': 'Description, diff, whatever of the new state',
+            'old': _active_theme(site_path, user),
+            'new': name,
         }
 
         # Return ``None`` when running with ``test=True``
         ret['result'] = None
 
-        return ret
+        return _finish(ret)
 
     # Finally, make the actual change and return the result
     new_state = __salt__['wordpress.enable_theme'](theme_name=name,
@@ -117,4 +133,63 @@ def theme_enabled(name,
 
     ret['result'] = True
 
-    return ret
+    return _finish(ret)
+
+
+def theme_blogs_enabled(name,
+                        site_path,
+                        blogs=None,
+                        user='www-data'):
+    """
+    Ensure that a theme is the active theme of every (or the given) blogs of a multisite network
+
+    The blogs are checked with one ``wp site list`` and one status listing per blog, run in parallel;
+    the theme is network-enabled, then activated with one ``--url`` call per blog, also in parallel.
+    :param name: The theme name
+    :param site_path: The path of the network's WordPress install
+    :param blogs: A list of blog URLs or IDs; defaults to every blog that is not archived, deleted or spam
+    :param user: The user to run WP-CLI as
+    :return:
+    """
+    ret = _prep_return_array(name)
+
+    # Get the current state, then check for changes
+    inventory = __salt__['wordpress.get_network_inventory'](site_path=site_path, user=user, blogs=blogs)
+    current_state = dict((url, blog['themes'].get(name, 'not installed')) for url, blog in inventory['blogs'].items())
+
+    pending = sorted(url for url, status in current_state.items() if status != 'active')
+
+    if not pending:
+        ret['result'] = True
+        ret['comment'] = 'System already in the correct state'
+        return _finish(ret)
+
+    # The state needs to change; check for test mode
+    if __opts__['test']:
+        ret['comment'] = 'Theme "{0}" will be enabled on {1} blog(s).'.format(name, len(pending))
+        ret['pchanges'] = dict((url, {'old': current_state[url], 'new': 'active'}) for url in pending)
+
+        # Return ``None`` when running with ``test=True``
+        ret['result'] = None
+
+        return _finish(ret)
+
+    # Finally, make the actual change and return the result
+    new_state = __salt__['wordpress.enable_theme_blogs'](theme_name=name, site_path=site_path, user=user, blogs=pending)
+
+    if isinstance(new_state, Exception):
+        ret['comment'] = 'Theme "{0}" could not be enabled: {1}'.format(name, new_state)
+        return _finish(ret)
+
+    ret['changes'] = dict((url, {'old': current_state[url], 'new': 'active'}) for url in pending
+                          if url not in new_state['Result']['failed'])
+
+    failed = new_state['Result']['failed']
+    if failed:
+        ret['comment'] = 'Theme "{0}" could not be enabled on {1} blog(s): {2}' \
+            .format(name, len(failed), ', '.join(failed))
+    else:
+        ret['comment'] = 'The state of "{0}" was changed on {1} blog(s)!'.format(name, len(ret['changes']))
+        ret['result'] = True
+
+    return _finish(ret)
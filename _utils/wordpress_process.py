@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Process helpers shared by the WordPress execution modules, which reach them through ``__utils__``.
+# Synced to minions with ``saltutil.sync_utils`` (or ``saltutil.sync_all``).
+
+import os
+
+from salt.exceptions import CommandExecutionError
+
+
+def demote(user):
+    """
+    Return the ``subprocess.Popen`` (and ``asyncio.create_subprocess_exec``) arguments that run a process as ``user``
+
+    As root, the process switches to the user, its groups and its environment.
+    Any other minion user can only run processes as itself.
+    These arguments are used instead of a ``preexec_fn``, which is unsafe when the minion runs threads.
+    :param user: The user to run as; None for the minion user
+    :return: A dict with the 'user', 'group', 'extra_groups' and 'env' arguments, empty when no switch is needed
+    """
+    import pwd
+
+    if not user or user == pwd.getpwuid(os.geteuid()).pw_name:
+        return {}
+
+    if os.geteuid() != 0:
+        raise CommandExecutionError('Unable to run commands as \'{0}\': the minion is not running as root'
+                                    .format(user))
+
+    pw_record = pwd.getpwnam(user)
+
+    return {
+        'user': pw_record.pw_uid,
+        'group': pw_record.pw_gid,
+        'extra_groups': os.getgrouplist(user, pw_record.pw_gid),
+        # WP-CLI keeps its cache and config under $HOME
+        'env': dict(os.environ, HOME=pw_record.pw_dir, USER=user, LOGNAME=user),
+    }
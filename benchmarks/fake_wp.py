@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stand-in for the ``wp`` executable, used by the benchmark harness.
+#
+# Every invocation sleeps for FAKE_WP_LATENCY seconds to simulate the PHP/WordPress bootstrap,
+# is appended to the FAKE_WP_LOG file, and reads/writes the site's plugin and theme state
+# in a ``.fake-wp.json`` file, so that the modules see consistent results across calls.
+
+import json
+import os
+import sys
+import time
+
+
+def _site_path(args):
+    for arg in args:
+        if arg.startswith('--path='):
+            return arg[len('--path='):]
+    return os.getcwd()
+
+
+def _load(site_path):
+    try:
+        with open(os.path.join(site_path, '.fake-wp.json')) as state_file:
+            return json.load(state_file)
+    except (IOError, OSError, ValueError):
+        return {'installed': True, 'plugins': {}, 'themes': {}}
+
+
+def _save(site_path, state):
+    # Concurrent invocations read the state while it is written, so it is replaced in one step
+    state_path = os.path.join(site_path, '.fake-wp.json')
+    tmp_path = '{0}.{1}.tmp'.format(state_path, os.getpid())
+
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+
+    os.replace(tmp_path, state_path)
+
+
+def _add_to_disk(site_path, kind, name):
+    # Keeps the file system index in line with the simulated installs
+    item_dir = os.path.join(site_path, 'wp-content', kind + 's', name)
+    if not os.path.isdir(item_dir):
+        os.makedirs(item_dir)
+
+    if kind == 'plugin':
+        header_path, header = os.path.join(item_dir, name + '.php'), '<?php\n/*\nPlugin Name: {0}\n*/\n'
+    else:
+        header_path, header = os.path.join(item_dir, 'style.css'), '/*\nTheme Name: {0}\n*/\n'
+
+    with open(header_path, 'w') as header_file:
+        header_file.write(header.format(name))
+
+
+def main(args):
+    with open(os.environ['FAKE_WP_LOG'], 'a') as log_file:
+        log_file.write(json.dumps({'args': args, 'started': time.time()}) + '\n')
+
+    time.sleep(float(os.environ.get('FAKE_WP_LATENCY', '0.05')))
+
+    positional = [arg.strip('"') for arg in args if not arg.startswith('--')]
+    site_path = _site_path(args)
+    state = _load(site_path)
+
+    if positional[:2] == ['core', 'is-installed']:
+        return 0 if state['installed'] else 1
+
+    if len(positional) < 2 or positional[0] not in ('plugin', 'theme'):
+        return 0
+
+    kind, action, names = positional[0], positional[1], positional[2:]
+    items = state[kind + 's']
+
+    # Read-only actions never save the state, so they cannot overwrite a concurrent change
+    if action == 'list':
+        sys.stdout.write(json.dumps([{'name': name, 'status': status} for name, status in items.items()]))
+        return 0
+    if action == 'is-installed':
+        return 0 if names[0] in items else 1
+    if action == 'status':
+        if names[0] in items:
+            sys.stdout.write('Status: {0}\n'.format(items[names[0]].capitalize()))
+        return 0
+
+    if action == 'install':
+        for name in names:
+            items.setdefault(name, 'inactive')
+            _add_to_disk(site_path, kind, name)
+    elif action == 'activate':
+        if kind == 'theme':
+            for name in items:
+                items[name] = 'inactive'
+        for name in names:
+            if name not in items:
+                sys.stderr.write('Error: The {0} \'{1}\' could not be found.\n'.format(kind, name))
+                return 1
+            items[name] = 'active'
+    elif action == 'deactivate':
+        for name in names:
+            if name in items:
+                items[name] = 'inactive'
+
+    _save(site_path, state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the WordPress execution and state modules against a stub ``wp`` binary
+
+The modules are loaded outside of Salt, with the loader dunders (``__salt__``, ``__opts__``,
+``__context__``) filled in by this script; Salt itself must still be importable.
+``benchmarks/fake_wp.py`` stands in for WP-CLI, simulates the bootstrap latency and logs
+every invocation, so each scenario reports how many processes it spawned.
+
+Every scenario of N plugins x M themes x K sites is run three times: once against empty sites ('apply'),
+once more against the converged sites ('converged', the usual scheduled highstate), and a third time
+('steady'), when the site fingerprints saved by the previous run are current; without the database backend,
+plugin and theme statuses are still probed with WP-CLI in that pass.
+Each pass is run with the per-item states and with the batched ``plugins_enabled`` state.
+
+Usage:
+
+    python benchmarks/run.py --plugins 5,20 --themes 2 --sites 1,10 --output bench.json
+    python benchmarks/run.py --compare bench.json
+"""
+
+import argparse
+import getpass
+import glob
+import importlib.util
+import itertools
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_WP = os.path.join(REPO_ROOT, 'benchmarks', 'fake_wp.py')
+
+
+def _run_all(cmd, cwd=None, runas=None, python_shell=False, **kwargs):
+    # Replacement for ``cmd.run_all``; ``runas`` is ignored as everything runs as the current user.
+    # The WP-CLI commands themselves are run by the module's own subprocess engine.
+    proc = subprocess.run(shlex.split(cmd), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    return {'pid': 0, 'retcode': proc.returncode, 'stdout': proc.stdout, 'stderr': proc.stderr}
+
+
+def _load_module(path, dunders):
+    name = 'bench_{0}_{1}'.format(os.path.basename(os.path.dirname(path)).strip('_'),
+                                  os.path.splitext(os.path.basename(path))[0])
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    for key, value in dunders.items():
+        setattr(module, key, value)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _loader(cachedir, config):
+    """
+    Load every module the way the Salt loader would, sharing one set of dunders
+
+    :return: The execution and state function dicts, and the shared ``__context__``
+    """
+    context = {}
+    salt_functions = {
+        'cmd.run_all': _run_all,
+        'config.get': lambda key, default=None: config.get(key, default),
+        'event.send': lambda tag, data: True,
+    }
+    opts = {'test': False, 'cachedir': cachedir}
+    utils = {}
+    dunders = {'__salt__': salt_functions, '__opts__': opts, '__context__': context, '__utils__': utils}
+
+    for path in sorted(glob.glob(os.path.join(REPO_ROOT, '_utils', 'wordpress*.py'))):
+        module = _load_module(path, dunders)
+        for name in dir(module):
+            if not name.startswith('_') and callable(getattr(module, name)) \
+                    and getattr(getattr(module, name), '__module__', None) == module.__name__:
+                utils['{0}.{1}'.format(os.path.splitext(os.path.basename(path))[0], name)] = getattr(module, name)
+
+    for path in sorted(glob.glob(os.path.join(REPO_ROOT, '_modules', 'wordpress*.py'))):
+        module = _load_module(path, dunders)
+        for name in dir(module):
+            if not name.startswith('_') and callable(getattr(module, name)) \
+                    and getattr(getattr(module, name), '__module__', None) == module.__name__:
+                salt_functions['{0}.{1}'.format(module.__virtualname__, name)] = getattr(module, name)
+
+    states = {}
+    for path in sorted(glob.glob(os.path.join(REPO_ROOT, '_states', 'wordpress_*.py'))):
+        module = _load_module(path, dunders)
+        virtualname = module.__virtual__()
+        for name in dir(module):
+            if not name.startswith('_') and callable(getattr(module, name)) \
+                    and getattr(getattr(module, name), '__module__', None) == module.__name__:
+                states['{0}.{1}'.format(virtualname, name)] = getattr(module, name)
+
+    return salt_functions, states, context
+
+
+def _make_sites(root, count):
+    sites = []
+    for index in range(count):
+        site_path = os.path.join(root, 'site{0}'.format(index))
+        for sub_dir in ('plugins', 'themes'):
+            os.makedirs(os.path.join(site_path, 'wp-content', sub_dir))
+        for file_name in ('wp-load.php', 'wp-config.php'):
+            open(os.path.join(site_path, file_name), 'w').close()
+        sites.append(site_path)
+    return sites
+
+
+def _state_runs(mode, sites, plugins, themes):
+    # Yields the (state, kwargs) pairs of one highstate.
+    # The commands run as the current user, as the work directory is private to it.
+    user = getpass.getuser()
+    for site_path in sites:
+        if mode == 'batched':
+            yield 'wordpress_plugin.plugins_enabled', {'name': site_path, 'plugins': plugins,
+                                                       'site_path': site_path, 'user': user}
+        else:
+            for plugin in plugins:
+                yield 'wordpress_plugin.plugin_installed', {'name': plugin, 'site_path': site_path, 'user': user}
+                yield 'wordpress_plugin.plugin_enabled', {'name': plugin, 'site_path': site_path, 'user': user}
+
+        for theme in themes:
+            yield 'wordpress_theme.theme_installed', {'name': theme, 'site_path': site_path, 'user': user}
+        if themes:
+            yield 'wordpress_theme.theme_enabled', {'name': themes[0], 'site_path': site_path, 'user': user}
+
+
+def _count_lines(path):
+    try:
+        with open(path) as log_file:
+            return sum(1 for _ in log_file)
+    except (IOError, OSError):
+        return 0
+
+
+def _run_pass(states, context, mode, sites, plugins, themes, log_path):
+    # One highstate: a fresh ``__context__``, every state run in order
+    context.clear()
+    spawns_before = _count_lines(log_path)
+    failed = 0
+
+    tracemalloc.start()
+    started = time.time()
+
+    for state, kwargs in _state_runs(mode, sites, plugins, themes):
+        ret = states[state](**kwargs)
+        failed += ret['result'] is False
+
+    wall_time = time.time() - started
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'spawns': _count_lines(log_path) - spawns_before,
+        'wall_time': round(wall_time, 4),
+        'python_peak_kb': python_peak // 1024,
+        'failed_states': failed,
+    }
+
+
+def run_scenario(plugin_count, theme_count, site_count, mode, latency, config):
+    work_dir = tempfile.mkdtemp(prefix='wp-bench-')
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    wp_path = os.path.join(bin_dir, 'wp')
+    with open(wp_path, 'w') as wp_file:
+        wp_file.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable, FAKE_WP))
+    os.chmod(wp_path, 0o755)
+
+    log_path = os.path.join(work_dir, 'wp.log')
+    saved_env = dict(os.environ)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_WP_LOG'] = log_path
+    os.environ['FAKE_WP_LATENCY'] = str(latency)
+
+    try:
+        salt_functions, states, context = _loader(os.path.join(work_dir, 'cache'), config)
+        sites = _make_sites(os.path.join(work_dir, 'sites'), site_count)
+        plugins = ['plugin-{0}'.format(index) for index in range(plugin_count)]
+        themes = ['theme-{0}'.format(index) for index in range(theme_count)]
+
+        results = []
+        for pass_name in ('apply', 'converged', 'steady'):
+            result = _run_pass(states, context, mode, sites, plugins, themes, log_path)
+            result.update({
+                'scenario': '{0}p-{1}t-{2}s-{3}-{4}'.format(plugin_count, theme_count, site_count,
+                                                            mode, pass_name),
+                'plugins': plugin_count,
+                'themes': theme_count,
+                'sites': site_count,
+                'mode': mode,
+                'pass': pass_name,
+            })
+            results.append(result)
+
+        return results
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(baseline_path, results):
+    # Prints the change of every metric against a previous result file
+    with open(baseline_path) as baseline_file:
+        baseline = dict((result['scenario'], result) for result in json.load(baseline_file)['results'])
+
+    for result in results:
+        old = baseline.get(result['scenario'])
+        if old is None:
+            print('{0}: new scenario'.format(result['scenario']))
+            continue
+        deltas = ', '.join('{0} {1} -> {2}'.format(metric, old[metric], result[metric])
+                           for metric in ('spawns', 'wall_time', 'python_peak_kb')
+                           if old[metric] != result[metric])
+        print('{0}: {1}'.format(result['scenario'], deltas or 'unchanged'))
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--plugins', type=_int_list, default=[5, 20], help='Plugin counts, comma-separated')
+    parser.add_argument('--themes', type=_int_list, default=[2], help='Theme counts, comma-separated')
+    parser.add_argument('--sites', type=_int_list, default=[1, 5], help='Site counts, comma-separated')
+    parser.add_argument('--modes', default='per-item,batched', help='State styles to run, comma-separated')
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated WP-CLI bootstrap time, seconds')
+    parser.add_argument('--config', default='{}', help='Module options as JSON, e.g. \'{"wordpress:backend": "cli"}\'')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results with a previous JSON result file')
+    args = parser.parse_args()
+
+    # The package caches would reach out to wordpress.org; keep the runs offline unless asked otherwise
+    config = {'wordpress:artifact_cache': False, 'wordpress:core_cache': False}
+    config.update(json.loads(args.config))
+    results = []
+    for plugin_count, theme_count, site_count, mode in itertools.product(args.plugins, args.themes, args.sites,
+                                                                         args.modes.split(',')):
+        results.extend(run_scenario(plugin_count, theme_count, site_count, mode, args.latency, config))
+
+    report = {
+        'meta': {
+            'python': sys.version.split()[0],
+            'latency': args.latency,
+            'config': config,
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Exercises the persistent WP-CLI worker through the ``wordpress:worker_command`` stand-in,
+# with a small Python script that speaks the worker protocol instead of the PHP worker.
+
+import importlib.util
+import os
+import signal
+import sys
+
+import pytest
+
+exceptions = pytest.importorskip('salt.exceptions')
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Logs every command it receives, and dies without answering on 'plugin crash'
+FAKE_WORKER = r'''
+import json
+import os
+import sys
+
+print(json.dumps({'ready': True}), flush=True)
+for line in sys.stdin:
+    command = json.loads(line)['command']
+    with open(os.environ['FAKE_WORKER_LOG'], 'a') as log_file:
+        log_file.write(command + '\n')
+    if command == 'plugin crash':
+        os._exit(1)
+    print(json.dumps({'retcode': 0, 'stdout': '{0} {1}'.format(os.getpid(), command), 'stderr': ''}), flush=True)
+'''
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    script_path = tmp_path / 'fake_worker.py'
+    script_path.write_text(FAKE_WORKER)
+    log_path = tmp_path / 'commands.log'
+    monkeypatch.setenv('FAKE_WORKER_LOG', str(log_path))
+
+    config = {'wordpress:worker_command': [sys.executable, str(script_path)]}
+    spec = importlib.util.spec_from_file_location('test_wordpress_worker_module',
+                                                  os.path.join(REPO_ROOT, '_modules', 'wordpress_worker.py'))
+    module = importlib.util.module_from_spec(spec)
+    module.__salt__ = {'config.get': lambda key, default=None: config.get(key, default)}
+    module.__opts__ = {'cachedir': str(tmp_path / 'cache')}
+    module.__context__ = {}
+    module.__utils__ = {'wordpress_process.demote': lambda user: {}}
+    spec.loader.exec_module(module)
+
+    module.commands = lambda: log_path.read_text().splitlines() if log_path.exists() else []
+    yield module
+    module.worker_stop()
+
+
+def _run(worker, command, site_path):
+    return worker.worker_run('wp {0} --path="{1}"'.format(command, site_path), str(site_path), None)
+
+
+def test_commands_share_one_worker(worker, tmp_path):
+    first = _run(worker, 'plugin list --format=json', tmp_path)
+    second = _run(worker, 'theme list', tmp_path)
+
+    assert first['retcode'] == 0 and second['retcode'] == 0
+    assert first['pid'] == second['pid']
+    # The worker is bound to its site, so ``--path`` is not sent
+    assert worker.commands() == ['plugin list --format=json', 'theme list']
+
+
+def test_unsupported_command_raises(worker, tmp_path):
+    with pytest.raises(exceptions.CommandExecutionError):
+        _run(worker, 'core download', tmp_path)
+
+
+def test_worker_dead_before_send_is_restarted(worker, tmp_path):
+    first = _run(worker, 'plugin list', tmp_path)
+    os.kill(first['pid'], signal.SIGKILL)
+    os.waitpid(first['pid'], 0)
+
+    second = _run(worker, 'plugin list', tmp_path)
+
+    assert second['retcode'] == 0
+    assert second['pid'] != first['pid']
+    assert worker.commands() == ['plugin list', 'plugin list']
+
+
+def test_command_that_cannot_be_sent_is_retried(worker, tmp_path):
+    first = _run(worker, 'plugin list', tmp_path)
+    proc = worker.__context__['wordpress.workers'][(str(tmp_path), None)]['proc']
+    os.kill(first['pid'], signal.SIGKILL)
+    proc.wait()
+    # Not noticed as dead until the request is written to its closed stdin
+    polls = [None]
+    proc.poll = lambda: polls.pop() if polls else proc.returncode
+
+    second = _run(worker, 'plugin list', tmp_path)
+
+    assert second['retcode'] == 0
+    assert second['pid'] != first['pid']
+    assert worker.commands() == ['plugin list', 'plugin list']
+
+
+def test_worker_dying_during_command_is_not_retried(worker, tmp_path):
+    result = _run(worker, 'plugin crash', tmp_path)
+
+    assert result['retcode'] == 1
+    assert 'may have partly run' in result['stderr']
+    # Sent once: neither a new worker nor the caller runs it again
+    assert worker.commands() == ['plugin crash']
+
+    # The next command gets a fresh worker
+    assert _run(worker, 'plugin list', tmp_path)['retcode'] == 0